@@ -24,46 +24,73 @@ ROOT.gInterpreter.Declare(f'#include "{os.path.dirname(os.path.realpath(__file__
 bins_d0 = (20000, -10, 10) # range mm, bins um
 bins_z0 = (20000, -10, 10) # range mm, bins um
 
-bins_d0_um = (200000, -1000, 1000) # range mm, bins um
-bins_z0_um = (200000, -1000, 1000) # range mm, bins um
-
 bins_p = (250, 0, 250)
-bins_res_p = (20000, -0.10, 0.10)
-bins_res_k = (10000, -0.005, 0.005)
+
+# quantile sketches of the resolutions (see QuantileSketchHelper in functions.h): relative accuracy, range of |x|
+sketch_d0_um = (0.002, 1e-3, 1e5) # um
+sketch_res = (0.002, 1e-8, 1.) # relative p and absolute k (GeV^-1) resolution
+
+
+def book_sketch(df, column, params, name=None):
+    """Book a mergeable quantile sketch of column, written out as <name>_sketch (name: column by default)"""
+    return ROOT.FCCAnalyses.BookSketch[df.GetColumnType(column)](ROOT.RDF.AsRNode(df), column, f"{name or column}_sketch", *params)
 
 
 ## functions defined here: https://github.com/HEP-FCC/FCCAnalyses/blob/master/analyzers/dataframe/src/myUtils.cc
 ## vertex fitter: https://indico.cern.ch/event/1003610/contributions/4214579/attachments/2187815/3696958/Bedeschi_Vertexing_Feb2021.pdf
 ## perf. plots: https://indico.cern.ch/event/965346/contributions/4062989/attachments/2125687/3578824/vertexing.pdf
 
-def analysis(input_file, output_file):
+# tree of the slim track tables written by slim.py, and the columns used here under their names in the tables
+slim_tree = "tracks"
+slim_aliases = {"muons_p": "trk_p", "RP_TRK_D0_cov": "trk_d0_cov", "RP_TRK_Z0_cov": "trk_z0_cov",
+                "RP_TRK_D0_um": "res_d0_um", "RP_TRK_Z0_um": "res_z0_um", "muon_res_p": "res_p", "muon_res_k": "res_k",
+                "muon_mc_pdg": "gen_pdg", "muon_res_pdg": "res_pdg"}
+
+# residual columns (reco - gen) per resolution type
+residual_columns = {"d0": "RP_TRK_D0_um", "z0": "RP_TRK_Z0_um", "p": "muon_res_p", "k": "muon_res_k"}
+
+# columns split by species, per truth PDG column: the per-particle columns and those of the matched particles only
+# (leptonResiduals skips the unmatched ones)
+species_columns = {"muon_mc_pdg": ["muons_p", "RP_TRK_D0_um", "RP_TRK_Z0_um", "RP_TRK_D0_cov", "RP_TRK_Z0_cov"],
+                   "muon_res_pdg": ["muon_res_p", "muon_res_k"]}
 
-    df = ROOT.RDataFrame("events", input_file)
 
+def define_residuals(df, all_tracks=False):
+    """
+    Define the muons, their track parameters and the residual columns. With all_tracks, all reconstructed
+    particles with a track are taken instead of the muons, to be split by species with select_species
+    """
 
     df = df.Alias("MCRecoAssociations0", "_Particle_parents.index")
     df = df.Alias("MCRecoAssociations1", "_Particle_daughters.index")
     df = df.Alias("Muons", "Muon_objIdx.index")
 
-    df = df.Define("muons_all", "FCCAnalyses::ReconstructedParticle::get(Muons, ReconstructedParticles)")
+    if all_tracks:
+        df = df.Define("muons_all", "FCCAnalyses::trackParticles(ReconstructedParticles)")
+    else:
+        df = df.Define("muons_all", "FCCAnalyses::ReconstructedParticle::get(Muons, ReconstructedParticles)")
     df = df.Define("muons_p", "FCCAnalyses::ReconstructedParticle::get_p(muons_all)")
-    muon_p = df.Histo1D(("muons_", "", *bins_p), "muons_p")
 
+    # generator particle matched to each muon, computed once and shared by all residuals
+    df = df.Define("muon_mc_index", "FCCAnalyses::leptonMCIndex(muons_all, MCRecoAssociations0, MCRecoAssociations1, ReconstructedParticles)")
+    df = df.Define("muon_mc_pdg", "FCCAnalyses::takeGen(FCCAnalyses::MCParticle::get_pdg(Particle), muon_mc_index)") # NaN if unmatched
 
-    # get track resolution (p and k)
-    df = df.Define("muon_res_p", "FCCAnalyses::leptonResolution(muons_all, MCRecoAssociations0, MCRecoAssociations1, ReconstructedParticles, Particle, 0)")
-    df = df.Define("muon_res_k", "FCCAnalyses::leptonResolution(muons_all, MCRecoAssociations0, MCRecoAssociations1, ReconstructedParticles, Particle, 3)")
-    muon_res_p = df.Histo1D(("muon_res_p", "", *bins_res_p), "muon_res_p")
-    muon_res_k = df.Histo1D(("muon_res_k", "", *bins_res_k), "muon_res_k")
+    # get track resolution (p, theta, phi and k) in one pass
+    df = df.Define("muon_residuals", "FCCAnalyses::leptonResiduals(muons_all, muon_mc_index, Particle)")
+    df = df.Define("muon_res_p", "muon_residuals.p")
+    df = df.Define("muon_res_theta", "muon_residuals.theta")
+    df = df.Define("muon_res_phi", "muon_residuals.phi")
+    df = df.Define("muon_res_k", "muon_residuals.k")
+    df = df.Define("muon_res_pdg", "muon_residuals.pdg")
 
     # get gen D0 and Z0
     #df = df.Define("D0_gen", "FCCAnalyses::get_D0_gen(muons_all, MCRecoAssociations0, MCRecoAssociations1, ReconstructedParticles, Particle, 0)")
     #df = df.Define("Z0_gen", "FCCAnalyses::get_Z0_gen(muons_all, MCRecoAssociations0, MCRecoAssociations1, ReconstructedParticles, Particle, 0)")
 
-    # calculate_d0_z0_gen
-    df = df.Define("d0_z0_gen", "FCCAnalyses::calculate_d0_z0_gen(Particle, magFieldBz)")
-    df = df.Define("D0_gen", "d0_z0_gen[0]")
-    df = df.Define("Z0_gen", "d0_z0_gen[1]")
+    # helix d0 and z0 of the generator particle matched to each muon (any number of particles per event)
+    df = df.Define("gen_helix", "FCCAnalyses::genHelixMatched(Particle, muon_mc_index, magFieldBz)")
+    df = df.Define("D0_gen", "gen_helix.d0")
+    df = df.Define("Z0_gen", "gen_helix.z0")
 
     # get the track fit parameters (assume particles are muons)
     df = df.Define("RP_TRK_D0", "ReconstructedParticle2Track::getRP2TRK_D0(muons_all, _EFlowTrack_trackStates) - D0_gen") # d0 in mm
@@ -75,45 +102,114 @@ def analysis(input_file, output_file):
     df = df.Define("RP_TRK_D0_um", "RP_TRK_D0 * 1000.0")
     df = df.Define("RP_TRK_Z0_um", "RP_TRK_Z0 * 1000.0")
 
-    # get the errors on the track parameters
+    return df
+
+
+def select_species(df, pdg, suffix):
+    """Define the columns of species_columns for the particles matched to a generator particle of PDG id pdg, as <column><suffix>"""
+    for pdg_column, columns in species_columns.items():
+        for column in columns:
+            if df.HasColumn(column): # the covariances are only defined for the analysis
+                df = df.Define(f"{column}{suffix}", f"{column}[{pdg_column} == {pdg}]")
+    return df
+
+
+def slim_dataframe(input_files):
+    """RDataFrame of slim track tables, with the columns named as in define_residuals"""
+    df = ROOT.RDataFrame(slim_tree, input_files)
+    for alias, column in slim_aliases.items():
+        df = df.Alias(alias, column)
+    return df
+
+
+def define_covariances(df):
+    """Define the errors on the track parameters of the muons"""
     df = df.Define("RP_TRK_D0_cov", "ReconstructedParticle2Track::getRP2TRK_D0_cov(muons_all, _EFlowTrack_trackStates)")
     df = df.Define("RP_TRK_Z0_cov", "ReconstructedParticle2Track::getRP2TRK_Z0_cov(muons_all, _EFlowTrack_trackStates)")
     df = df.Define("RP_TRK_omega_cov", "ReconstructedParticle2Track::getRP2TRK_omega_cov(muons_all, _EFlowTrack_trackStates)")
     df = df.Define("RP_TRK_phi_cov", "ReconstructedParticle2Track::getRP2TRK_phi_cov(muons_all, _EFlowTrack_trackStates)")
     df = df.Define("RP_TRK_tanlambda_cov", "ReconstructedParticle2Track::getRP2TRK_tanLambda_cov(muons_all, _EFlowTrack_trackStates)")
+    return df
 
-    h_RP_TRK_D0 = df.Histo1D(("RP_TRK_D0", "", *bins_d0), "RP_TRK_D0")
-    h_RP_TRK_Z0 = df.Histo1D(("RP_TRK_Z0", "", *bins_z0), "RP_TRK_Z0")
 
-    h_RP_TRK_D0_um = df.Histo1D(("RP_TRK_D0_um", "", *bins_d0_um), "RP_TRK_D0_um")
-    h_RP_TRK_Z0_um = df.Histo1D(("RP_TRK_Z0_um", "", *bins_z0_um), "RP_TRK_Z0_um")
+def book_results(df, suffix=""):
+    """Book the outputs on the columns <column><suffix>, returns them in the order they are written out"""
 
-    h_RP_TRK_D0_cov = df.Histo1D(("RP_TRK_D0_cov", "", *bins_d0), "RP_TRK_D0_cov")
-    h_RP_TRK_Z0_cov = df.Histo1D(("RP_TRK_Z0_cov", "", *bins_z0), "RP_TRK_Z0_cov")
+    muon_p = df.Histo1D(("muons_", "", *bins_p), f"muons_p{suffix}")
+    muon_res_p = book_sketch(df, f"muon_res_p{suffix}", sketch_res, "muon_res_p")
+    muon_res_k = book_sketch(df, f"muon_res_k{suffix}", sketch_res, "muon_res_k")
 
+    h_RP_TRK_D0_um = book_sketch(df, f"RP_TRK_D0_um{suffix}", sketch_d0_um, "RP_TRK_D0_um")
+    h_RP_TRK_Z0_um = book_sketch(df, f"RP_TRK_Z0_um{suffix}", sketch_d0_um, "RP_TRK_Z0_um")
 
-    # write output
+    h_RP_TRK_D0_cov = df.Histo1D(("RP_TRK_D0_cov", "", *bins_d0), f"RP_TRK_D0_cov{suffix}")
+    h_RP_TRK_Z0_cov = df.Histo1D(("RP_TRK_Z0_cov", "", *bins_z0), f"RP_TRK_Z0_cov{suffix}")
+
+
+    return [h_RP_TRK_D0_um, h_RP_TRK_Z0_um, h_RP_TRK_D0_cov, h_RP_TRK_Z0_cov, muon_p, muon_res_p, muon_res_k]
+
+
+def build_graph(input_file, slim=False, pdgs=None):
+    """
+    Book the analysis on input_file, returns the results of each output file in the order they are written out.
+    With slim, input_file is a slim track table written by slim.py instead of a Delphes output.
+    With pdgs, all tracks are analysed and split by the PDG id of their generator particle, into one output per species
+    """
+
+    if slim:
+        df = slim_dataframe(input_file)
+    else:
+        df = define_covariances(define_residuals(ROOT.RDataFrame("events", input_file), all_tracks=bool(pdgs)))
+
+    if not pdgs:
+        return [book_results(df)]
+    return [book_results(select_species(df, pdg, f"_species{i}"), f"_species{i}") for i, pdg in enumerate(pdgs)]
+
+
+def write_output(results, output_file):
     fout = ROOT.TFile(output_file, "RECREATE")
-    h_RP_TRK_D0.Write()
-    h_RP_TRK_Z0.Write()
-    h_RP_TRK_D0_um.Write()
-    h_RP_TRK_Z0_um.Write()
-    h_RP_TRK_D0_cov.Write()
-    h_RP_TRK_Z0_cov.Write()
-    muon_p.Write()
-    muon_res_p.Write()
-    muon_res_k.Write()
+    for res in results:
+        res.Write()
     fout.Close()
 
 
+def analysis(input_file, output_files, slim=False, pdgs=None):
+    for results, output_file in zip(build_graph(input_file, slim, pdgs), output_files):
+        write_output(results, output_file)
+
+
+def analysis_batch(input_files, output_files, nThreads=0, slim=False, pdgs=None):
+    """
+    Analyse all samples in one process: the libraries and functions.h are loaded and JIT-compiled once,
+    and the event loops of all graphs run concurrently on a shared thread pool via RunGraphs.
+    output_files are the outputs of the first input file, then those of the second one, ...
+    """
+    ROOT.EnableImplicitMT(nThreads)
+    graphs = [build_graph(input_file, slim, pdgs) for input_file in input_files]
+    ROOT.RDF.RunGraphs([outputs[0][0] for outputs in graphs]) # one handle per graph triggers the full graph
+    for results, output_file in zip([results for outputs in graphs for results in outputs], output_files):
+        write_output(results, output_file)
+
+
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", type=str, help="Input file", required=True)
-    parser.add_argument("-o", "--output", type=str, help="Output file", required=True)
+    parser.add_argument("-i", "--input", type=str, nargs='+', help="Input file(s)", required=True)
+    parser.add_argument("-o", "--output", type=str, nargs='+', help="Output file(s), one per input file (with --pdg one per input file and species, those of the first input file first)", required=True)
+    parser.add_argument("--nThreads", type=int, help="Number of threads when analysing several files (0: all cores)", default=0)
+    parser.add_argument("--slim", help="Inputs are slim track tables (slim.py) instead of Delphes outputs", action='store_true')
+    parser.add_argument("--pdg", type=int, nargs='+', help="Analyse all tracks and split them by the PDG id of their generator particle, one output per species", default=None)
     args = parser.parse_args()
 
-    logger.info(f"Start analysis on {args.input}")
-    analysis(args.input, args.output)
-    logger.info(f"Done! Output saved to {args.output}")
+    if len(args.output) != len(args.input)*len(args.pdg or [None]):
+        parser.error("--output needs one file per input file (and per --pdg species)")
+
+    if len(args.input) == 1:
+        logger.info(f"Start analysis on {args.input[0]}")
+        analysis(args.input[0], args.output, args.slim, args.pdg)
+        logger.info(f"Done! Output saved to {', '.join(args.output)}")
+    else:
+        logger.info(f"Start analysis on {len(args.input)} files")
+        analysis_batch(args.input, args.output, args.nThreads, args.slim, args.pdg)
+        logger.info(f"Done! Outputs saved to {', '.join(args.output)}")
@@ -0,0 +1,234 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+# Benchmarks of the pipeline: each stage of run.py on a small grid (wall and CPU time, events/s, peak RSS and bytes
+# written, measured over the stage process and all its children), and micro-benchmarks of the kernels of
+# functions.h on synthetic events. Every run appends a record with the git commit to a JSON lines file, so that
+# runs can be compared across commits with --compare.
+
+# stage: (run.py options, output directories of the stage relative to the output directory, {card} is the card)
+STAGES = {
+    "gun": (["--gun"], ["hepmc3", "cards"]),
+    "delphes": (["--delphes"], ["delphes_{card}"]),
+    "slim": (["--analysis", "--slim"], ["slim_{card}", "analysis_{card}"]),
+    "analysis": (["--analysis"], ["analysis_{card}"]),
+    "plots": (["--plots"], ["plots_{card}"]),
+    "resolution": (["--plots", "--unbinned"], ["plots_{card}"]),
+}
+DEFAULT_STAGES = ["gun", "delphes", "analysis", "plots"]
+
+# synthetic gun events and the kernels timed on them, compiled once
+KERNELS = r"""
+namespace FCCAnalysesBenchmark {
+
+using namespace FCCAnalyses;
+
+// gun-like events: two beam particles and nparticles muons from a displaced vertex, with matched reconstructed muons
+struct Events {
+    std::vector<Vec_mc> mc;
+    std::vector<Vec_rp> reco;
+    std::vector<Vec_i> mc_index;
+};
+
+Events makeEvents(int nevents, int nparticles, unsigned int seed) {
+    std::mt19937_64 rng(seed);
+    std::uniform_real_distribution<double> uniform(0., 1.);
+    std::normal_distribution<double> gauss(0., 1.);
+    Events events;
+    for (int i = 0; i < nevents; i++) {
+        Vec_mc mc(2 + nparticles);
+        Vec_rp reco(nparticles);
+        Vec_i index(nparticles);
+        for (int j = 0; j < nparticles; j++) {
+            const double p = 1. + 99.*uniform(rng), theta = 0.15 + 2.8*uniform(rng), phi = 2*M_PI*uniform(rng), vphi = 2*M_PI*uniform(rng);
+            auto& particle = mc[2 + j];
+            particle.PDG = 13;
+            particle.charge = uniform(rng) < 0.5 ? -1 : 1;
+            particle.mass = 0.10566;
+            particle.vertex.x = 20.*std::cos(vphi);
+            particle.vertex.y = 20.*std::sin(vphi);
+            particle.vertex.z = 0.;
+            particle.momentum.x = p*std::sin(theta)*std::cos(phi);
+            particle.momentum.y = p*std::sin(theta)*std::sin(phi);
+            particle.momentum.z = p*std::cos(theta);
+            const double smear = 1. + 1e-3*gauss(rng);
+            reco[j].momentum.x = particle.momentum.x*smear;
+            reco[j].momentum.y = particle.momentum.y*smear;
+            reco[j].momentum.z = particle.momentum.z*smear;
+            reco[j].mass = particle.mass;
+            reco[j].tracks_begin = j;
+            index[j] = 2 + j;
+        }
+        events.mc.push_back(mc);
+        events.reco.push_back(reco);
+        events.mc_index.push_back(index);
+    }
+    return events;
+}
+
+// best of repeat runs over all events, in ns per event
+template <typename F>
+double timeEvents(const Events& events, int repeat, F kernel) {
+    double best = 1e300;
+    for (int r = 0; r < repeat; r++) {
+        const auto start = std::chrono::steady_clock::now();
+        for (size_t i = 0; i < events.mc.size(); i++) kernel(i);
+        const std::chrono::duration<double, std::nano> elapsed = std::chrono::steady_clock::now() - start;
+        best = std::min(best, elapsed.count()/events.mc.size());
+    }
+    return best;
+}
+
+std::map<std::string, double> timeKernels(int nevents, int nparticles, int repeat, unsigned int seed) {
+    const Events events = makeEvents(nevents, nparticles, seed);
+    const Vec_f bz{2.f};
+    double sink = 0.; // keeps the results alive
+    std::map<std::string, double> times;
+    times["genHelixMatched"] = timeEvents(events, repeat, [&](size_t i) { sink += genHelixMatched(events.mc[i], events.mc_index[i], bz).d0[0]; });
+    times["leptonResiduals"] = timeEvents(events, repeat, [&](size_t i) { sink += leptonResiduals(events.reco[i], events.mc_index[i], events.mc[i]).p.size(); });
+    std::vector<Vec_f> pdg; // per-generator-particle column, as taken for the muons in the analysis
+    for (const auto& mc : events.mc) pdg.push_back(MCParticle::get_pdg(mc));
+    times["takeGen"] = timeEvents(events, repeat, [&](size_t i) { sink += takeGen(pdg[i], events.mc_index[i]).size(); });
+    QuantileSketchHelper sketch("benchmark_sketch", 0.002, 1e-8, 1., 1);
+    times["QuantileSketch"] = timeEvents(events, repeat, [&](size_t i) { sketch.Exec(0, (double)events.reco[i][0].momentum.x/events.mc[i][2].momentum.x - 1.); });
+    times["sink"] = sink;
+    return times;
+}
+
+}
+"""
+
+
+def git_commit():
+    """Commit of the working tree, with a -dirty suffix if it has uncommitted changes"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def directory_bytes(paths):
+    total = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+def run_stage(stage, run_options, output_dir, card, nevents, nsamples):
+    """
+    Run a stage of run.py from scratch (its outputs in output_dir are removed first), returns its metrics.
+    The resource usage covers the stage and all its child processes
+    """
+    options, directories = STAGES[stage]
+    directories = [os.path.join(output_dir, d.format(card=card)) for d in directories]
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+    cmd = ["python", "analysis/run.py", *options, "--force", "--output_dir", output_dir, "--delphes_card", card, *run_options]
+    print(f"Benchmarking {stage}: {' '.join(cmd)}")
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {returncode}")
+    events = nevents*nsamples
+    return {"wall": wall, "cpu": usage.ru_utime + usage.ru_stime, "events": events, "events_per_s": events/wall,
+            "peak_rss_mb": usage.ru_maxrss/1024, "bytes_written": directory_bytes(directories)}
+
+def run_kernels(nevents, nparticles, repeat, seed):
+    """Time the kernels of functions.h on synthetic events, in ns per event"""
+    import ROOT
+    import analysis # loads the libraries and functions.h
+
+    ROOT.gInterpreter.Declare("#include <chrono>\n#include <map>\n#include <random>")
+    ROOT.gInterpreter.Declare(KERNELS)
+    times = ROOT.FCCAnalysesBenchmark.timeKernels(nevents, nparticles, repeat, seed)
+    return {str(item.first): float(item.second) for item in times if str(item.first) != "sink"}
+
+def read_records(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(path, commits=None):
+    """Print the metrics of two records side by side: the last ones of the given commits, or the last two records"""
+    records = read_records(path)
+    if commits:
+        if len(commits) != 2:
+            raise SystemExit("--compare takes two commits, or none for the last two records")
+        selected = [[r for r in records if r["commit"].startswith(c)][-1:] for c in commits]
+        if not all(selected):
+            raise SystemExit(f"No benchmark record for {', '.join(c for c, s in zip(commits, selected) if not s)} in {path}")
+        old, new = (s[0] for s in selected)
+    elif len(records) >= 2:
+        old, new = records[-2:]
+    else:
+        raise SystemExit(f"Need at least two benchmark records in {path}")
+
+    print(f"{'':32} {old['commit']:>14} {new['commit']:>14} {'ratio':>8}")
+    for stage in new["stages"]:
+        if stage not in old["stages"]:
+            continue
+        for metric in ("wall", "cpu", "events_per_s", "peak_rss_mb", "bytes_written"):
+            a, b = old["stages"][stage][metric], new["stages"][stage][metric]
+            print(f"{stage + ' ' + metric:32} {a:14.4g} {b:14.4g} {b/a if a else float('nan'):8.3f}")
+    for kernel, b in new["kernels"].items():
+        if kernel in old["kernels"]:
+            a = old["kernels"][kernel]
+            print(f"{kernel + ' ns/event':32} {a:14.4g} {b:14.4g} {b/a:8.3f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=str, nargs='*', help=f"Stages to run, in order (available: {', '.join(STAGES)})", default=DEFAULT_STAGES)
+    parser.add_argument("--theta", type=int, nargs='+', help="Polar angles of the benchmark grid (degrees)", default=[20, 90])
+    parser.add_argument("--mom", type=int, nargs='+', help="Momenta of the benchmark grid (GeV)", default=[10])
+    parser.add_argument("--nevents", type=int, help="Number of events per sample", default=2000)
+    parser.add_argument("--delphes_card", type=str, help="Delphes card", default="IDEA_baseline")
+    parser.add_argument("--nThreads", type=int, help="Number of concurrent jobs of the stages", default=os.cpu_count())
+    parser.add_argument("--output_dir", type=str, help="Output directory of the benchmark samples", default="output_benchmark")
+    parser.add_argument("--kernels", help="Also run the micro-benchmarks of the functions.h kernels", action='store_true')
+    parser.add_argument("--kernel_events", type=int, help="Number of synthetic events of the micro-benchmarks", default=100000)
+    parser.add_argument("--kernel_particles", type=int, help="Muons per synthetic event", default=1)
+    parser.add_argument("--repeat", type=int, help="Repetitions of the micro-benchmarks (best is kept)", default=5)
+    parser.add_argument("--results", type=str, help="JSON lines file the benchmark records are appended to", default="benchmarks.jsonl")
+    parser.add_argument("--compare", type=str, nargs='*', help="Compare the records of two commits (default: the last two records) and exit", default=None)
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(args.results, args.compare or None)
+        sys.exit(0)
+
+    run_options = ["--theta", *map(str, args.theta), "--mom", *map(str, args.mom), "--nevents", str(args.nevents), "--nThreads", str(args.nThreads)]
+    nsamples = len(args.theta)*len(args.mom)
+    record = {
+        "commit": git_commit(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "config": {"theta": args.theta, "mom": args.mom, "nevents": args.nevents, "card": args.delphes_card, "nThreads": args.nThreads},
+        "stages": {},
+        "kernels": {},
+    }
+    for stage in args.stages:
+        record["stages"][stage] = run_stage(stage, run_options, args.output_dir, args.delphes_card, args.nevents, nsamples)
+        m = record["stages"][stage]
+        print(f"{stage}: {m['wall']:.1f} s wall, {m['cpu']:.1f} s CPU, {m['events_per_s']:.0f} events/s, {m['peak_rss_mb']:.0f} MB peak RSS, {m['bytes_written']/1e6:.1f} MB written")
+    if args.kernels:
+        record["kernels"] = run_kernels(args.kernel_events, args.kernel_particles, args.repeat, 1)
+        for kernel, t in record["kernels"].items():
+            print(f"{kernel}: {t:.1f} ns/event")
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Benchmark record of {record['commit']} appended to {args.results}")
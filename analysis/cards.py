@@ -0,0 +1,352 @@
+import argparse
+import itertools
+import json
+import os
+import re
+
+# Delphes cards are Tcl: top-level statements (set ..., module Class Name {...}) with braced, possibly nested bodies.
+# The parser keeps the text of every statement, so that derived cards differ from the original only where modified
+
+# branches of the TreeWriter read (through the EDM4hep output) by analysis.py
+TRACKING_BRANCHES = ["Particle", "EFlowTrack", "Muon"]
+# modules that only add information to the tracks not used for the resolutions (dN/dx, timing), bypassed
+TRACKING_BYPASS = ["ClusterCounting", "TimeSmearing", "TimeOfFlight"]
+# calorimeters pass on the tracks as eflow tracks, replaced by their input tracks
+CALORIMETERS = ["Calorimeter", "SimpleCalorimeter", "DualReadoutCalorimeter"]
+# modules whose output is a subset of their input
+FILTERS = ["Efficiency", "PdgCodeFilter"]
+# columns of the DetectorGeometry layers of the TrackCovariance module
+LAYER_FIELDS = ["type", "label", "zmin", "zmax", "r", "w", "X0", "n_meas", "th_up", "th_down", "reso_up", "reso_down", "flag"]
+
+
+class Statement:
+    """A top-level statement of a card, with the comments and blank lines preceding it"""
+
+    def __init__(self, text, prefix=""):
+        self.text = text
+        self.prefix = prefix
+
+    def to_text(self):
+        return self.prefix + self.text
+
+
+class Module(Statement):
+
+    def __init__(self, header, cls, name, body, footer, prefix=""):
+        self.header = header
+        self.cls = cls
+        self.name = name
+        self.body = body
+        self.footer = footer
+        self.prefix = prefix
+
+    @property
+    def text(self):
+        return f"{self.header}{{{self.body}}}{self.footer}"
+
+    def params(self, key):
+        """Values of the set/add lines for key, as lists of tokens"""
+        return [line.split()[2:] for line in self.body.splitlines() if re.match(rf"\s*(set|add)\s+{key}\s", line)]
+
+    def param(self, key):
+        values = self.params(key)
+        return values[0][0] if values else None
+
+    def set_param(self, key, value):
+        """Replace the value of a set line, returns whether the module has it"""
+        self.body, n = re.subn(rf"^(\s*set\s+{key}\s+)\S+", lambda m: f"{m.group(1)}{value}", self.body, flags=re.M)
+        return n > 0
+
+    def remove_lines(self, predicate):
+        lines = self.body.splitlines(keepends=True)
+        self.body = "".join(line for line in lines if not predicate(line))
+
+    def references(self):
+        """Arrays of other modules (Module/array) this module reads"""
+        return set(re.findall(r"(?<![\w/$])([A-Za-z]\w*)/(\w+)(?![\w/])", self.body))
+
+    def replace_references(self, mapping):
+        """Replace references to arrays (Module/array -> Module/array)"""
+        def replace(m):
+            return mapping.get(m.group(0), m.group(0))
+        self.body = re.sub(r"(?<![\w/$])[A-Za-z]\w*/\w+(?![\w/])", replace, self.body)
+
+
+class ExecutionPath(Statement):
+
+    def __init__(self, original, original_path, prefix=""):
+        self.original = original
+        self.original_path = original_path
+        self.prefix = prefix
+        self.card = None
+
+    @property
+    def text(self):
+        if self.card.execution_path == self.original_path:
+            return self.original
+        path = "".join(f"  {name}\n" for name in self.card.execution_path)
+        return f"set ExecutionPath {{\n{path}}}\n"
+
+
+class Card:
+
+    def __init__(self, statements, execution_path, trailer=""):
+        self.statements = statements
+        self.execution_path = execution_path
+        self.trailer = trailer
+
+    @property
+    def modules(self):
+        return {s.name: s for s in self.statements if isinstance(s, Module)}
+
+    def producer(self, array):
+        """Module producing an array (Module/array), None for the Delphes reader arrays"""
+        return self.modules.get(array.split("/")[0])
+
+    def to_text(self):
+        return "".join(s.to_text() for s in self.statements) + self.trailer
+
+
+def parse_card(text):
+    """Parse a Delphes card into its statements"""
+    statements = []
+    execution_path = []
+    prefix = ""
+    lines = text.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip() or line.lstrip().startswith("#"):
+            prefix += line
+            i += 1
+            continue
+
+        # collect the statement until its braces are balanced
+        depth = line.count("{") - line.count("}")
+        statement = line
+        while depth > 0 and i + 1 < len(lines):
+            i += 1
+            statement += lines[i]
+            depth += lines[i].count("{") - lines[i].count("}")
+        i += 1
+
+        m = re.match(r"(\s*module\s+(\S+)\s+(\S+)\s*)\{(.*)\}(\s*)$", statement, flags=re.S)
+        if m:
+            statements.append(Module(m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), prefix))
+        elif re.match(r"\s*set\s+ExecutionPath\s*\{", statement):
+            body = statement[statement.index("{")+1:statement.rindex("}")]
+            execution_path = [token for line in body.splitlines() if not line.strip().startswith("#") for token in line.split()]
+            statements.append(ExecutionPath(statement, list(execution_path), prefix))
+        else:
+            statements.append(Statement(statement, prefix))
+        prefix = ""
+    card = Card(statements, execution_path, prefix)
+    for s in statements:
+        if isinstance(s, ExecutionPath):
+            s.card = card
+    return card
+
+
+def resolve(mapping):
+    """Follow chains of replaced arrays to their final replacement"""
+    resolved = {}
+    for array in mapping:
+        target = array
+        while target in mapping:
+            target = mapping[target]
+        resolved[array] = target
+    return resolved
+
+def is_subset(card, array, other):
+    """Whether array only holds candidates of other, i.e. it is other after a chain of filters"""
+    while array != other:
+        module = card.producer(array)
+        if module is None or module.cls not in FILTERS:
+            return False
+        array = module.param("InputArray")
+    return True
+
+def tracking_card(card, branches=TRACKING_BRANCHES):
+    """
+    Derive a tracking-only card: keep only the TreeWriter branches read by the analysis and the modules they need.
+    Timing/dN/dx modules on the track chain are bypassed, and the calorimeter eflow tracks are replaced by the
+    calorimeter input tracks. Merger inputs that become subsets of other inputs (e.g. forward loopers) are dropped
+    """
+    modules = card.modules
+
+    # arrays replaced by the arrays they were made from
+    mapping = {}
+    for module in modules.values():
+        if module.cls in TRACKING_BYPASS:
+            mapping[f"{module.name}/{module.param('OutputArray')}"] = module.param("InputArray")
+        if module.cls in CALORIMETERS and module.param("EFlowTrackOutputArray"):
+            mapping[f"{module.name}/{module.param('EFlowTrackOutputArray')}"] = module.param("TrackInputArray")
+    mapping = resolve(mapping)
+    for module in modules.values():
+        module.replace_references(mapping)
+
+    for module in modules.values():
+        if module.cls == "Merger":
+            inputs = [values[0] for values in module.params("InputArray")]
+            redundant = {a for a in inputs for b in inputs if a != b and is_subset(card, a, b)}
+            module.remove_lines(lambda line: re.match(r"\s*add\s+InputArray\s+(\S+)", line) and line.split()[2] in redundant)
+        if module.cls == "TreeWriter":
+            module.remove_lines(lambda line: re.match(r"\s*add\s+Branch\s", line) and line.split()[3] not in branches)
+
+    # modules needed by the TreeWriter
+    needed = set()
+    stack = [name for name, module in modules.items() if module.cls == "TreeWriter"]
+    while stack:
+        name = stack.pop()
+        if name in needed or name not in modules:
+            continue
+        needed.add(name)
+        stack.extend(ref for ref, _ in modules[name].references())
+
+    card.statements = [s for s in card.statements if not isinstance(s, Module) or s.name in needed]
+    card.execution_path = [name for name in card.execution_path if name in needed]
+    return card
+
+
+def format_value(value):
+    return f"{value:g}" if isinstance(value, (int, float)) else str(value)
+
+def get_variable(card, name):
+    """Value of a top-level variable of the card, None if it is not set"""
+    for s in card.statements:
+        m = re.match(rf"\s*set\s+{name}\s+(\S+)", s.text) if type(s) is Statement else None
+        if m:
+            return m.group(1)
+    return None
+
+def detector_geometry(card):
+    """Field B (T) and layers (dicts of LAYER_FIELDS, numbers as floats) of the TrackCovariance module of the card"""
+    module = next((m for m in card.modules.values() if m.cls == "TrackCovariance"), None)
+    if module is None:
+        raise ValueError("Card has no TrackCovariance module")
+    bz = module.param("Bz")
+    if bz.startswith("$"):
+        bz = get_variable(card, bz[1:])
+    layers = []
+    for line in module.body.splitlines():
+        tokens = line.split()
+        if len(tokens) == len(LAYER_FIELDS) and tokens[0] in ("1", "2"):
+            layers.append({field: token if field == "label" else float(token) for field, token in zip(LAYER_FIELDS, tokens)})
+    return float(bz), layers
+
+def set_variable(card, name, value):
+    """Set a top-level variable of the card (e.g. set B 2.0)"""
+    for s in card.statements:
+        if type(s) is Statement and re.match(rf"\s*set\s+{name}\s", s.text):
+            s.text = re.sub(rf"(\s*set\s+{name}\s+)\S+", lambda m: f"{m.group(1)}{format_value(value)}", s.text, count=1)
+            return
+    raise ValueError(f"Card has no variable {name}")
+
+def set_layer(card, label, index, field, value):
+    """
+    Set a field (see LAYER_FIELDS) of a tracker layer: the index-th layer with the given label
+    (e.g. VTXLOW[0] is the innermost vertex layer), or the index-th layer of the geometry for label LAYER
+    """
+    column = LAYER_FIELDS.index(field)
+    found = False
+    for module in card.modules.values():
+        if module.cls != "TrackCovariance":
+            continue
+        lines = module.body.splitlines(keepends=True)
+        count = 0
+        for i, line in enumerate(lines):
+            tokens = line.split()
+            if len(tokens) != len(LAYER_FIELDS) or tokens[0] not in ("1", "2"):
+                continue
+            if label in ("LAYER", tokens[1]):
+                if count == index:
+                    tokens[column] = format_value(value)
+                    lines[i] = line[:len(line) - len(line.lstrip())] + " ".join(tokens) + "\n"
+                    found = True
+                count += 1
+        module.body = "".join(lines)
+    if not found:
+        raise ValueError(f"Card has no layer {label}[{index}]")
+
+def set_parameter(card, key, value):
+    """
+    Set a parameter of the card:
+    LABEL[i].field: field of a tracker layer (e.g. VTXLOW[0].r, LAYER[1].X0), see set_layer
+    Module.Key: parameter of a module (e.g. TrackSmearing.NMinHits)
+    NAME: top-level variable (e.g. B)
+    """
+    m = re.fullmatch(r"(\w+)\[(\d+)\]\.(\w+)", key)
+    if m:
+        return set_layer(card, m.group(1), int(m.group(2)), m.group(3), value)
+    m = re.fullmatch(r"(\w+)\.(\w+)", key)
+    if m:
+        module = card.modules.get(m.group(1))
+        if module is None or not module.set_param(m.group(2), format_value(value)):
+            raise ValueError(f"Card has no parameter {key}")
+        return
+    set_variable(card, key, value)
+
+def sweep_variants(spec):
+    """Grid of parameter values of a sweep spec, as (variant name, {parameter: value})"""
+    keys = list(spec["parameters"])
+    variants = []
+    for values in itertools.product(*(spec["parameters"][key] for key in keys)):
+        suffix = "_".join(re.sub(r"[^\w.]", "", key) + format_value(value) for key, value in zip(keys, values))
+        variants.append((f"{spec.get('name', spec['template'])}_{suffix}", dict(zip(keys, values))))
+    return variants
+
+def write_sweep(spec_path, cards_dir, output_dir):
+    """
+    Write the card variants of a sweep spec (JSON) to output_dir, returns {variant name: card path}.
+    The spec gives the template card (name in cards_dir, or path) and a grid of parameter values, e.g.
+    {"template": "IDEA_baseline", "parameters": {"B": [2, 3], "VTXLOW[0].r": [0.0117, 0.0137]}}
+    """
+    with open(spec_path) as f:
+        spec = json.load(f)
+    template = spec["template"]
+    template_path = template if template.endswith(".tcl") else f"{cards_dir}/{template}.tcl"
+    spec.setdefault("name", os.path.basename(template_path).replace(".tcl", ""))
+    with open(template_path) as f:
+        template_text = f.read()
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths, index = {}, {}
+    for name, parameters in sweep_variants(spec):
+        card = parse_card(template_text)
+        for key, value in parameters.items():
+            set_parameter(card, key, value)
+        paths[name] = f"{output_dir}/{name}.tcl"
+        index[name] = parameters
+        with open(paths[name], "w") as f:
+            f.write(card.to_text())
+    with open(f"{output_dir}/sweep.json", "w") as f:
+        json.dump(index, f, indent=4)
+    return paths
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, help="Input Delphes card")
+    parser.add_argument("-o", "--output", type=str, help="Output Delphes card (output directory with --sweep)", required=True)
+    parser.add_argument("--tracking", help="Derive a tracking-only card, with only the modules needed for the resolution analysis", action='store_true')
+    parser.add_argument("--sweep", type=str, help="Write the card variants of a sweep spec (JSON)")
+    parser.add_argument("--set", type=str, nargs='*', help="Set parameters of the card, e.g. B=3 VTXLOW[0].r=0.0117", default=[])
+    args = parser.parse_args()
+
+    if args.sweep:
+        for name, path in write_sweep(args.sweep, "delphes_cards", args.output).items():
+            print(f"Generated {path}")
+        raise SystemExit
+    if args.input is None:
+        parser.error("--input is required without --sweep")
+
+    with open(args.input) as f:
+        card = parse_card(f.read())
+    for item in args.set:
+        key, value = item.split("=")
+        set_parameter(card, key, value)
+    if args.tracking:
+        card = tracking_card(card)
+    with open(args.output, "w") as f:
+        f.write(card.to_text())
@@ -5,8 +5,11 @@ import shutil
 import argparse
 import math
 import json
+import glob
 import numpy as np
 
+import results
+
 import ROOT
 ROOT.gROOT.SetBatch(True)
 ROOT.gStyle.SetOptStat(0)
@@ -16,6 +19,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--card1", type=str, help="First card", default="IDEA_baseline")
 parser.add_argument("--card2", type=str, help="Second card", default="IDEA_baseline_3T")
 parser.add_argument("--output", type=str, help="Output", default="output")
+parser.add_argument("--particle", type=str, help="Particle name of the samples", default="mu_minus")
+parser.add_argument("--cards", type=str, nargs='*', help="Compare these cards with --reference (without names: all cards with results in the output directory), instead of --card1 and --card2", default=None)
+parser.add_argument("--reference", type=str, help="Reference card of --cards (default: the first one)", default=None)
 args = parser.parse_args()
 
 current_dir = os.path.abspath(os.getcwd())
@@ -54,6 +60,26 @@ def ratio_tgraphs(g1, g2, name="ratio_graph"):
 
     return ratio_graph, miny, maxy
 
+def graphs_from_results(plots_path, card, hist_type):
+    """Resolution vs. cos(theta) graphs of a card, one per momentum, read from its results table"""
+    table = results.read_table(results.results_path(plots_path))
+    mask = results.select(table, card=card, particle=args.particle, observable=hist_type)
+    colors = [ROOT.kBlack, ROOT.kRed, ROOT.kBlue, ROOT.kGreen+2, ROOT.kMagenta+1]
+    graphs = []
+    for i, mom in enumerate(np.unique(table["p"][mask])):
+        sel = np.flatnonzero(mask & (table["p"] == mom))
+        sel = sel[np.argsort(table["theta"][sel])]
+        x = np.cos(np.radians(table["theta"][sel])).astype('d')
+        y = table["res_quantile"][sel].astype('d')
+        g = ROOT.TGraph(len(sel), x, y)
+        g.SetName(f"mom{mom:g}")
+        g.SetTitle(f"p = {mom:g} GeV")
+        g.SetLineColor(colors[i % len(colors)])
+        g.SetLineWidth(2)
+        g.SetMarkerColor(colors[i % len(colors)])
+        graphs.append(g)
+    return graphs
+
 def make_plot(card1, card2, output, hist_type):
 
     output_base_dir = f"{current_dir}/{output}"
@@ -169,11 +195,9 @@ def make_plot(card1, card2, output, hist_type):
     #legend.SetHeader(f"Delphes {delphes_card_name}")
     graphs_ratios = []
 
-    # open graphs of the first card
-    fIn = ROOT.TFile(f"{plots_path_card1}/{hist_type}_vs_theta.root")
+    # graphs of the first card
     graphs_card1 = []
-    for ig, key in enumerate(fIn.GetListOfKeys()):
-        obj = key.ReadObj()
+    for ig, obj in enumerate(graphs_from_results(plots_path_card1, card1, hist_type)):
         if obj.InheritsFrom("TGraph"):
             obj.SetMarkerStyle(20)
             obj.SetMarkerSize(1.2)
@@ -188,11 +212,9 @@ def make_plot(card1, card2, output, hist_type):
             if ymax_g > ymax:
                 ymax = ymax_g
 
-    # open graphs of the second card
-    fIn = ROOT.TFile(f"{plots_path_card2}/{hist_type}_vs_theta.root")
+    # graphs of the second card
     graphs_card2 = []
-    for ig, key in enumerate(fIn.GetListOfKeys()):
-        obj = key.ReadObj()
+    for ig, obj in enumerate(graphs_from_results(plots_path_card2, card2, hist_type)):
         if obj.InheritsFrom("TGraph"):
             print(obj.GetName())
             obj.SetMarkerStyle(22)
@@ -254,8 +276,146 @@ def make_plot(card1, card2, output, hist_type):
     c.SaveAs(f"{output}/{card1}_{card2}_{hist_type}_vs_theta.pdf")
 
 
+observables = ["d0", "z0", "p", "k"]
+
+def load_results(output_base_dir, cards):
+    """Results tables of the cards concatenated into one columnar table"""
+    paths = [results.results_path(f"{output_base_dir}/plots_{card}/") for card in cards]
+    missing = [card for card, path in zip(cards, paths) if not os.path.exists(path)]
+    if missing:
+        raise SystemExit(f"ERROR: no results for card(s) {', '.join(missing)} (no plots_<card>/{results.RESULTS_FILE}, run the plots step first)")
+    tables = [results.read_table(path) for path in paths]
+    columns = results.KEYS + ["res_quantile", "res_quantile_err"]
+    return {key: np.concatenate([t.get(key, np.full(len(t["card"]), np.nan)) for t in tables]) for key in columns}
+
+def result_arrays(table, cards):
+    """
+    Quantile widths and their uncertainties of all cards as arrays of shape (card, observable, p, theta), NaN
+    where a card has no result, with the momenta and thetas of all cards
+    """
+    mask = (table["particle"] == args.particle) & np.isin(table["card"], cards) & np.isin(table["observable"], observables)
+    moms, imom = np.unique(table["p"][mask], return_inverse=True)
+    thetas, itheta = np.unique(table["theta"][mask], return_inverse=True)
+    card_order, observable_order = np.argsort(cards), np.argsort(observables)
+    icard = card_order[np.searchsorted(cards, table["card"][mask], sorter=card_order)]
+    iobservable = observable_order[np.searchsorted(observables, table["observable"][mask], sorter=observable_order)]
+
+    shape = (len(cards), len(observables), len(moms), len(thetas))
+    res, err = np.full(shape, np.nan), np.full(shape, np.nan)
+    res[icard, iobservable, imom, itheta] = table["res_quantile"][mask]
+    err[icard, iobservable, imom, itheta] = table["res_quantile_err"][mask]
+    return res, err, moms, thetas
+
+def compare_cards(output, cards, reference):
+    """
+    Ratios of the quantile widths of all cards to those of the reference card, for all observables, momenta and
+    thetas at once. Stored as a columnar table in compare_<reference>.json, and drawn into compare_<reference>.pdf,
+    one page per observable and momentum with the resolutions on top and the ratios below
+    """
+    output_base_dir = f"{current_dir}/{output}"
+    res, err, moms, thetas = result_arrays(load_results(output_base_dir, cards), np.asarray(cards))
+    ref = cards.index(reference)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = res/res[ref]
+        # relative uncertainties of the two cards added in quadrature, the reference is exactly 1
+        ratio_err = np.abs(ratio)*np.hypot(err/res, err[ref]/res[ref])
+    ratio_err[ref] = 0.
+
+    grid = np.meshgrid(np.arange(len(cards)), np.arange(len(observables)), moms, thetas, indexing='ij')
+    table = {"card": np.asarray(cards)[grid[0]].ravel(), "observable": np.asarray(observables)[grid[1]].ravel(), "p": grid[2].ravel(), "theta": grid[3].ravel(),
+             "res_quantile": res.ravel(), "ratio": ratio.ravel(), "ratio_err": ratio_err.ravel()}
+    keep = np.isfinite(table["res_quantile"])
+    results.write_table(f"{output}/compare_{reference}.json", {key: values[keep] for key, values in table.items()})
+
+    # one canvas for all pages
+    x = np.cos(np.radians(thetas))
+    colors = [ROOT.kBlack, ROOT.kRed, ROOT.kBlue, ROOT.kGreen+2, ROOT.kMagenta+1, ROOT.kOrange+7, ROOT.kCyan+2, ROOT.kViolet-1, ROOT.kGray+1, ROOT.kPink+9]
+    hist_types = {"d0": "d_{0} resolution (#mum)", "z0": "z_{0} resolution (#mum)", "p": "Momentum resolution (%)", "k": "Curvature resolution (%)"}
+    pdf = f"{output}/compare_{reference}.pdf"
+    c = ROOT.TCanvas("c", "c", 800, 800)
+    c.Print(f"{pdf}[")
+    for io, hist_type in enumerate(observables):
+        for im, mom in enumerate(moms):
+            c.Clear()
+            pad1 = ROOT.TPad("p1", "p1", 0, 0.35, 1, 1)
+            pad2 = ROOT.TPad("p2", "p2", 0, 0.0, 1, 0.33)
+            pad1.SetBottomMargin(0.025)
+            pad1.SetLeftMargin(0.18)
+            pad1.SetRightMargin(0.05)
+            pad1.SetLogy()
+            pad1.SetGrid()
+            pad2.SetTopMargin(0.0)
+            pad2.SetBottomMargin(0.37)
+            pad2.SetLeftMargin(0.18)
+            pad2.SetRightMargin(0.05)
+            pad2.SetGrid()
+
+            values, ratios, errors = res[:, io, im], ratio[:, io, im], ratio_err[:, io, im]
+            if not np.isfinite(values).any():
+                continue
+            c.cd()
+            pad1.Draw()
+            pad1.cd()
+            frameT = pad1.DrawFrame(0, 10**np.floor(np.log10(np.nanmin(values))), 1, 10**np.ceil(np.log10(np.nanmax(values))), f";;{hist_types[hist_type]}")
+            frameT.GetXaxis().SetLabelSize(0)
+            legend = ROOT.TLegend(0.22, 0.5, 0.55, 0.9)
+            legend.SetBorderSize(0)
+            legend.SetFillStyle(0)
+            legend.SetTextSize(0.03)
+            legend.SetHeader(f"p = {mom:g} GeV, ratio to {reference}")
+            graphs = []
+            for ic, card in enumerate(cards):
+                valid = np.isfinite(values[ic])
+                g = ROOT.TGraph(int(valid.sum()), x[valid].astype('d'), values[ic][valid].astype('d'))
+                valid_ratio = valid & np.isfinite(ratios[ic])
+                r = ROOT.TGraphErrors(int(valid_ratio.sum()), x[valid_ratio].astype('d'), ratios[ic][valid_ratio].astype('d'),
+                                      np.zeros(int(valid_ratio.sum())), np.nan_to_num(errors[ic][valid_ratio]).astype('d'))
+                for graph in (g, r):
+                    graph.SetLineColor(colors[ic % len(colors)])
+                    graph.SetMarkerColor(colors[ic % len(colors)])
+                    graph.SetLineWidth(2)
+                    graph.SetMarkerStyle(20 + ic//len(colors))
+                g.Draw("LP")
+                legend.AddEntry(g, card, "LP")
+                graphs += [g, r]
+            legend.Draw()
+
+            # no ratios if the reference has no results at this momentum
+            finite = np.isfinite(ratios)
+            if finite.any():
+                c.cd()
+                pad2.Draw()
+                pad2.cd()
+                margin = np.nan_to_num(errors[finite])
+                frameB = pad2.DrawFrame(0, 0.95*(ratios[finite] - margin).min(), 1, 1.05*(ratios[finite] + margin).max(), ";cos(#theta);Ratio")
+                frameB.GetXaxis().SetTitleSize(0.12)
+                frameB.GetXaxis().SetLabelSize(0.1)
+                frameB.GetYaxis().SetTitleSize(0.1)
+                frameB.GetYaxis().SetTitleOffset(0.6)
+                frameB.GetYaxis().SetLabelSize(0.08)
+                frameB.GetYaxis().SetNdivisions(505)
+                for r in graphs[1::2]:
+                    r.Draw("LP")
+            else:
+                print(f"No {reference} results for {hist_type} at p = {mom:g} GeV, page drawn without ratios")
+
+            c.Print(pdf, f"Title:{hist_type} p={mom:g}")
+    c.Print(f"{pdf}]")
+    print(f"Compared {len(cards)} cards with {reference}: {output}/compare_{reference}.json, {pdf}")
+
+
 if __name__ == "__main__":
 
+    if args.cards is not None:
+        cards = args.cards or sorted(os.path.basename(os.path.dirname(path))[len("plots_"):] for path in glob.glob(f"{current_dir}/{args.output}/plots_*/{results.RESULTS_FILE}"))
+        if not cards:
+            parser.error(f"--cards: no cards given and no results in {args.output}/plots_*/{results.RESULTS_FILE}")
+        reference = args.reference or cards[0]
+        if reference not in cards:
+            cards.insert(0, reference)
+        compare_cards(args.output, cards, reference)
+        raise SystemExit(0)
+
     card1 = args.card1
     card2 = args.card2
     output = args.output
@@ -0,0 +1,157 @@
+import argparse
+import math
+import os
+
+import numpy as np
+
+import cards
+import results
+
+# Analytic resolutions from the DetectorGeometry of the TrackCovariance module of a card: a linearised
+# least-squares (Fisher matrix) helix fit to the layer measurements, including multiple scattering in the layer
+# material, evaluated for the whole theta x p grid at once. Results go into a results table for the card
+# <card>_fastsim, in the same format as the plots step, so the summary plots and compare.py can show them.
+# Energy loss, hit efficiencies and pattern recognition are not modelled.
+
+FASTSIM_SUFFIX = "_fastsim"
+masses = {"mu_minus": 0.10566, "mu_plus": 0.10566, "e_minus": 0.000511, "e_plus": 0.000511, "pi_minus": 0.13957, "pi_plus": 0.13957,
+          "K_minus": 0.49368, "K_plus": 0.49368, "proton": 0.93827, "antiproton": 0.93827}
+
+# track parameters: d0 (m), phi0, curvature kappa (1/m), z0 (m), cot(theta), and their finite difference steps
+PARAMETERS = ["d0", "phi0", "kappa", "z0", "cot"]
+
+
+def layer_arrays(layers):
+    """Columns of the layers as arrays. For disks (type 2), zmin/zmax are the radial extent and r the z position"""
+    return {field: np.array([layer[field] for layer in layers]) for field in cards.LAYER_FIELDS if field != "label"}
+
+def crossings(params, geo, s_start):
+    """
+    Crossings of the helices with the layers: transverse path length s from the point of closest approach,
+    the two measured coordinates (r*phi and z for barrel layers, r*phi and r for disks) and whether the layer is crossed.
+    params: (5, G, 1) track parameters, geo: layer arrays (L,), returns (G, L) arrays
+    """
+    d0, phi0, kappa, z0, cot = params
+    barrel = geo["type"] == 1
+
+    # barrel: solve r(s) = R, r(s)^2 = d0^2 + 4(1 + kappa d0)/kappa^2 sin^2(kappa s/2)
+    arg = 0.5*kappa*np.sqrt(np.clip((geo["r"]**2 - d0**2)/(1 + kappa*d0), 0, None))
+    s_barrel = 2/kappa*np.arcsin(np.clip(arg, -1, 1))
+    # disk at z = r column
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s_disk = (geo["r"] - z0)/cot
+    s = np.where(barrel, s_barrel, s_disk)
+
+    x = -d0*np.sin(phi0) + (np.sin(phi0 + kappa*s) - np.sin(phi0))/kappa
+    y = d0*np.cos(phi0) - (np.cos(phi0 + kappa*s) - np.cos(phi0))/kappa
+    z = z0 + s*cot
+    r = np.hypot(x, y)
+    rphi = np.where(barrel, geo["r"], r)*np.arctan2(y, x)
+
+    valid = (s > s_start) & np.isfinite(s) & (kappa*s < math.pi)
+    valid &= np.where(barrel, (arg <= 1) & (z >= geo["zmin"]) & (z <= geo["zmax"]), (r >= geo["zmin"]) & (r <= geo["zmax"]))
+    return s, rphi, np.where(barrel, z, r), valid
+
+def resolutions(geometry, thetas, moms, mass=0.10566, R0=0., step=1e-7):
+    """
+    Covariance of the track parameters for all (theta, p) combinations.
+    geometry: (Bz, layers) as returned by cards.detector_geometry, thetas in degrees, moms in GeV, R0: production radius in m.
+    Returns theta, p (grid, flattened) and the covariance matrices (G, 5, 5)
+    """
+    bz, layers = geometry
+    geo = layer_arrays(layers)
+    theta, p = (a.ravel() for a in np.meshgrid(np.radians(thetas), np.asarray(moms, dtype='d'), indexing='ij'))
+    G = len(theta)
+    sin, cos = np.sin(theta), np.cos(theta)
+    pt = p*sin
+    nominal = np.stack([np.zeros(G), np.zeros(G), 0.299792458*bz/pt, np.zeros(G), cos/sin])[:, :, None]
+    barrel = geo["type"] == 1
+
+    # Jacobian of the measured coordinates by central differences: (G, L, 5) for both coordinates
+    s, a, b, valid = crossings(nominal, geo, R0)
+    da, db = np.zeros(a.shape + (5,)), np.zeros(b.shape + (5,))
+    for j in range(5):
+        h = step*(np.abs(nominal[2]) if PARAMETERS[j] == "kappa" else 1.)
+        shift = np.zeros_like(nominal)
+        shift[j] = h
+        _, a_up, b_up, _ = crossings(nominal + shift, geo, R0)
+        _, a_down, b_down, _ = crossings(nominal - shift, geo, R0)
+        da[..., j] = (a_up - a_down)/(2*h)
+        db[..., j] = (b_up - b_down)/(2*h)
+
+    # measurements: upper side of measuring layers, and lower side of two-sided ones, u = cos(stereo) a + sin(stereo) b
+    measuring = geo["flag"] == 1
+    rows = [(i, geo["th_up"][i], geo["reso_up"][i]) for i in np.flatnonzero(measuring & (geo["n_meas"] >= 1))]
+    rows += [(i, geo["th_down"][i], geo["reso_down"][i]) for i in np.flatnonzero(measuring & (geo["n_meas"] >= 2))]
+    index = np.array([row[0] for row in rows])
+    stereo = np.array([row[1] for row in rows])
+    sigma = np.array([row[2] for row in rows])
+    ok = valid[:, index] & (sigma > 0) # (G, M)
+    J = np.cos(stereo)[None, :, None]*da[:, index] + np.sin(stereo)[None, :, None]*db[:, index]
+    J = np.where(ok[..., None], J, 0.)
+
+    # multiple scattering: kinks at every crossed layer with material, in the bending plane (alpha) and
+    # in the plane of the track and the z axis (beta), displace later measurements by the kink times the distance
+    beta_rel = p/np.sqrt(p**2 + mass**2)
+    path_factor = np.where(barrel[None, :], 1/sin[:, None], 1/np.abs(cos[:, None]))
+    x0 = np.where(valid & (geo["X0"] > 0), geo["w"]/np.where(geo["X0"] > 0, geo["X0"], 1.)*path_factor, 0.) # (G, K)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta0 = np.where(x0 > 0, 0.0136/(beta_rel[:, None]*p[:, None])*np.sqrt(x0)*(1 + 0.038*np.log(x0)), 0.)
+    distance = np.clip(s[:, index][:, :, None] - s[:, None, :], 0, None)/sin[:, None, None] # (G, M, K) 3D distance
+    fb = np.where(barrel[index][None, :], 1/sin[:, None], 1/np.abs(cos[:, None])) # z (r) shift per unit displacement for barrels (disks)
+    g_alpha = np.cos(stereo)[None, :, None]*distance*ok[..., None]
+    g_beta = (np.sin(stereo)[None, :]*fb)[..., None]*distance*ok[..., None]
+    V = np.einsum('gmk,gk,gnk->gmn', g_alpha, theta0**2, g_alpha) + np.einsum('gmk,gk,gnk->gmn', g_beta, theta0**2, g_beta)
+    V += np.eye(len(rows))[None]*np.where(ok, sigma**2, 1.)[:, :, None]
+
+    # Fisher matrix of the fit and covariance of the track parameters
+    fisher = np.einsum('gmi,gmj->gij', J, np.linalg.solve(V, J))
+    return theta, p, np.linalg.inv(fisher)
+
+def resolution_rows(card_name, particle, geometry, thetas, moms, R0=0.):
+    """Rows of a results table: d0 and z0 in um, relative pT and absolute 1/pT (GeV^-1) resolution as in analysis.py"""
+    bz = geometry[0]
+    theta, p, cov = resolutions(geometry, thetas, moms, masses.get(particle, 0.10566), R0)
+    kappa = 0.299792458*bz/(p*np.sin(theta))
+    widths = {
+        "d0": np.sqrt(cov[:, 0, 0])*1e6,
+        "z0": np.sqrt(cov[:, 3, 3])*1e6,
+        "p": np.sqrt(cov[:, 2, 2])/kappa,
+        "k": np.sqrt(cov[:, 2, 2])/(0.299792458*bz),
+    }
+    rows = []
+    for i in range(len(theta)):
+        for hist_type, width in widths.items():
+            value = float(width[i])
+            rows.append({"card": card_name, "particle": particle, "theta": float(np.round(np.degrees(theta[i]), 6)), "p": float(p[i]), "observable": hist_type,
+                         "rms": value, "rms_err": 0., "sigma": value, "sigma_err": 0., "res_quantile": value, "res_quantile_err": 0.})
+    return rows
+
+def fastsim_card(delphes_card, card_name, plots_dir, particle, thetas, moms, R0=0.):
+    """Fast simulation of a card, stored in the results table of plots_dir under card <card_name>_fastsim"""
+    with open(delphes_card) as f:
+        geometry = cards.detector_geometry(cards.parse_card(f.read()))
+    os.makedirs(plots_dir, exist_ok=True)
+    rows = resolution_rows(f"{card_name}{FASTSIM_SUFFIX}", particle, geometry, thetas, moms, R0)
+    results.update_table(results.results_path(plots_dir), rows)
+    return rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delphes_card", type=str, nargs='+', help="Delphes card name(s) (as in delphes_cards directory) or path(s)", default=["IDEA_baseline"])
+    parser.add_argument("--output_dir", type=str, help="Output directory, results go to plots_<card>_fastsim", default="output")
+    parser.add_argument("--particle", type=str, help="Particle name", default="mu_minus")
+    parser.add_argument("--theta", type=float, nargs='+', help="Polar angles (degrees)", default=[10, 20, 30, 40, 50, 60, 70, 80, 90])
+    parser.add_argument("--mom", type=float, nargs='+', help="Momenta (GeV)", default=[5, 10, 50, 100])
+    parser.add_argument("--R0", type=float, help="Transverse production radius (mm)", default=20)
+    args = parser.parse_args()
+
+    for card in args.delphes_card:
+        path = card if card.endswith(".tcl") else f"delphes_cards/{card}.tcl"
+        card_name = os.path.basename(path).replace(".tcl", "")
+        plots_dir = f"{args.output_dir}/plots_{card_name}{FASTSIM_SUFFIX}"
+        rows = fastsim_card(path, card_name, plots_dir, args.particle, args.theta, args.mom, args.R0*1e-3)
+        for row in rows:
+            print(f"{row['card']} theta={row['theta']:g} p={row['p']:g} {row['observable']}: {row['res_quantile']:.4g}")
@@ -1,25 +1,11 @@
+#include <algorithm>
+#include <array>
+#include <cmath>
+#include <limits>
+#include "ROOT/RDataFrame.hxx"
 
-namespace FCCAnalyses {
 
-Vec_f leptonResolution(Vec_rp leptons, Vec_i recind, Vec_i mcind, Vec_rp reco, Vec_mc mc, int mode=0) {
-    Vec_f result;
-    result.reserve(leptons.size());
-    for(int i = 0; i < leptons.size(); ++i) {
-        TLorentzVector reco_;
-        reco_.SetXYZM(leptons[i].momentum.x, leptons[i].momentum.y, leptons[i].momentum.z, leptons[i].mass);
-        int track_index = leptons[i].tracks_begin;
-        int mc_index = FCCAnalyses::ReconstructedParticle2MC::getTrack2MC_index(track_index, recind, mcind, reco);
-        if(mc_index >= 0 && mc_index < (int)mc.size()) {
-            TLorentzVector mc_;
-            mc_.SetXYZM(mc.at(mc_index).momentum.x, mc.at(mc_index).momentum.y, mc.at(mc_index).momentum.z, mc.at(mc_index).mass);
-            if(mode == 0) result.push_back((reco_.Pt()-mc_.Pt())/mc_.Pt()); // momentum resolution
-            else if(mode == 1) result.push_back((reco_.Theta()-mc_.Theta())/mc_.Theta()); // theta resolution
-            else if(mode == 2) result.push_back((reco_.Phi()-mc_.Phi())/mc_.Phi()); // phi resolution
-            else if(mode == 3) result.push_back(1./reco_.Pt() - 1./mc_.Pt()); // resolution on curvature k=1/p
-        }
-    }
-    return result;
-}
+namespace FCCAnalyses {
 
 Vec_f get_D0_gen(Vec_rp leptons, Vec_i recind, Vec_i mcind, Vec_rp reco, Vec_mc mc, int mode=0) {
     Vec_f result;
@@ -74,116 +60,196 @@ Vec_f get_gen_vtx(Vec_mc mc) {
     return result;
 }
 
-static inline int sgn(double x) {
-  return (x > 0.0) - (x < 0.0);   // returns +1, 0, or -1
+// Signed d0 and z0 (mm) of the helix of a particle at its point of closest approach to the z axis, with the
+// conventions of the former calculate_d0_z0_gen. qB is charge times Bz (T); without a curvature the vertex is used
+inline void helixPCA(double x, double y, double z, double px, double py, double pz, double qB, float& d0, float& z0) {
+    const double pT = std::hypot(px, py);
+    if (pT < 1e-9 || std::abs(qB) < 1e-12) {
+        d0 = 0.f;
+        z0 = z;
+        return;
+    }
+    // circle of radius R (mm) around c, on the side of the momentum given by s = sign(qB)
+    const double s = qB > 0 ? 1. : -1.;
+    const double R = pT/(0.3*std::abs(qB))*1000.;
+    const double xc = x - s*R*py/pT;
+    const double yc = y + s*R*px/pT;
+    d0 = s*(R - std::hypot(xc, yc));
+    // turning angle (in [0, 2pi)) from the PCA to the vertex along the direction of motion: z0 is extrapolated
+    // backwards from the vertex to the PCA, as calculate_d0_z0_gen did, hence the minus sign below
+    const double twopi = 2.*M_PI;
+    double dphi = std::fmod(-s*(std::atan2(-yc, -xc) - std::atan2(y - yc, x - xc)), twopi);
+    if (dphi < 0.) dphi += twopi;
+    z0 = z - s*R*dphi*pz/pT;
 }
 
-Vec_f calculate_d0_z0_gen(Vec_mc mc, Vec_f Bz) {
+// Helix d0 and z0 of the generator particles matched to the leptons (index from leptonMCIndex), NaN for unmatched
+// leptons and neutral particles. Only the matched particles are extrapolated, and the results are filled in place
+struct GenHelix {
+    Vec_f d0;
+    Vec_f z0;
+};
+
+inline GenHelix genHelixMatched(const Vec_mc& mc, const Vec_i& index, const Vec_f& Bz) {
+    const size_t n = index.size();
+    GenHelix result{Vec_f(n), Vec_f(n)};
+    const double B = Bz.empty() ? 0. : Bz[0];
+    for (size_t i = 0; i < n; i++) {
+        if (index[i] < 0 || index[i] >= (int)mc.size() || mc[index[i]].charge == 0) {
+            result.d0[i] = result.z0[i] = std::numeric_limits<float>::quiet_NaN();
+            continue;
+        }
+        const auto& p = mc[index[i]];
+        helixPCA(p.vertex.x, p.vertex.y, p.vertex.z, p.momentum.x, p.momentum.y, p.momentum.z, p.charge*B, result.d0[i], result.z0[i]);
+    }
+    return result;
+}
 
-    //cout << "calculate_d0_z0_gen **************************************************" << endl;
-    Vec_f result;
-    float Bz_T = Bz[0];
-
-    auto mcp = mc[2];
-
-    double x_mm = mcp.vertex.x;
-    double y_mm = mcp.vertex.y;
-    double z_mm = mcp.vertex.z;
-    double px_GeV = mcp.momentum.x;
-    double py_GeV = mcp.momentum.y;
-    double pz_GeV = mcp.momentum.z;
-    int q = mcp.charge;
-
-    // Position vector
-    TVector3 vtx(x_mm, y_mm, z_mm);
-
-    // Momentum vector
-    TVector3 p(px_GeV, py_GeV, pz_GeV);
-
-    //cout << " PHI " << vtx.Phi() <<  "  " << p.Phi() << endl;
-    //cout << " VTX " << x_mm <<  "  " << y_mm <<  "  " << z_mm << " " << std::sqrt(x_mm*x_mm + y_mm*y_mm) << endl;
-    if(vtx.Phi() > -M_PI && vtx.Phi() < -0.5*M_PI) cout << "THIRD QUAD" << endl;
-
-    double xref_mm=0.0;
-    double yref_mm=0.0;
-    double zref_mm=0.0;
-           
-    //cout << std::sqrt(x_mm*x_mm + y_mm*y_mm) << endl;
-    const double pT = std::hypot(px_GeV, py_GeV);
-    // straight-line fallback if pT~0 or B~0
-    if (pT < 1e-9 || std::abs(Bz_T) < 1e-12) {
-        // PCA to ref in transverse plane for a line is more work; for your muons pT>0 and B!=0.
-        result.push_back(0.0);
-        result.push_back(z_mm - zref_mm);
-        return result;
+// Reconstructed particles with a track: the charged particles of all species, for guns of several species
+Vec_rp trackParticles(const Vec_rp& reco) {
+    Vec_rp result;
+    result.reserve(reco.size());
+    for (const auto& p : reco) {
+        if (p.tracks_begin < p.tracks_end) result.push_back(p);
     }
+    return result;
+}
 
-    const double tx = px_GeV / pT;
-    const double ty = py_GeV / pT;
-
-    // curvature sign s = sign(q*Bz)
-    const double s = sgn(double(q) * Bz_T);
-
-    // radius in mm: R = (pT / (0.3|q|B)) * 1000
-    const double R_mm = (pT / (0.3 * std::abs(double(q) * Bz_T))) * 1000.0;
-
-    // center of circle in xy
-    const double xc = x_mm + s * R_mm * (-ty);
-    const double yc = y_mm + s * R_mm * ( tx);
-
-    // vector center -> ref
-    const double dxC = xc - xref_mm;
-    const double dyC = yc - yref_mm;
-    const double Dc  = std::hypot(dxC, dyC);
-
-    // PCA point on circle closest to ref
-    const double xP = xc - R_mm * (dxC / Dc);
-    const double yP = yc - R_mm * (dyC / Dc);
-
-    // unsigned d0 is distance ref -> PCA
-    const double d0_abs = std::hypot(xP - xref_mm, yP - yref_mm);
-
-    // tangent at PCA to get signed d0
-    const double ux = (xP - xc) / R_mm;
-    const double uy = (yP - yc) / R_mm;
-    const double tpx = s * (-uy);
-    const double tpy = s * ( ux);
-
-    const double rx = (xP - xref_mm);
-    const double ry = (yP - yref_mm);
-    const double cross_z = tpx*ry - tpy*rx; // (t x r)_z
-    double d0 = - sgn(cross_z) * d0_abs; // should be opposite sign to be correct -- what is the convention in Delphes?
-
-    // compute z at PCA via phase advance along circle
-    double phi0 = std::atan2(y_mm - yc, x_mm - xc);
-    double phi1 = std::atan2(yP  - yc, xP  - xc);
-    double dphi = phi1 - phi0;
-
-    // enforce motion direction: rot = -s
-    const double rot = -s;
-    // shift by 2pi so that rot*dphi >= 0, picking the nearest equivalent
-    const double twopi = 2.0*M_PI;
-    while (rot*dphi < 0.0) {
-        dphi += (rot > 0 ? +twopi : -twopi);
+// Index of the generator particle matched to each lepton track, -1 if there is none
+Vec_i leptonMCIndex(const Vec_rp& leptons, const Vec_i& recind, const Vec_i& mcind, const Vec_rp& reco) {
+    Vec_i result(leptons.size());
+    for (size_t i = 0; i < leptons.size(); ++i) {
+        result[i] = FCCAnalyses::ReconstructedParticle2MC::getTrack2MC_index(leptons[i].tracks_begin, recind, mcind, reco);
     }
-    // keep within [-2pi,2pi] (optional safety)
-    if (dphi >  twopi) dphi -= twopi;
-    if (dphi < -twopi) dphi += twopi;
+    return result;
+}
 
-    const double dz = R_mm * dphi * (pz_GeV / pT);
-    const double zP = z_mm + dz;
+// Values of a per-generator-particle column for the given indices, NaN where there is no match
+Vec_f takeGen(const Vec_f& values, const Vec_i& index) {
+    Vec_f result(index.size());
+    for (size_t i = 0; i < index.size(); ++i) {
+        result[i] = index[i] >= 0 && index[i] < (int)values.size() ? values[index[i]] : std::numeric_limits<float>::quiet_NaN();
+    }
+    return result;
+}
 
-    const double z0 = zP - zref_mm;
+// Residuals of the leptons with respect to their matched generator particle, for all observables in one pass over the
+// leptons (unmatched ones are skipped): relative pT, theta and phi, and 1/pT (GeV^-1), and the PDG id of the matched
+// generator particle
+struct LeptonResiduals {
+    Vec_f p;
+    Vec_f theta;
+    Vec_f phi;
+    Vec_f k;
+    Vec_f pdg;
+};
+
+LeptonResiduals leptonResiduals(const Vec_rp& leptons, const Vec_i& mc_index, const Vec_mc& mc) {
+    LeptonResiduals result;
+    for (auto v : {&result.p, &result.theta, &result.phi, &result.k, &result.pdg}) v->reserve(leptons.size());
+    for (size_t i = 0; i < leptons.size(); ++i) {
+        const int j = mc_index[i];
+        if (j < 0 || j >= (int)mc.size()) continue;
+        const auto& reco = leptons[i].momentum;
+        const auto& gen = mc[j].momentum;
+        const double reco_pt = std::hypot(reco.x, reco.y), gen_pt = std::hypot(gen.x, gen.y);
+        // theta and phi as in TLorentzVector
+        const double reco_theta = reco_pt == 0. && reco.z == 0. ? 0. : std::atan2(reco_pt, reco.z);
+        const double gen_theta = gen_pt == 0. && gen.z == 0. ? 0. : std::atan2(gen_pt, gen.z);
+        const double reco_phi = reco_pt == 0. ? 0. : std::atan2(reco.y, reco.x);
+        const double gen_phi = gen_pt == 0. ? 0. : std::atan2(gen.y, gen.x);
+        result.p.push_back((reco_pt - gen_pt)/gen_pt);
+        result.theta.push_back((reco_theta - gen_theta)/gen_theta);
+        result.phi.push_back((reco_phi - gen_phi)/gen_phi);
+        result.k.push_back(1./reco_pt - 1./gen_pt);
+        result.pdg.push_back(mc[j].PDG);
+    }
+    return result;
+}
 
-    //cout << d0 <<  " " << z0 << endl;
-    //if(vtx.Phi() > -M_PI && vtx.Phi() < -0.5*M_PI) d0 = 0;
 
-    result.push_back(d0);
-    result.push_back(z0);
-    
-    
-    return result;
+// Elements of a per-lepton column as floats (compact track tables of slim.py)
+template <typename T>
+Vec_f toFloat(const ROOT::VecOps::RVec<T>& values) {
+    return Vec_f(values.begin(), values.end());
 }
 
 
+// Mergeable quantile sketch (in the spirit of DDSketch): the values are counted in logarithmic buckets of |x|,
+// so that every quantile is known to a relative accuracy alpha with a fixed number of buckets per slot,
+// independent of the binning a histogram would need. The result is a TH1D with one bin per signed bucket index
+// (bin center = index, 0 for |x| < min_value) holding the counts, and the exact sums of x and x^2 in its
+// statistics, so outputs can still be merged with hadd. The parameters are kept in the title, see analysis/sketch.py
+class QuantileSketchHelper : public ROOT::Detail::RDF::RActionImpl<QuantileSketchHelper> {
+public:
+    using Result_t = TH1D;
+
+    QuantileSketchHelper(const std::string& name, double alpha, double min_value, double max_value, unsigned int nslots)
+        : fMinValue(min_value), fLogGamma(std::log((1. + alpha)/(1. - alpha))) {
+        fNBuckets = (int)std::ceil(std::log(max_value/min_value)/fLogGamma);
+        fCounts.assign(nslots, std::vector<ULong64_t>(2*fNBuckets + 1, 0));
+        fStats.assign(nslots, {0., 0.});
+        fResult = std::make_shared<TH1D>(name.c_str(), TString::Format("sketch alpha=%g min=%g nbuckets=%d", alpha, min_value, fNBuckets),
+                                         2*fNBuckets + 1, -fNBuckets - 0.5, fNBuckets + 0.5);
+        fResult->SetDirectory(nullptr);
+    }
+    QuantileSketchHelper(QuantileSketchHelper&&) = default;
+    QuantileSketchHelper(const QuantileSketchHelper&) = delete;
+
+    std::shared_ptr<TH1D> GetResultPtr() const { return fResult; }
+    void Initialize() {}
+    void InitTask(TTreeReader*, unsigned int) {}
+
+    void Exec(unsigned int slot, double x) {
+        if (!std::isfinite(x)) return;
+        // bucket i > 0 holds min*gamma^(i-1) < |x| <= min*gamma^i, values beyond max_value go to the last bucket
+        const double ax = std::abs(x);
+        int index = 0;
+        if (ax >= fMinValue) index = std::clamp((int)std::ceil(std::log(ax/fMinValue)/fLogGamma), 1, fNBuckets);
+        fCounts[slot][fNBuckets + (x < 0 ? -index : index)]++;
+        fStats[slot][0] += x;
+        fStats[slot][1] += x*x;
+    }
+
+    template <typename T>
+    void Exec(unsigned int slot, const ROOT::VecOps::RVec<T>& values) {
+        for (auto x : values) Exec(slot, x);
+    }
+
+    void Finalize() {
+        double sumx = 0., sumx2 = 0., n = 0.;
+        for (size_t slot = 0; slot < fCounts.size(); slot++) {
+            sumx += fStats[slot][0];
+            sumx2 += fStats[slot][1];
+        }
+        for (int i = 0; i < 2*fNBuckets + 1; i++) {
+            double count = 0.;
+            for (auto& counts : fCounts) count += counts[i];
+            fResult->SetBinContent(i + 1, count);
+            n += count;
+        }
+        // SetBinContent resets the statistics, set them last: sumw, sumw2, sumwx, sumwx2
+        double stats[4] = {n, n, sumx, sumx2};
+        fResult->PutStats(stats);
+        fResult->SetEntries(n);
+    }
+
+    std::string GetActionName() { return "QuantileSketch"; }
+
+private:
+    std::shared_ptr<TH1D> fResult;
+    std::vector<std::vector<ULong64_t>> fCounts; // bucket counts per slot, from the most negative bucket
+    std::vector<std::array<double, 2>> fStats; // sum of x and x^2 per slot
+    double fMinValue;
+    double fLogGamma;
+    int fNBuckets;
+};
+
+// Book a quantile sketch of a (vector) column, T is the column type
+template <typename T>
+ROOT::RDF::RResultPtr<TH1D> BookSketch(ROOT::RDF::RNode df, const std::string& column, const std::string& name,
+                                       double alpha=0.002, double min_value=1e-8, double max_value=1.) {
+    return df.Book<T>(QuantileSketchHelper(name, alpha, min_value, max_value, df.GetNSlots()), {column});
+}
+
 }
\ No newline at end of file
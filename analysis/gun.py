@@ -0,0 +1,136 @@
+import argparse
+import concurrent.futures
+import math
+import os
+import sys
+
+import numpy as np
+
+# Python particle gun writing HepMC3 ASCII, a native alternative to bin/gunHEPMC3 (no container needed). It reads
+# the same input cards and generates the same events as generate_event of gunHEPMC3.cpp: per particle a vertex at
+# R0 along phi and z0, with the two beam electrons as incoming particles and the gun particle with phi in [0, pi],
+# theta uniform in theta_range and a log-uniform momentum in mom_range. Events are generated with NumPy in batches
+# and formatted as WriterAscii of HepMC3 3.2.5 does. The random stream (PCG64) differs from the mt19937 of the
+# compiled gun, so the samples are statistically equivalent, not identical.
+
+HEPMC3_VERSION = "3.02.05"
+HEADER = f"HepMC::Version {HEPMC3_VERSION}\nHepMC::Asciiv3-START_EVENT_LISTING\n"
+FOOTER = "HepMC::Asciiv3-END_EVENT_LISTING\n\n"
+
+# PDG masses (GeV) of get_mass in gunHEPMC3.cpp, 0 for other particles
+masses = {211: 0.139570, -211: 0.139570, 2212: 0.93827, -2212: 0.93827, 2112: 0.93957, 111: 0.13498, 130: 0.49767,
+          310: 0.49767, 11: 0.00051, -11: 0.00051, 22: 0.00000, 13: 0.10566, -13: 0.10566, 213: 0.76690, -213: 0.76690}
+
+BEAM_ENERGY = 125.
+
+
+def read_card(path):
+    """Parse a gun input card (key value lines) as gunHEPMC3 does"""
+    config = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) < 2:
+                break
+            config[fields[0]] = fields[1]
+    return {
+        "nevents": int(float(config["nevents"])),
+        "npart": int(float(config["npart"])),
+        "R0": float(config["R0"]),
+        "z0": float(config["z0"]),
+        "theta_range": [float(v) for v in config["theta_range"].split(",")],
+        "mom_range": [float(v) for v in config["mom_range"].split(",")],
+        "pid_list": [int(v) for v in config["pid_list"].split(",")],
+        "seed": int(config["seed"]) if "seed" in config else None,
+        "first_event": int(config.get("first_event", 0)),
+    }
+
+def event_template(npart, displaced):
+    """
+    printf-style template of one event: the event number, then per particle the vertex position (if displaced)
+    and the pid, px, py, pz, e and m of the gun particle
+    """
+    zero = f"{0.:.16e}"
+    beam = f"{BEAM_ENERGY:.16e}"
+    lines = [f"E %d {npart} {3*npart}", "U GEV MM"]
+    for i in range(npart):
+        lines.append(f"P {3*i+1} 0 11 {zero} {zero} {beam} {beam} {zero} 3")
+        lines.append(f"P {3*i+2} 0 -11 {zero} {zero} {f'{-BEAM_ENERGY:.16e}'} {beam} {zero} 3")
+        # WriterAscii only writes the position of vertices away from the origin
+        lines.append(f"V {-(i+1)} 0 [{3*i+1},{3*i+2}]" + (f" @ %.16e %.16e %.16e {zero}" if displaced else ""))
+        lines.append(f"P {3*i+3} {-(i+1)} %d %.16e %.16e %.16e %.16e %.16e 1")
+    return "\n".join(lines) + "\n"
+
+def generate_batch(config, rng, first_event, nevents):
+    """
+    Values of nevents events for event_template, one row per event: the event number, then per particle
+    (x, y, z,) pid, px, py, pz, e, m
+    """
+    npart = config["npart"]
+    shape = (nevents, npart)
+    phi = rng.uniform(0., math.pi, shape)
+    pid = np.asarray(config["pid_list"])[rng.integers(0, len(config["pid_list"]), shape)]
+    theta = np.radians(rng.uniform(*config["theta_range"][:2], shape))
+    p = np.exp(rng.uniform(*np.log(config["mom_range"][:2]), shape))
+    mass = np.vectorize(lambda pdg: masses.get(pdg, 0.), otypes=['d'])(pid) if pid.size else np.zeros(shape)
+
+    px = p*np.sin(theta)*np.cos(phi)
+    py = p*np.sin(theta)*np.sin(phi)
+    pz = p*np.cos(theta)
+    e = np.sqrt(px*px + py*py + pz*pz + mass*mass)
+    # the written mass is the one of the four-momentum, as FourVector::m
+    m2 = e*e - (px*px + py*py + pz*pz)
+    m = np.where(m2 < 0, -np.sqrt(np.abs(m2)), np.sqrt(np.abs(m2)))
+
+    columns = [pid, px, py, pz, e, m]
+    if config["R0"] != 0 or config["z0"] != 0:
+        columns = [config["R0"]*np.cos(phi), config["R0"]*np.sin(phi), np.full(shape, config["z0"])] + columns
+    values = np.stack(columns, axis=-1).reshape(nevents, -1)
+    return np.hstack([np.arange(first_event, first_event + nevents, dtype='d')[:, None], values])
+
+def generate_sample(card_path, output_file=None, output_dir=".", batch_size=20000):
+    """Generate the sample of a gun card into a HepMC3 file, <card name>.hepmc in output_dir by default"""
+    config = read_card(card_path)
+    if output_file is None:
+        output_file = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(card_path))[0]}.hepmc")
+    rng = np.random.default_rng(config["seed"])
+    template = event_template(config["npart"], config["R0"] != 0 or config["z0"] != 0)
+
+    with open(output_file, "w", buffering=1 << 22) as f:
+        f.write(HEADER)
+        for start in range(0, config["nevents"], batch_size):
+            n = min(batch_size, config["nevents"] - start)
+            values = generate_batch(config, rng, config["first_event"] + start, n)
+            f.write((template*n) % tuple(values.ravel().tolist()))
+        f.write(FOOTER)
+    print(f"config: {card_path}, nevents: {config['nevents']}, seed: {config['seed']}, first_event: {config['first_event']}\nDone: {output_file}")
+    return output_file
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cards", type=str, nargs='+', help="Gun input card(s)")
+    parser.add_argument("-o", "--output", type=str, help="Output file (a single card only, e.g. a named pipe)", default=None)
+    parser.add_argument("-d", "--output_dir", type=str, help="Directory of the <card name>.hepmc outputs", default=".")
+    parser.add_argument("-j", "--nThreads", type=int, help="Number of samples generated in parallel", default=1)
+    parser.add_argument("--batch_size", type=int, help="Number of events generated and written at once", default=20000)
+    args = parser.parse_args()
+
+    if args.output and len(args.cards) > 1:
+        parser.error("--output takes a single card")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(args.nThreads, len(args.cards)))) as pool:
+        futures = {pool.submit(generate_sample, card, args.output, args.output_dir, args.batch_size): card for card in args.cards}
+        failed = 0
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error generating {futures[future]}: {e}", file=sys.stderr)
+                failed += 1
+    if failed:
+        print(f"{failed} of {len(args.cards)} samples failed", file=sys.stderr)
+        sys.exit(1)
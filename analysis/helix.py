@@ -0,0 +1,62 @@
+import argparse
+
+import numpy as np
+
+# NumPy reference of the generator-level helix d0/z0 (genHelixMatched in functions.h), used to validate the C++ kernel
+
+
+def helix_pca(x, y, z, px, py, pz, qB):
+    """
+    Signed d0 and z0 (mm) at the point of closest approach to the z axis of the helices of particles produced at
+    (x, y, z) (mm) with momentum (px, py, pz) (GeV), qB: charge times Bz (T). Arrays of any (broadcastable) shape
+    """
+    x, y, z, px, py, pz, qB = np.broadcast_arrays(*(np.asarray(a, dtype='d') for a in (x, y, z, px, py, pz, qB)))
+    pT = np.hypot(px, py)
+    curved = (pT >= 1e-9) & (np.abs(qB) >= 1e-12)
+    pT = np.where(curved, pT, 1.)
+    s = np.where(qB > 0, 1., -1.)
+    R = pT/(0.3*np.where(curved, np.abs(qB), 1.))*1000.
+    xc = x - s*R*py/pT
+    yc = y + s*R*px/pT
+    d0 = s*(R - np.hypot(xc, yc))
+    dphi = np.mod(-s*(np.arctan2(-yc, -xc) - np.arctan2(y - yc, x - xc)), 2*np.pi)
+    z0 = z - s*R*dphi*pz/pT
+    return np.where(curved, d0, 0.), np.where(curved, z0, z)
+
+def validate(input_file, nevents=0):
+    """Compare genHelixMatched on all generator particles of a Delphes output with the NumPy reference"""
+    import ROOT
+    import analysis # loads functions.h
+
+    df = ROOT.RDataFrame("events", input_file)
+    if nevents > 0:
+        df = df.Range(nevents)
+    df = df.Define("gen_index", "ROOT::VecOps::RVec<int> index(Particle.size()); std::iota(index.begin(), index.end(), 0); return index;")
+    df = df.Define("gen_helix", "FCCAnalyses::genHelixMatched(Particle, gen_index, magFieldBz)")
+    df = df.Define("gen_d0", "gen_helix.d0").Define("gen_z0", "gen_helix.z0").Define("gen_qB", "Particle.charge*magFieldBz[0]")
+    columns = {"x": "Particle.vertex.x", "y": "Particle.vertex.y", "z": "Particle.vertex.z",
+               "px": "Particle.momentum.x", "py": "Particle.momentum.y", "pz": "Particle.momentum.z", "qB": "gen_qB"}
+    data = df.AsNumpy(list(columns.values()) + ["gen_d0", "gen_z0"])
+    flat = {name: np.concatenate([np.asarray(v, dtype='d') for v in data[column]]) for name, column in {**columns, "d0": "gen_d0", "z0": "gen_z0"}.items()}
+
+    charged = flat["qB"] != 0
+    d0, z0 = helix_pca(*(flat[name][charged] for name in columns))
+    ok = True
+    for name, reference in (("d0", d0), ("z0", z0)):
+        diff = np.abs(flat[name][charged] - reference)
+        # the kernel returns floats: compare relative to the float precision of the values
+        beyond = (diff > 1e-5*np.maximum(np.abs(reference), 1.)).sum()
+        print(f"{name}: {charged.sum()} charged particles, max |kernel - reference| = {diff.max(initial=0.):.3g} mm, {beyond} beyond tolerance")
+        ok &= beyond == 0
+    return ok
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, help="Delphes output file to validate genHelixMatched on", required=True)
+    parser.add_argument("--nevents", type=int, help="Number of events (0: all)", default=0)
+    args = parser.parse_args()
+
+    if not validate(args.input, args.nevents):
+        raise SystemExit(1)
@@ -0,0 +1,84 @@
+import ast
+import functools
+import hashlib
+import json
+import os
+
+# manifests live next to the stage outputs, in a hidden directory so they are not picked up as samples
+MANIFEST_DIR = ".manifest"
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path, mtime_ns, size):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_digest(path):
+    """Content hash of a file, cached as long as the file is not modified"""
+    st = os.stat(path)
+    return _file_digest(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+def source_digest(path, names):
+    """
+    Hash of the source of some top-level functions of a Python file, for outputs that depend on a part
+    of a script only (e.g. slim track tables on the residual definitions of analysis.py, not on its binning)
+    """
+    with open(path) as f:
+        source = f.read()
+    h = hashlib.sha256()
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.FunctionDef) and node.name in names:
+            h.update(ast.get_source_segment(source, node).encode())
+    return h.hexdigest()
+
+def manifest_path(output):
+    return os.path.join(os.path.dirname(output), MANIFEST_DIR, f"{os.path.basename(output)}.json")
+
+def recorded_digest(output):
+    try:
+        with open(manifest_path(output)) as f:
+            return json.load(f)["digest"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def output_digest(output):
+    """Digest identifying an upstream output: the recorded manifest hash, or its content hash if it has none"""
+    digest = recorded_digest(output)
+    if digest is None:
+        digest = file_digest(output) if os.path.exists(output) else "missing"
+    return digest
+
+def compute_digest(files=(), upstream=(), extra=None):
+    """
+    Hash over everything a stage output depends on:
+    files: contents of the scripts/cards used to produce it
+    upstream: digests of the upstream outputs (see output_digest)
+    extra: any other settings (must be JSON serializable)
+    """
+    h = hashlib.sha256()
+    for path in files:
+        h.update(os.path.basename(path).encode())
+        h.update(file_digest(path).encode())
+    for digest in upstream:
+        h.update(digest.encode())
+    if extra is not None:
+        h.update(json.dumps(extra, sort_keys=True).encode())
+    return h.hexdigest()
+
+def is_current(output, digest, key=None):
+    """
+    Whether output exists and was produced from inputs with the given digest.
+    key: name the manifest is recorded under, if different from output (e.g. one sample of a shared output)
+    """
+    return os.path.exists(output) and recorded_digest(key or output) == digest
+
+def record(output, digest):
+    path = manifest_path(output)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump({"output": os.path.basename(output), "digest": digest}, f, indent=4)
+    os.replace(tmp, path)
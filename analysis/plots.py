@@ -1,60 +1,198 @@
 import argparse
 import sys,array,ROOT,math,os,copy
+import concurrent.futures
 import numpy as np
 import json
+import zlib
+
+import results
+import sketch
 
 ROOT.gROOT.SetBatch(True)
 ROOT.gStyle.SetOptStat(0)
 ROOT.gStyle.SetOptTitle(0)
 
 
+# histograms of the analysis output per resolution type
+hist_names = {"d0": "RP_TRK_D0_um", "z0": "RP_TRK_Z0_um", "p": "muon_res_p", "k": "muon_res_k"}
+
+
+def load_res(fIn, hist_name):
+    """
+    Histogram of a resolution, and its quantile sketch if the analysis output has one. For a sketch,
+    the histogram is only used for the Gauss fit and the plot, filled from the sketch buckets over the central
+    99.8% of the values, so that tails do not widen the bins of the core. An empty sketch gives an empty
+    histogram, and NaN resolutions
+    """
+    sketch_hist = fIn.Get(f"{hist_name}{sketch.SKETCH_SUFFIX}")
+    if not sketch_hist:
+        return fIn.Get(hist_name), None
+    sk = sketch.Sketch.from_hist(sketch_hist)
+    if sk.empty:
+        print(f"WARNING: {hist_name} of {fIn.GetName()} is empty, no resolution")
+        low, high = -1., 1.
+    else:
+        low, high = sk.quantiles([0.001, 0.999])
+        # 10% margins, a range of its own magnitude if all values are in one bucket
+        margin = 0.1*(high - low) if high > low else max(abs(low), sk.min_value)
+        low, high = low - margin, high + margin
+    hist = ROOT.TH1D(hist_name, "", 200, low, high)
+    hist.SetDirectory(0)
+    filled = sk.counts > 0
+    hist.FillN(int(filled.sum()), sk.values()[filled], sk.counts[filled])
+    return hist, sk
+
 def compute_res(input_file, output_name, hist_name, hist_type, plotGauss=True):
 
     fIn = ROOT.TFile(input_file)
-    hist = fIn.Get(hist_name)
+    hist, sk = load_res(fIn, hist_name)
+    data = res_stats(hist, sk, output_name)
+    fit = core_fit(*hist_arrays([hist]), [data["mean"]], [data["rms"]])
+    data.update(fit_values(fit, 0))
+    plot_res(hist, data, output_name, hist_type, plotGauss)
+    with open(f"{output_name}.json", "w") as f:
+        json.dump(table_values(data), f, indent=4)
 
-    rebin = 1
-    hist = hist.Rebin(rebin)
+def res_stats(hist, sk, output_name):
+    """Mean, RMS and quantile width of a resolution, from its sketch if there is one (exact moments, quantiles within its accuracy)"""
 
     probabilities = np.array([0.001, 0.999, 0.84, 0.16], dtype='d')
 
-    # get mean
-    mean = hist.GetMean()
+    if sk is not None:
+        mean = sk.mean
+        rms, rms_err = sk.rms, sk.rms_err
+        quantiles = sk.quantiles(probabilities)
+    else:
+        mean = hist.GetMean()
+        rms, rms_err = hist.GetRMS(), hist.GetRMSError()
+        quantiles = np.array([0.0, 0.0, 0.0, 0.0], dtype='d')
+        hist.GetQuantiles(4, quantiles, probabilities)
 
-    # compute RMS
-    rms, rms_err = hist.GetRMS(), hist.GetRMSError()
+    data = {"mean": float(mean), "rms": float(rms), "rms_err": float(rms_err), "res_quantile": float(0.5*(quantiles[2] - quantiles[3]))}
 
-    # range for plotting
-    xMin, xMax = mean - 3*rms, mean + 3*rms
-
-    # compute quantiles
-    quantiles = np.array([0.0, 0.0, 0.0, 0.0], dtype='d')
-    hist.GetQuantiles(4, quantiles, probabilities)
-    #xMin, xMax = min([quantiles[0], -quantiles[1]]), max([-quantiles[0], quantiles[1]])
-    res_quantile = 0.5*(quantiles[2] - quantiles[3])
+    # uncertainty of the quantile width from Poisson bootstrap replicas of the sketch buckets
+    if sk is not None:
+        rng = np.random.default_rng(zlib.crc32(os.path.basename(output_name).encode()))
+        replicas = sk.bootstrap_quantiles(probabilities[2:], rng=rng)
+        data["res_quantile_err"] = float(0.5*(replicas[:, 0] - replicas[:, 1]).std(ddof=1))
+    return data
 
+def hist_arrays(hists):
+    """Bin centers and contents of histograms as rows of two arrays, shorter histograms padded with empty bins"""
+    nbins = max(hist.GetNbinsX() for hist in hists)
+    centers, contents = np.zeros((len(hists), nbins)), np.zeros((len(hists), nbins))
+    for i, hist in enumerate(hists):
+        n = hist.GetNbinsX()
+        axis = hist.GetXaxis()
+        edges = np.array([axis.GetBinLowEdge(j) for j in range(1, n+2)])
+        centers[i, :n] = 0.5*(edges[1:] + edges[:-1])
+        contents[i, :n] = np.array([hist.GetBinContent(j) for j in range(1, n+1)])
+    return centers, contents
 
+def solve_rows(matrices, vectors, max_condition=1e12):
+    """
+    Solutions of the linear systems of many rows, and a mask of the rows whose matrix is singular or
+    ill-conditioned (or not finite), for which the solution is zero instead
+    """
+    finite = np.isfinite(matrices).all(axis=(1, 2)) & np.isfinite(vectors).all(axis=1)
+    good = finite.copy()
+    good[finite] = np.linalg.cond(matrices[finite]) < max_condition
+    solution = np.zeros_like(vectors)
+    if good.any():
+        solution[good] = np.linalg.solve(matrices[good], vectors[good][..., None])[..., 0]
+    return solution, ~good
 
-    # fit with Gauss
-    gauss = ROOT.TF1("gauss2", "gaus", xMin, xMax)
-    gauss.SetParameter(0, hist.Integral())
-    gauss.SetParameter(1, hist.GetMean())
-    gauss.SetParameter(2, hist.GetRMS())
-    gauss.SetLineColor(ROOT.kRed)
-    gauss.SetLineWidth(3)
-    hist.Fit("gauss2", "R")
+def core_fit(centers, contents, mu, sigma, nsigma=2., iterations=10, steps=3):
+    """
+    Gaussian fits of the cores of many histograms at once (one per row of centers and contents): the fit range
+    is iterated to +-nsigma around the fitted mean, starting from mu and sigma. The chi2 uses the bin errors
+    sqrt(content) and skips empty bins, as a TF1 fit, and is minimised with batched Gauss-Newton steps.
+    Returns the amplitude, mean and sigma per row, their covariance and the fit range. Rows whose fit fails
+    (too few bins in the range, or a singular chi2, e.g. a degenerate core, a zero amplitude or a collapsed sigma)
+    get NaN parameters, without affecting the other rows
+    """
+    x, y = np.asarray(centers, dtype='d'), np.asarray(contents, dtype='d')
+    mu, sigma = np.array(mu, dtype='d'), np.abs(np.array(sigma, dtype='d'))
+    window = np.abs(x - mu[:, None]) < nsigma*sigma[:, None]
+    amplitude = np.where(window, y, 0.).max(axis=1)
+    weight = np.where(y > 0, 1/np.where(y > 0, y, 1.), 0.)
+    failed = ~(np.isfinite(mu) & (sigma > 0))
+    for _ in range(iterations):
+        # bins with their center in the range, as in a TF1 fit with option R
+        low, high = mu - nsigma*sigma, mu + nsigma*sigma
+        window = (y > 0) & (x >= low[:, None]) & (x <= high[:, None])
+        w = np.where(window, weight, 0.)
+        ok = window.sum(axis=1) > 3
+        for _ in range(steps):
+            # failed rows are evaluated with a unit sigma, their parameters are no longer updated
+            scale = np.where(failed, 1., sigma)[:, None]
+            z = np.where(failed[:, None], 0., x - mu[:, None])/scale
+            g = np.exp(-0.5*z**2)
+            f = np.where(failed, 0., amplitude)[:, None]*g
+            jacobian = np.stack([g, f*z/scale, f*z**2/scale], axis=-1)
+            hessian = np.einsum('hb,hbi,hbj->hij', w, jacobian, jacobian)
+            gradient = np.einsum('hb,hbi,hb->hi', w, jacobian, y - f)
+            # rows without enough bins in the range keep their parameters, failed rows stop
+            hessian[~ok | failed] = np.eye(3)
+            gradient[~ok | failed] = 0.
+            step, singular = solve_rows(hessian, gradient)
+            failed |= singular
+            amplitude, mu, sigma = amplitude + step[:, 0], mu + step[:, 1], np.abs(sigma + step[:, 2])
+            failed |= ~(np.isfinite(amplitude) & np.isfinite(mu) & (sigma > 0))
+    covariance = np.full((len(x), 3, 3), np.nan)
+    invertible = ok & ~failed
+    if invertible.any():
+        covariance[invertible] = np.linalg.inv(hessian[invertible])
+    # rows without enough bins in the final range have no fit either
+    failed |= ~ok
+    for values in (amplitude, mu, sigma):
+        values[failed] = np.nan
+    return {"amplitude": amplitude, "mu": mu, "sigma": sigma, "covariance": covariance, "min": low, "max": high}
 
-    mu, sigma = gauss.GetParameter(1), gauss.GetParameter(2)
-    sigma_err = gauss.GetParError(2)
+def fit_values(fit, i):
+    """Fit results of row i"""
+    return {"fit_amplitude": float(fit["amplitude"][i]), "fit_mu": float(fit["mu"][i]), "sigma": float(fit["sigma"][i]),
+            "sigma_err": float(np.sqrt(fit["covariance"][i, 2, 2])), "fit_min": float(fit["min"][i]), "fit_max": float(fit["max"][i])}
 
+def table_values(data):
+    """Values of a resolution stored in the results table and the JSON outputs"""
+    return {key: data[key] for key in results.VALUES if key in data}
 
-    ## do plotting
-    yMin, yMax = 0, 1.3*hist.GetMaximum()
+def res_canvas():
     canvas = ROOT.TCanvas("canvas", "", 1000, 1000)
     canvas.SetTopMargin(0.055)
     canvas.SetRightMargin(0.05)
     canvas.SetLeftMargin(0.15)
     canvas.SetBottomMargin(0.11)
+    return canvas
+
+def plot_res(hist, data, output_name, hist_type, plotGauss=True):
+
+    canvas = res_canvas()
+    drawn = draw_res(canvas, hist, data, hist_type, plotGauss)
+    canvas.SaveAs(f"{output_name}.png")
+    canvas.SaveAs(f"{output_name}.pdf")
+    canvas.Close()
+
+def draw_res(canvas, hist, data, hist_type, plotGauss=True):
+    """Draw a resolution histogram with its Gauss fit and estimates on canvas, returns the drawn objects to keep them alive"""
+
+    mean, rms, res_quantile = data["mean"], data["rms"], data["res_quantile"]
+    mu, sigma = data["fit_mu"], data["sigma"]
+
+    # range for plotting
+    xMin, xMax = mean - 3*rms, mean + 3*rms
+
+    # fitted Gauss, drawn over its fit range
+    gauss = ROOT.TF1("gauss2", "gaus", data["fit_min"], data["fit_max"])
+    gauss.SetParameters(data["fit_amplitude"], mu, sigma)
+    gauss.SetLineColor(ROOT.kRed)
+    gauss.SetLineWidth(3)
+
+
+    ## do plotting
+    yMin, yMax = 0, 1.3*hist.GetMaximum()
+    canvas.cd()
 
     hist_types = {"d0": "d_{0} (#mum)", "z0": "z_{0} (#mum)", "p": "Momentum resolution (%)", "k": "Curvature resolution (%)"}
     dummy = ROOT.TH1D("h", "h", 1, xMin, xMax)
@@ -97,33 +235,129 @@ def compute_res(input_file, output_name, hist_name, hist_type, plotGauss=True):
     latex.SetTextSize(0.035)
     latex.SetTextColor(1)
     latex.SetTextFont(42)
-    latex.DrawLatex(0.2, 0.9, f"Mean/RMS = {hist.GetMean():.4f}/{rms:.4f}")
+    latex.DrawLatex(0.2, 0.9, f"Mean/RMS = {mean:.4f}/{rms:.4f}")
     latex.DrawLatex(0.2, 0.85, f"Resolution = {res_quantile:.4f} %")
     if plotGauss:
         latex.DrawLatex(0.2, 0.80, f"Gauss #mu/#sigma = {mu:.4f}/{sigma:.4f}")
 
-    canvas.SaveAs(f"{output_name}.png")
-    canvas.SaveAs(f"{output_name}.pdf")
-    canvas.Close()
+    return dummy, gauss, latex
 
-    del gauss
+def compute_res_sample(input_file):
+    """Resolution estimates of all types of one sample, and the bin contents for the core fit"""
+    fIn = ROOT.TFile(input_file)
+    stats, arrays = {}, {}
+    for hist_type, hist_name in hist_names.items():
+        hist, sk = load_res(fIn, hist_name)
+        stats[hist_type] = res_stats(hist, sk, f"{hist_type}_{os.path.basename(input_file).replace('.root', '')}")
+        arrays[hist_type] = hist_arrays([hist])
+    fIn.Close()
+    return stats, arrays
 
-    data = {}
-    data["rms"] = rms
-    data["rms_err"] = rms_err
-    data["sigma"] = sigma
-    data["sigma_err"] = sigma_err
-    data["res_quantile"] = res_quantile
-    with open(f"{output_name}.json", "w") as f:
-        json.dump(data, f, indent=4)
+def compute_res_batch(input_files, output_dir, card, nThreads=None):
+    """
+    Extract the resolutions of all samples and store them in the results table of output_dir: the histograms
+    are read in a process pool and the Gauss cores of all samples and types are fitted at once. No plots are
+    drawn, see render
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nThreads) as pool:
+        loaded = list(pool.map(compute_res_sample, input_files))
+
+    entries = [(i, hist_type) for i in range(len(input_files)) for hist_type in hist_names]
+    nbins = max(loaded[i][1][hist_type][0].shape[1] for i, hist_type in entries)
+    centers, contents = np.zeros((len(entries), nbins)), np.zeros((len(entries), nbins))
+    for row, (i, hist_type) in enumerate(entries):
+        c, y = loaded[i][1][hist_type]
+        centers[row, :c.shape[1]], contents[row, :c.shape[1]] = c[0], y[0]
+    stats = [loaded[i][0][hist_type] for i, hist_type in entries]
+    fit = core_fit(centers, contents, [s["mean"] for s in stats], [s["rms"] for s in stats])
+
+    rows = []
+    for row, (i, hist_type) in enumerate(entries):
+        particle, theta, p = results.parse_sample(os.path.basename(input_files[i]).replace(".root", ""))
+        rows.append({"card": card, "particle": particle, "theta": theta, "p": p, "observable": hist_type, **table_values({**stats[row], **fit_values(fit, row)})})
+    results.update_table(results.results_path(output_dir), rows)
+
+def render(input_files, output_dir, hist_types=None, pdf=None):
+    """
+    Draw the resolutions of analysis outputs with their estimates and Gauss fits (recomputed as in
+    compute_res_batch): a PNG and a PDF per sample and type in output_dir, or all of them as pages of the
+    single PDF pdf, drawn on one canvas
+    """
+    hist_types = hist_types or list(hist_names)
+    canvas = res_canvas()
+    if pdf:
+        canvas.Print(f"{pdf}[")
+    for input_file in input_files:
+        sample_name = os.path.basename(input_file).replace(".root", "")
+        fIn = ROOT.TFile(input_file)
+        hists = {hist_type: load_res(fIn, hist_names[hist_type]) for hist_type in hist_types}
+        stats = [res_stats(hist, sk, f"{hist_type}_{sample_name}") for hist_type, (hist, sk) in hists.items()]
+        fit = core_fit(*hist_arrays([hist for hist, _ in hists.values()]), [s["mean"] for s in stats], [s["rms"] for s in stats])
+        for i, (hist_type, (hist, sk)) in enumerate(hists.items()):
+            if sk is not None and sk.empty:
+                continue
+            canvas.Clear()
+            drawn = draw_res(canvas, hist, {**stats[i], **fit_values(fit, i)}, hist_type)
+            if pdf:
+                canvas.Print(pdf, f"Title:{hist_type} {sample_name}")
+            else:
+                canvas.SaveAs(f"{output_dir}/{hist_type}_{sample_name}.png")
+                canvas.SaveAs(f"{output_dir}/{hist_type}_{sample_name}.pdf")
+        fIn.Close()
+    if pdf:
+        canvas.Print(f"{pdf}]")
+        print(f"Resolution plots of {len(input_files)} sample(s) saved to {pdf}")
+    canvas.Close()
+
+def validate_fit(input_file):
+    """Compare the core fits of the resolutions of an analysis output with TF1 fits over the same ranges"""
+    fIn = ROOT.TFile(input_file)
+    hists, stats = [], []
+    for hist_type, hist_name in hist_names.items():
+        hist, sk = load_res(fIn, hist_name)
+        hists.append(hist)
+        stats.append(res_stats(hist, sk, hist_type))
+    fit = core_fit(*hist_arrays(hists), [s["mean"] for s in stats], [s["rms"] for s in stats])
+    ok = True
+    for i, (hist_type, hist) in enumerate(zip(hist_names, hists)):
+        values = fit_values(fit, i)
+        gauss = ROOT.TF1(f"validate_{hist_type}", "gaus", values["fit_min"], values["fit_max"])
+        gauss.SetParameters(values["fit_amplitude"], values["fit_mu"], values["sigma"])
+        hist.Fit(gauss, "RQ0")
+        sigma, sigma_err = abs(gauss.GetParameter(2)), gauss.GetParError(2)
+        # both minimise the same chi2: agreement well within the statistical uncertainty
+        agree = abs(values["sigma"] - sigma) < 0.01*sigma_err + 1e-6*sigma and abs(values["sigma_err"] - sigma_err) < 0.01*sigma_err
+        print(f"{hist_type}: sigma {values['sigma']:.6g} +- {values['sigma_err']:.3g} (TF1: {sigma:.6g} +- {sigma_err:.3g}){'' if agree else ' MISMATCH'}")
+        ok &= agree
+    fIn.Close()
+    return ok
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", type=str, help="Input file", required=True)
-    parser.add_argument("-o", "--output", type=str, help="Output file base name", required=True)
-    parser.add_argument("-n", "--histName", type=str, help="Histogram to plot", required=True)
-    parser.add_argument("-t", "--type", type=str, help="Type (d0, z0, p or k)", required=True)
+    parser.add_argument("-i", "--input", type=str, nargs='+', help="Input file(s)", required=True)
+    parser.add_argument("-o", "--output", type=str, help="Output file base name (output directory in batch mode)")
+    parser.add_argument("-n", "--histName", type=str, help="Histogram to plot")
+    parser.add_argument("-t", "--type", type=str, help="Type (d0, z0, p or k)")
+    parser.add_argument("--batch", help="Process all types of all input files and store them in a single results table (no plots)", action='store_true')
+    parser.add_argument("--card", type=str, help="Delphes card name, key of the results table in batch mode", default="")
+    parser.add_argument("--nThreads", type=int, help="Number of processes in batch mode", default=None)
+    parser.add_argument("--validate", help="Compare the core fits of the input file with TF1 fits", action='store_true')
+    parser.add_argument("--render", help="Draw the resolutions of the input files into the output directory, see --types and --pdf", action='store_true')
+    parser.add_argument("--types", type=str, nargs='+', help="Types to draw with --render (default: all)", default=None)
+    parser.add_argument("--pdf", type=str, help="With --render, draw all plots as pages of this PDF file instead", default=None)
     args = parser.parse_args()
 
-    compute_res(args.input, args.output, args.histName, args.type)
+    if args.validate:
+        if not validate_fit(args.input[0]):
+            raise SystemExit(1)
+    elif args.output is None:
+        parser.error("--output is required")
+    elif args.render:
+        render(args.input, args.output, args.types, args.pdf)
+    elif args.batch:
+        compute_res_batch(args.input, args.output, args.card, args.nThreads)
+    else:
+        if args.histName is None or args.type is None or len(args.input) != 1:
+            parser.error("a single --input with --histName and --type is required, or use --batch")
+        compute_res(args.input[0], args.output, args.histName, args.type)
@@ -0,0 +1,137 @@
+import argparse
+import math
+import os
+import re
+import zlib
+
+import numpy as np
+
+import results
+
+# quantile width as in plots.py: half the distance between the 16% and 84% quantiles
+probabilities = [0.16, 0.84]
+
+
+def quantile_width(x, keepdims=False):
+    """Quantile width along the last axis"""
+    q = np.quantile(x, probabilities, axis=-1, keepdims=keepdims)
+    return 0.5*(q[1] - q[0])
+
+def rms(x):
+    return x.std(axis=-1)
+
+def core_sigma(x, nsigma=2., iterations=10):
+    """
+    Width of the Gaussian core along the last axis: mean and standard deviation are iterated within
+    +-nsigma of the mean, and the standard deviation is corrected for the truncation of a Gaussian at nsigma
+    """
+    phi = math.exp(-0.5*nsigma**2)/math.sqrt(2*math.pi)
+    correction = math.sqrt(1 - 2*nsigma*phi/math.erf(nsigma/math.sqrt(2)))
+    mu = np.median(x, axis=-1, keepdims=True)
+    sigma = quantile_width(x, keepdims=True)
+    for _ in range(iterations):
+        core = np.abs(x - mu) < nsigma*sigma
+        n = core.sum(axis=-1, keepdims=True)
+        mu = np.where(core, x, 0.).sum(axis=-1, keepdims=True)/n
+        sigma = np.sqrt(np.where(core, (x - mu)**2, 0.).sum(axis=-1, keepdims=True)/n)/correction
+    return sigma[..., 0]
+
+estimators = {"rms": rms, "sigma": core_sigma, "res_quantile": quantile_width}
+
+def bootstrap_errors(x, nboot=100, batch_size=25, rng=None):
+    """Standard deviation of the estimators over bootstrap replicas of x, evaluated in batches of replicas"""
+    rng = rng or np.random.default_rng()
+    replicas = {name: [] for name in estimators}
+    for start in range(0, nboot, batch_size):
+        resampled = x[rng.integers(0, len(x), size=(min(batch_size, nboot - start), len(x)))]
+        for name, estimator in estimators.items():
+            replicas[name].append(estimator(resampled))
+    return {f"{name}_err": float(np.concatenate(values).std(ddof=1)) for name, values in replicas.items()}
+
+def estimate(x, nboot=100, rng=None):
+    """Unbinned resolution estimates of the residuals x, with bootstrap uncertainties"""
+    data = {name: float(estimator(x)) for name, estimator in estimators.items()}
+    data.update(bootstrap_errors(x, nboot, rng=rng))
+    return data
+
+def sample_of(input_file):
+    """Sample name of a Delphes output, shards are combined into their sample"""
+    return re.sub(r"_shard[0-9]+$", "", os.path.basename(input_file).replace(".root", ""))
+
+def species_samples(sample_name, pdgs):
+    """
+    Samples of the species of a sample of several species (analysis.py --pdg), named after each species:
+    e_minus_theta_10_p_5 for pdg 11 of mu_minus+e_minus_theta_10_p_5
+    """
+    particle, _, _ = results.parse_sample(sample_name)
+    species = particle.split("+")
+    if len(species) != len(pdgs):
+        raise ValueError(f"{sample_name} does not have the {len(pdgs)} species of --pdg")
+    return [f"{name}{sample_name[len(particle):]}" for name in species]
+
+def read_residuals(input_files, nThreads=0, slim=False, pdgs=None):
+    """
+    Residual columns of all samples in one go: the residuals are defined as in analysis.py (or read from
+    slim track tables) and all event loops run together via RunGraphs. Returns {sample: {type: flat numpy array}}.
+    With pdgs, all tracks are split by the PDG id of their generator particle, into one sample per species
+    """
+    import ROOT
+    import analysis
+
+    ROOT.EnableImplicitMT(nThreads)
+    files = {}
+    for input_file in input_files:
+        files.setdefault(sample_of(input_file), []).append(input_file)
+
+    columns = list(analysis.residual_columns.values())
+    counts, arrays = [], {}
+    for sample_name, sample_files in files.items():
+        df = analysis.slim_dataframe(sample_files) if slim else analysis.define_residuals(ROOT.RDataFrame("events", sample_files), all_tracks=bool(pdgs))
+        if pdgs:
+            for i, (pdg, species) in enumerate(zip(pdgs, species_samples(sample_name, pdgs))):
+                df = analysis.select_species(df, pdg, f"_species{i}")
+                arrays[species] = (df.AsNumpy([f"{column}_species{i}" for column in columns], lazy=True), f"_species{i}")
+        else:
+            arrays[sample_name] = (df.AsNumpy(columns, lazy=True), "")
+        counts.append(df.Count())
+    ROOT.RDF.RunGraphs(counts) # the lazy AsNumpy results are filled in the same event loops
+
+    residuals = {}
+    for sample_name, (result, suffix) in arrays.items():
+        values = result.GetValue()
+        residuals[sample_name] = {hist_type: np.concatenate([np.asarray(v, dtype='d') for v in values[f"{column}{suffix}"]] or [np.zeros(0)]) for hist_type, column in analysis.residual_columns.items()}
+    return residuals
+
+def compute_res_unbinned(input_files, output_dir, card, nThreads=0, nboot=100, seed=1, slim=False, pdgs=None):
+    """Unbinned resolutions of all samples (or species, with pdgs) and types, stored in the results table of output_dir"""
+    rows = []
+    for sample_name, residuals in read_residuals(input_files, nThreads, slim, pdgs).items():
+        particle, theta, p = results.parse_sample(sample_name)
+        for hist_type, x in residuals.items():
+            x = x[np.isfinite(x)]
+            if len(x) < 2:
+                # e.g. a species without reconstructed tracks at this point, the other samples go on
+                print(f"WARNING: {sample_name} {hist_type}: {len(x)} residual(s), no resolution")
+                data = {key: math.nan for name in estimators for key in (name, f"{name}_err")}
+            else:
+                rng = np.random.default_rng([seed, zlib.crc32(f"{sample_name}:{hist_type}".encode())])
+                data = estimate(x, nboot, rng)
+            rows.append({"card": card, "particle": particle, "theta": theta, "p": p, "observable": hist_type, **data})
+            print(f"{sample_name} {hist_type}: {data}")
+    results.update_table(results.results_path(output_dir), rows)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, nargs='+', help="Delphes output files or slim track tables (shards of a sample are combined)", required=True)
+    parser.add_argument("-o", "--output", type=str, help="Output directory of the results table", required=True)
+    parser.add_argument("--card", type=str, help="Delphes card name, key of the results table", default="")
+    parser.add_argument("--nThreads", type=int, help="Number of threads (0: all cores)", default=0)
+    parser.add_argument("--nboot", type=int, help="Number of bootstrap replicas for the uncertainties", default=100)
+    parser.add_argument("--seed", type=int, help="Seed of the bootstrap", default=1)
+    parser.add_argument("--slim", help="Inputs are slim track tables (slim.py) instead of Delphes outputs", action='store_true')
+    parser.add_argument("--pdg", type=int, nargs='+', help="Split the tracks of the samples by the PDG id of their generator particle (samples named <species>+<species>..._theta_<theta>_p_<p>)", default=None)
+    args = parser.parse_args()
+
+    compute_res_unbinned(args.input, args.output, args.card, args.nThreads, args.nboot, args.seed, args.slim, args.pdg)
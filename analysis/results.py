@@ -0,0 +1,76 @@
+import fcntl
+import json
+import os
+import re
+
+import numpy as np
+
+# columnar table holding the resolution results of all samples of a card, keyed by
+# card, particle, theta, p and observable (d0, z0, p or k)
+RESULTS_FILE = "results.json"
+KEYS = ["card", "particle", "theta", "p", "observable"]
+VALUES = ["rms", "rms_err", "sigma", "sigma_err", "res_quantile", "res_quantile_err"]
+
+
+def parse_sample(sample_name):
+    """Split a sample name (e.g. mu_minus_theta_10_p_5) into particle, theta and p"""
+    m = re.fullmatch(r"(.+)_theta_([0-9.]+)_p_([0-9.]+)", sample_name)
+    if not m:
+        raise ValueError(f"Cannot parse sample name {sample_name}")
+    return m.group(1), float(m.group(2)), float(m.group(3))
+
+def results_path(plots_dir):
+    return os.path.join(plots_dir, RESULTS_FILE)
+
+def read_table(path):
+    """Read a results table as a dict of numpy arrays, one per column"""
+    with open(path) as f:
+        columns = json.load(f)
+    return {key: np.asarray(values) for key, values in columns.items()}
+
+def write_table(path, table):
+    columns = {key: np.asarray(values).tolist() for key, values in table.items()}
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(columns, f)
+    os.replace(tmp, path)
+
+def from_rows(rows):
+    """Table from a list of row dicts, values a row does not have (e.g. older tables) are NaN"""
+    table = {key: np.asarray([row[key] for row in rows]) for key in KEYS}
+    table.update({key: np.asarray([row.get(key, np.nan) for row in rows], dtype='d') for key in VALUES})
+    return table
+
+def to_rows(table):
+    n = len(table["card"])
+    return [{key: table[key][i].item() for key in table} for i in range(n)]
+
+def update_table(path, rows):
+    """
+    Insert rows into the table at path, replacing the existing rows with the same keys. The read, merge and write
+    hold an exclusive lock on <path>.lock, so that concurrent jobs updating the same table do not drop each other's rows
+    """
+    def key(row):
+        return tuple(row[k] for k in KEYS)
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = {}
+        if os.path.exists(path):
+            merged = {key(row): row for row in to_rows(read_table(path))}
+        for row in rows:
+            merged[key(row)] = row
+        write_table(path, from_rows(list(merged.values())))
+
+def select(table, **keys):
+    """Boolean mask of the rows matching all given key values"""
+    mask = np.ones(len(table["card"]), dtype=bool)
+    for key, value in keys.items():
+        mask &= table[key] == value
+    return mask
+
+def lookup(table, column, **keys):
+    """Value of column for the single row matching keys"""
+    idx = np.flatnonzero(select(table, **keys))
+    if len(idx) != 1:
+        raise KeyError(f"Found {len(idx)} rows for {keys}")
+    return table[column][idx[0]].item()
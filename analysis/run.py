@@ -1,12 +1,21 @@
 import concurrent.futures
 import os
-import subprocess
-import shutil
+import sys
 import argparse
 import math
 import json
+import hashlib
+import re
+import fnmatch
 import numpy as np
 
+import cards
+import fastsim
+import manifest
+import plots
+import results
+import scheduler
+
 import ROOT
 ROOT.gROOT.SetBatch(True)
 ROOT.gStyle.SetOptStat(0)
@@ -18,11 +27,55 @@ parser.add_argument("--delphes", help="Run Delphes", action='store_true')
 parser.add_argument("--analysis", help="Run analysis", action='store_true')
 parser.add_argument("--plots", help="Run plots", action='store_true')
 parser.add_argument("--summary_plots", help="Run summary plots", action='store_true')
+parser.add_argument("--render", type=str, nargs='*', help="Draw the per-sample resolution plots: of the samples matching the given patterns (e.g. '*theta_10_*') as PNG/PDF files, or without patterns of all samples into one multi-page PDF plots_<card>/resolutions.pdf", default=None)
 parser.add_argument("--display_commands", help="Display commands only, don't run", action='store_true')
-parser.add_argument("--delphes_card", type=str, help="Delphes detector card name (as in delphes_cards directory)", default="IDEA_baseline")
+parser.add_argument("--job_log", type=str, help="JSON lines log of the wall/CPU time, peak RSS and I/O of every job (default: <output_dir>/job_log.jsonl), see analysis/scheduler.py", default=None)
+parser.add_argument("--job_manifest", type=str, help="Write the jobs to this JSON job manifest instead of running them, to be run by worker agents (analysis/worker.py) on the nodes sharing the output directory", default=None)
+parser.add_argument("--delphes_card", type=str, nargs='+', help="Delphes detector card name(s) (as in delphes_cards directory), default IDEA_baseline", default=None)
+parser.add_argument("--sweep", type=str, help="Sweep spec (JSON) of card variants generated from a template card, see analysis/cards.py", default=None)
+parser.add_argument("--theta", type=float, nargs='+', help="Polar angles of the gun grid (degrees)", default=[10, 20, 30, 40, 50, 60, 70, 80, 90])
+parser.add_argument("--mom", type=int, nargs='+', help="Momenta of the gun grid (GeV)", default=[5, 10, 50, 100])
+parser.add_argument("--pdg", type=int, nargs='+', help="PDG ids of the gun particles (default: 13, muons). Several species are generated in mixed samples, simulated once and split by species in the analysis", default=[13])
+parser.add_argument("--nevents", type=int, help="Number of events per sample and species (maximum per sample with --target_precision)", default=100000)
+parser.add_argument("--target_precision", type=float, help="Generate events in batches until the relative uncertainty of the quantile width of each sample is below this (e.g. 0.01), up to --nevents per sample", default=None)
+parser.add_argument("--target_observables", type=str, nargs='+', help="Observables the --target_precision applies to", default=["d0", "z0", "p", "k"])
+parser.add_argument("--batch_events", type=int, help="Minimum number of events of a batch with --target_precision", default=10000)
+parser.add_argument("--refine_tolerance", type=float, help="Refine the theta grid where linear interpolation of the summary curves is off by more than this (relative, e.g. 0.05), see --refine_rounds", default=None)
+parser.add_argument("--refine_rounds", type=int, help="Maximum number of grid refinements with --refine_tolerance", default=3)
+parser.add_argument("--refine_min_step", type=float, help="Smallest theta spacing (degrees) the grid is refined to", default=1.)
 parser.add_argument("--output_dir", type=str, help="Output directory", default="output")
-parser.add_argument("--nThreads", type=int, help="Number of threads", default=128)
+parser.add_argument("--nThreads", type=int, help="Maximum number of concurrent jobs (and of threads within a multi-threaded job)", default=os.cpu_count())
+parser.add_argument("--stage_jobs", type=str, nargs='*', help="Maximum number of concurrent jobs per stage, e.g. delphes=16 analysis=8", default=[])
+parser.add_argument("--stage_memory", type=str, nargs='*', help="Estimated memory per job of a stage in MB, e.g. delphes=2000", default=[])
+parser.add_argument("--memory", type=int, help="Memory budget in MB for all concurrent jobs (default: available memory)", default=None)
+parser.add_argument("--retries", type=int, help="Number of times a failed job is retried", default=1)
+parser.add_argument("--native_gun", help="Generate the gun samples with the NumPy gun analysis/gun.py instead of bin/gunHEPMC3 in its container", action='store_true')
+parser.add_argument("--gun_group_size", type=int, help="Number of samples generated per gun job (0: all samples in a single job, e.g. a single container session)", default=1)
+parser.add_argument("--stream", help="Stream gun events into Delphes through named pipes instead of writing HepMC3 files (requires --gun and --delphes)", action='store_true')
+parser.add_argument("--single_process", help="Run the analysis of all samples in a single process", action='store_true')
+parser.add_argument("--shards", type=int, help="Number of shards each sample is generated and simulated in, merged after the analysis", default=1)
+parser.add_argument("--seed", type=int, help="Base seed, from which the seeds of the gun and Delphes for each sample and shard are derived", default=1)
+parser.add_argument("--slim", help="Write slim per-track tables of the Delphes outputs (analysis/slim.py) and run the analysis and the unbinned resolutions on them", action='store_true')
+parser.add_argument("--unbinned", help="Plots step: unbinned resolutions with bootstrap uncertainties from the Delphes outputs, instead of the analysis histograms", action='store_true')
+parser.add_argument("--tracking_only", help="Run Delphes with a tracking-only variant of the card, derived with analysis/cards.py", action='store_true')
+parser.add_argument("--fastsim", help="Compute analytic resolutions of each card from its tracker geometry (analysis/fastsim.py), shown as card <card>_fastsim in the summary plots", action='store_true')
+parser.add_argument("--force", help="Rerun the requested steps even if their outputs are up to date", action='store_true')
 args = parser.parse_args()
+if any(int(item.split("=")[1]) < 1 for item in args.stage_jobs):
+    parser.error("--stage_jobs limits must be at least 1, a stage without job slots would never run")
+if args.stream and not (args.gun and args.delphes):
+    parser.error("--stream requires --gun and --delphes")
+if args.delphes_card is None:
+    args.delphes_card = [] if args.sweep else ["IDEA_baseline"]
+if args.stream and (args.sweep or len(args.delphes_card) > 1):
+    parser.error("--stream runs the gun for each card, use it with a single card")
+for option in ("target_precision", "refine_tolerance"):
+    if getattr(args, option) and not (args.gun and (args.delphes or args.stream) and (args.analysis or args.unbinned) and args.plots):
+        parser.error(f"--{option} runs all steps in rounds: use it with --gun, --delphes (or --stream), --analysis (unless --unbinned) and --plots")
+if args.target_precision and args.shards > 1:
+    parser.error("--target_precision shards the samples itself, use it without --shards")
+if (args.target_precision or args.refine_tolerance) and args.job_manifest:
+    parser.error("--target_precision and --refine_tolerance need the results of each round, use them without --job_manifest")
 
 current_dir = os.path.abspath(os.getcwd())
 
@@ -46,139 +99,639 @@ pdg_dict = {
     16:  "nu_tau",        -16: "nu_tau_bar",
     17:  "tau'_minus",    -17: "tau'_plus",
     18:  "nu_tau'",       -18: "nu_tau'_bar",
-}
 
-def generate_gun_cards(input_dir, theta_range, mom_range, pid, nevents = 100000, npart = 1, R0=0, z0=0):
-
-    def helper_ranges():
-        for theta in theta_range:
-            for mom in mom_range:
-                yield theta, mom
+    # Hadrons
+    211:  "pi_plus",      -211: "pi_minus",
+    321:  "K_plus",       -321: "K_minus",
+    2212: "proton",       -2212: "antiproton",
+}
+for pid in args.pdg:
+    if pid not in pdg_dict:
+        parser.error(f"--pdg {pid} is not a known particle")
+
+class RunConfig:
+    """
+    Settings of a run shared by the job builders, from the command line arguments: the gun configuration, the
+    output paths, the Delphes cards, the gun/Delphes/analysis units of each sample and the job estimates
+    """
+
+    def __init__(self, args):
+        self.particle_ids = args.pdg
+        # the Muon collection only holds muons: other species are analysed from all tracks, split by their truth PDG id
+        self.split_species = len(self.particle_ids) > 1 or abs(self.particle_ids[0]) != 13
+        self.nevents = args.nevents # number of events
+        self.npart = 1 # particles per event
+        self.R0, self.z0 = 20, 0 # displacement of track
+
+        self.output_base_dir = f"{current_dir}/{args.output_dir}"
+        self.delphes_output = f"{current_dir}/bin/delphes_output_tracking.tcl" if args.tracking_only else f"{current_dir}/bin/delphes_output.tcl"
+        self.delphes_cards = {name: f"{current_dir}/delphes_cards/{name}.tcl" for name in args.delphes_card}
+        self.gun_path = f"{self.output_base_dir}/cards/"
+        self.hepmc_path = f"{self.output_base_dir}/hepmc3/"
+        self.stream_path = f"{self.output_base_dir}/hepmc3_stream/"
+
+        self.sample_units = {} # gun/Delphes/analysis jobs of each sample
+        self.job_events = self.nevents*len(self.particle_ids)*self.npart/args.shards # cost estimate of the jobs
+        # estimated memory per job in MB
+        self.stage_memory = {"gun": 500, "delphes": 1500, "stream": 2000, "slim": 2500, "analysis": 2500, "merge": 500, "plots": 2000, "resolution": 4000}
+        self.stage_memory.update(parse_stage_values(args.stage_memory, int))
+
+
+def format_number(value):
+    """Theta or momentum in sample names: integral values without decimals (10 for 10.0), others as they are (22.3)"""
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+def sample_name(pid, theta, mom):
+    return f"{pdg_dict[pid]}_theta_{format_number(theta)}_p_{format_number(mom)}"
+
+def gun_sample_name(pids, theta, mom):
+    """Name of a gun sample of one or several species, e.g. mu_minus+e_minus_theta_10_p_5"""
+    return f"{'+'.join(pdg_dict[pid] for pid in pids)}_theta_{format_number(theta)}_p_{format_number(mom)}"
+
+def species_samples(config, name):
+    """
+    Analysis outputs of a gun sample or shard, one per species when the samples are split by species:
+    mu_minus_theta_10_p_5 and e_minus_theta_10_p_5 for mu_minus+e_minus_theta_10_p_5
+    """
+    if not config.split_species:
+        return [name]
+    return [f"{pdg_dict[pid]}{name[name.index('_theta_'):]}" for pid in config.particle_ids]
+
+def shard_names(sample_name, nshards):
+    """Names of the jobs a sample is generated in, the sample name itself if it is not sharded"""
+    if nshards == 1:
+        return [sample_name]
+    return [f"{sample_name}_shard{i}" for i in range(nshards)]
+
+def shard_seed(name):
+    """Deterministic seed for a sample or shard, derived from --seed"""
+    return int(hashlib.sha256(f"{args.seed}:{name}".encode()).hexdigest()[:8], 16) or 1
+
+def parse_stage_values(items, value_type):
+    """Parse stage=value command line items"""
+    values = {}
+    for item in items:
+        stage, value = item.split("=")
+        values[stage] = value_type(value)
+    return values
+
+def is_up_to_date(output, digest, key=None):
+    """Check the manifest of a stage output against the digest of its current inputs"""
+    if args.force or not manifest.is_current(output, digest, key):
+        return False
+    print(f"Skipping {key or output}, up to date")
+    return True
+
+# digests of the outputs (re)made or checked in this run
+planned_digests = {}
+
+def plan_output(output, digest, key=None):
+    """Register the digest of an output, returns whether it needs to be (re)made"""
+    planned_digests[os.path.normpath(key or output)] = digest
+    return not is_up_to_date(output, digest, key)
+
+def upstream_digest(path):
+    """Digest of an upstream output: as planned if it is part of this run, as recorded otherwise"""
+    return planned_digests.get(os.path.normpath(path)) or manifest.output_digest(path)
+
+def job_name(config, path):
+    return os.path.relpath(path, config.output_base_dir)
+
+def gun_digest(input_path):
+    """Digest of a gun sample, recorded for its HepMC3 file and used by Delphes also when streaming"""
+    gun_source = f"{current_dir}/analysis/gun.py" if args.native_gun else f"{current_dir}/bin/gunHEPMC3.cpp"
+    return manifest.compute_digest([input_path, gun_source])
+
+def delphes_digest(config, delphes_card, gun_sample_digest):
+    return manifest.compute_digest([delphes_card, config.delphes_output], [gun_sample_digest])
+
+def write_gun_card(filename, name, theta, mom, pids, nevents, first_event=0, npart=1, R0=0, z0=0):
+    with open(filename, 'w') as f:
+        f.write(f"npart {npart}\n")
+        f.write(f"theta_range {float(theta)},{float(theta)}\n")
+        f.write(f"mom_range {float(mom)},{float(mom)}\n")
+        f.write(f"pid_list {','.join(str(pid) for pid in pids)}\n")
+        f.write(f"R0 {R0}\n")
+        f.write(f"z0 {z0}\n")
+        f.write(f"nevents {nevents}\n")
+        f.write(f"seed {shard_seed(name)}\n")
+        f.write(f"first_event {first_event}\n")
+    print(f"Generated {filename}")
+
+def generate_gun_cards(input_dir, points, pids, nevents = 100000, npart = 1, R0=0, z0=0, nshards=1):
+    """Gun cards of the (theta, mom) points, each particle of a species drawn at random from pids"""
 
     def helper_write(theta, mom):
-        filename = os.path.join(input_dir, f"{pdg_dict[pid]}_theta_{theta}_p_{mom}.input")
-        with open(filename, 'w') as f:
-            f.write(f"npart {npart}\n")
-            f.write(f"theta_range {theta}.0,{theta}.0\n")
-            f.write(f"mom_range {mom}.0,{mom}.0\n")
-            f.write(f"pid_list {pid}\n")
-            f.write(f"R0 {R0}\n")
-            f.write(f"z0 {z0}\n")
-            f.write(f"nevents {nevents}\n")
-
-        print(f"Generated {filename}")
+        # each shard gets its own seed and a consecutive range of the events
+        for shard, name in enumerate(shard_names(gun_sample_name(pids, theta, mom), nshards)):
+            first_event = shard*(nevents//nshards) + min(shard, nevents%nshards)
+            shard_nevents = nevents//nshards + (1 if shard < nevents%nshards else 0)
+            write_gun_card(os.path.join(input_dir, f"{name}.input"), name, theta, mom, pids, shard_nevents, first_event, npart, R0, z0)
 
     print("Starting gun generator")
     with concurrent.futures.ThreadPoolExecutor(max_workers=args.nThreads) as pool:
-        for theta, mom in helper_ranges():
+        for theta, mom in points:
             pool.submit(helper_write, theta, mom)
     print(f"All gun input files generated and stored in {input_dir}")
 
 
-def generate_gun_events(samples_directory, hepmcs_directory):
+def delphes_shard_cards(units, delphes_card, cards_dir):
+    """
+    Delphes card per job. Shards get a copy of the card with their own RandomSeed,
+    otherwise all shards would be smeared with the same random sequence
+    """
+    if args.shards == 1 and not args.target_precision:
+        return {unit: delphes_card for unit in units}
+
+    os.makedirs(cards_dir, exist_ok=True)
+    with open(delphes_card) as f:
+        card = f.read()
+    cards = {}
+    for unit in units:
+        seed_line = f"set RandomSeed {shard_seed(f'delphes:{unit}')}"
+        shard_card, n = re.subn(r"^set RandomSeed .*$", seed_line, card, flags=re.M)
+        if n == 0:
+            shard_card = f"{seed_line}\n{card}"
+        cards[unit] = f"{cards_dir}/{unit}.tcl"
+        with open(cards[unit], 'w') as f:
+            f.write(shard_card)
+    return cards
+
+
+def gun_jobs(config, samples, samples_directory, hepmcs_directory):
+    """
+    Generate the stale samples in groups of --gun_group_size input cards (one by default, all with 0) per job,
+    the gun generates the samples of a group with worker threads. Each sample goes to Delphes as soon as its
+    group is generated; larger groups save container startups
+    """
 
     gun_singularity_helper = f"{current_dir}/bin/run_gunHEPMC3_singularity.sh" # gun helper
     gun_exe = f"{current_dir}/bin/gunHEPMC3" # gun executable
 
-    def helper_run(input_path):
-        """
-        $1: directory to cd into (where you want to run the command, so output files go there)
-        $2: command to run (./gunHEPMC3)
-        $3: argument to that command (input file)
-        """
-        try:
-            cmd = [
-                gun_singularity_helper, 
-                hepmcs_directory,
-                gun_exe,
-                input_path
-            ]
-            if args.display_commands:
-                print(' '.join(cmd))
-            else:
-                subprocess.run(cmd, check=True)
-
-        except Exception as e:
-            print(f"Unknown error for {input_path}: {e}")
+    stale = [sample_name for sample_name in samples if plan_output(os.path.join(hepmcs_directory, f"{sample_name}.hepmc"), gun_digest(os.path.join(samples_directory, f"{sample_name}.input")))]
+    group_size = args.gun_group_size or max(len(stale), 1)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.nThreads) as pool:
-        for sample_name in os.listdir(samples_directory):
-            pool.submit(helper_run, os.path.join(samples_directory, sample_name))
+    jobs = []
+    for i in range(0, len(stale), group_size):
+        group = stale[i:i+group_size]
+        inputs = [os.path.join(samples_directory, f"{sample_name}.input") for sample_name in group]
+        outputs = [os.path.join(hepmcs_directory, f"{sample_name}.hepmc") for sample_name in group]
+        nthreads = min(len(group), args.nThreads)
 
-    print(f"All gun HepMC3 files generated and stored in {hepmcs_directory}")
-
-def detector_response(input_dir, output_dir, delphes_card):
-
-    def helper_response(hepmc):
-        filename, _ = os.path.splitext(hepmc)
+        # $1: directory to cd into (where you want to run the command, so output files go there)
+        # $2: command to run (./gunHEPMC3)
+        # $3...: arguments to that command (number of threads, input files)
+        cmd = [
+            gun_singularity_helper,
+            hepmcs_directory,
+            gun_exe,
+            "-j",
+            nthreads,
+            *inputs
+        ]
+        if args.native_gun:
+            cmd = ["python", f"{current_dir}/analysis/gun.py", "-j", nthreads, "--output_dir", hepmcs_directory, *inputs]
+        name = job_name(config, outputs[0]) if len(group) == 1 else f"{job_name(config, outputs[0])}+{len(group)-1}"
+        jobs.append(scheduler.Job(name, "gun", cmd, inputs, outputs, [(output, upstream_digest(output)) for output in outputs], cost=config.job_events*len(group)/nthreads, memory=config.stage_memory["gun"]))
+    return jobs
+
+def delphes_jobs(config, samples, input_dir, output_dir, delphes_cards):
+
+    jobs = []
+    for sample_name in samples:
+        hepmc = f"{input_dir}/{sample_name}.hepmc"
+        output = f"{output_dir}/{sample_name}.root"
+        delphes_card = delphes_cards[sample_name]
+        digest = delphes_digest(config, delphes_card, upstream_digest(hepmc))
+        if not plan_output(output, digest):
+            continue
         cmd = [
             "DelphesHepMC3_EDM4HEP",
             delphes_card,
-            f"{current_dir}/bin/delphes_output.tcl",
-            f"{output_dir}/{filename}.root",
-            f"{input_dir}/{hepmc}"
+            config.delphes_output,
+            output,
+            hepmc
         ]
+        jobs.append(scheduler.Job(job_name(config, output), "delphes", cmd, [hepmc], [output], [(output, digest)], cost=config.job_events, memory=config.stage_memory["delphes"]))
+    return jobs
+
+def stream_jobs(config, samples, samples_directory, stream_directory, output_dir, delphes_cards):
+    """
+    Run gun and Delphes concurrently per sample: the gun writes into a named pipe in stream_directory
+    that Delphes reads, so no HepMC3 file is stored and the Delphes output is ready when the generation ends
+    """
+
+    stream_helper = f"{current_dir}/bin/stream_gun_delphes.sh"
+    gun_exe = f"{current_dir}/bin/gunHEPMC3"
+
+    jobs = []
+    for sample_name in samples:
+        input_path = os.path.join(samples_directory, f"{sample_name}.input")
+        output = f"{output_dir}/{sample_name}.root"
+        delphes_card = delphes_cards[sample_name]
+        digest = delphes_digest(config, delphes_card, gun_digest(input_path))
+        if not plan_output(output, digest):
+            continue
+        cmd = [
+            stream_helper,
+            stream_directory,
+            gun_exe,
+            input_path,
+            delphes_card,
+            config.delphes_output,
+            output
+        ]
+        if args.native_gun:
+            cmd[2] = f"{current_dir}/analysis/gun.py"
+            cmd.append("native")
+        jobs.append(scheduler.Job(job_name(config, output), "stream", cmd, [input_path], [output], [(output, digest)], cost=2*config.job_events, memory=config.stage_memory["stream"]))
+    return jobs
+
+def slim_jobs(config, samples, input_dir, output_dir, slim_script):
+    """One job per sample writing its slim track table, or a single job for all samples with --single_process"""
+
+    scripts_dir = os.path.dirname(slim_script)
+    # the tables depend on the residual definitions of analysis.py only, not on its histograms
+    definitions = manifest.source_digest(f"{scripts_dir}/analysis.py", ["define_residuals", "define_covariances"])
+
+    stale = []
+    for sample_name in samples:
+        digest = manifest.compute_digest([slim_script, f"{scripts_dir}/functions.h"], [upstream_digest(f"{input_dir}/{sample_name}.root")], extra=definitions)
+        if plan_output(f"{output_dir}/{sample_name}.root", digest):
+            stale.append(sample_name)
+
+    inputs = [f"{input_dir}/{sample_name}.root" for sample_name in stale]
+    outputs = [f"{output_dir}/{sample_name}.root" for sample_name in stale]
+    records = [(output, upstream_digest(output)) for output in outputs]
+
+    if args.single_process:
+        if not stale:
+            return []
+        nthreads = min(args.nThreads, os.cpu_count())
+        cmd = [
+            "python",
+            slim_script,
+            "--nThreads",
+            nthreads,
+            "--input",
+            *inputs,
+            "--output",
+            *outputs
+        ]
+        if config.split_species:
+            cmd.append("--all_tracks")
+        return [scheduler.Job(job_name(config, output_dir), "slim", cmd, inputs, outputs, records, cost=config.job_events*len(stale)/nthreads, memory=config.stage_memory["slim"])]
 
-        if args.display_commands:
-            print(' '.join(cmd))
-        else:
-            subprocess.run(cmd, check=True)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.nThreads) as pool:
-        for gun_hepmc in os.listdir(input_dir):
-            pool.submit(helper_response, gun_hepmc)
-
-
-def analyze(input_dir, output_dir, analysis_script):
-
-    def helper_analyze(sample_name):
+    jobs = []
+    for input_file, output, record in zip(inputs, outputs, records):
+        cmd = [
+            "python",
+            slim_script,
+            "--nThreads",
+            1,
+            "--input",
+            input_file,
+            "--output",
+            output
+        ]
+        if config.split_species:
+            cmd.append("--all_tracks")
+        jobs.append(scheduler.Job(job_name(config, output), "slim", cmd, [input_file], [output], [record], cost=config.job_events, memory=config.stage_memory["slim"]))
+    return jobs
+
+def analysis_jobs(config, samples, input_dir, output_dir, analysis_script):
+    """
+    One analysis job per sample, or a single job for all samples with --single_process.
+    Samples of several species are split into one output per species (see species_samples)
+    """
+
+    functions_header = f"{os.path.dirname(analysis_script)}/functions.h"
+
+    stale = []
+    for sample_name in samples:
+        digest = manifest.compute_digest([analysis_script, functions_header], [upstream_digest(f"{input_dir}/{sample_name}.root")])
+        if any([plan_output(f"{output_dir}/{species}.root", digest) for species in species_samples(config, sample_name)]):
+            stale.append(sample_name)
+
+    inputs = [f"{input_dir}/{sample_name}.root" for sample_name in stale]
+    outputs = [[f"{output_dir}/{species}.root" for species in species_samples(config, sample_name)] for sample_name in stale]
+    records = [[(output, upstream_digest(output)) for output in sample_outputs] for sample_outputs in outputs]
+    species_args = ["--pdg", *config.particle_ids] if config.split_species else []
+
+    if args.single_process:
+        if not stale:
+            return []
+        nthreads = min(args.nThreads, os.cpu_count())
+        all_outputs = [output for sample_outputs in outputs for output in sample_outputs]
         cmd = [
             "python",
             analysis_script,
+            "--nThreads",
+            nthreads,
             "--input",
-            f"{input_dir}/{sample_name}",
+            *inputs,
             "--output",
-            f"{output_dir}/{sample_name}"
+            *all_outputs,
+            *species_args
         ]
+        if args.slim:
+            cmd.append("--slim")
+        return [scheduler.Job(job_name(config, output_dir), "analysis", cmd, inputs, all_outputs, [record for sample_records in records for record in sample_records], cost=config.job_events*len(stale)/nthreads, memory=config.stage_memory["analysis"])]
 
-        if args.display_commands:
-            print(' '.join(cmd))
-        else:
-            subprocess.run(cmd, check=True)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.nThreads) as pool:
-        for sample_name in os.listdir(input_dir):
-            pool.submit(helper_analyze, sample_name)
-
-
-def plot(input_dir, output_dir, plots_script):
-
-    def helper_plot(sample_name):
-        sample_name = sample_name.replace(".root", "")
-        for hist_name, hist_type in zip(["RP_TRK_D0_um", "RP_TRK_Z0_um", "muon_res_p", "muon_res_k"], ["d0", "z0", "p", "k"]):
-            cmd = [
-                "python",
-                plots_script,
-                "--input",
-                f"{input_dir}/{sample_name}.root",
-                "--output",
-                f"{output_dir}/{hist_type}_{sample_name}",
-                "--histName",
-                hist_name,
-                "--type",
-                hist_type
-            ]
-
-            if args.display_commands:
-                print(' '.join(cmd))
+    jobs = []
+    for input_file, sample_outputs, sample_records in zip(inputs, outputs, records):
+        cmd = [
+            "python",
+            analysis_script,
+            "--input",
+            input_file,
+            "--output",
+            *sample_outputs,
+            *species_args
+        ]
+        if args.slim:
+            cmd.append("--slim")
+        jobs.append(scheduler.Job(job_name(config, sample_outputs[0]), "analysis", cmd, [input_file], sample_outputs, sample_records, cost=config.job_events, memory=config.stage_memory["analysis"]))
+    return jobs
+
+def merge_jobs(config, samples, analysis_dir):
+    """Merge the analysis histograms of the shards of each sample (and species) into the sample output"""
+
+    jobs = []
+    for sample_name in samples:
+        for i, species in enumerate(species_samples(config, sample_name)):
+            inputs = [f"{analysis_dir}/{species_samples(config, unit)[i]}.root" for unit in config.sample_units[sample_name]]
+            output = f"{analysis_dir}/{species}.root"
+            digest = manifest.compute_digest(upstream=[upstream_digest(input_file) for input_file in inputs])
+            if not plan_output(output, digest):
+                continue
+            cmd = ["hadd", "-f", output, *inputs]
+            jobs.append(scheduler.Job(job_name(config, output), "merge", cmd, inputs, [output], [(output, digest)], memory=config.stage_memory["merge"]))
+    return jobs
+
+def plot_jobs(config, samples, input_dir, output_dir, plots_script, card_name):
+    """A single batch job extracting the resolutions of all stale samples into the results table"""
+
+    table = results.results_path(output_dir)
+
+    # results of all samples go into a single table, manifests are kept per sample
+    stale = []
+    for sample_name in samples:
+        digest = manifest.compute_digest([plots_script, f"{os.path.dirname(plots_script)}/results.py"], [upstream_digest(f"{input_dir}/{sample_name}.root")])
+        if plan_output(table, digest, key=f"{output_dir}/{sample_name}"):
+            stale.append(sample_name)
+    if not stale:
+        return []
+
+    inputs = [f"{input_dir}/{sample_name}.root" for sample_name in stale]
+    nthreads = min(args.nThreads, os.cpu_count())
+    cmd = [
+        "python",
+        plots_script,
+        "--batch",
+        "--card",
+        card_name,
+        "--nThreads",
+        nthreads,
+        "--output",
+        output_dir,
+        "--input",
+        *inputs
+    ]
+    records = [(f"{output_dir}/{sample_name}", upstream_digest(f"{output_dir}/{sample_name}")) for sample_name in stale]
+    return [scheduler.Job(job_name(config, table), "plots", cmd, inputs, [table], records, cost=len(stale)/nthreads, memory=config.stage_memory["plots"])]
+
+def resolution_jobs(config, samples, input_dir, output_dir, resolution_script, card_name):
+    """A single job computing the unbinned resolutions of all stale samples from their Delphes outputs"""
+
+    table = results.results_path(output_dir)
+    scripts_dir = os.path.dirname(resolution_script)
+    scripts = [resolution_script, f"{scripts_dir}/analysis.py", f"{scripts_dir}/functions.h", f"{scripts_dir}/results.py"]
+
+    stale = []
+    for sample_name in samples:
+        inputs = [f"{input_dir}/{unit}.root" for unit in config.sample_units[sample_name]]
+        digest = manifest.compute_digest(scripts, [upstream_digest(input_file) for input_file in inputs])
+        if plan_output(table, digest, key=f"{output_dir}/{sample_name}"):
+            stale.append(sample_name)
+    if not stale:
+        return []
+
+    inputs = [f"{input_dir}/{unit}.root" for sample_name in stale for unit in config.sample_units[sample_name]]
+    nthreads = min(args.nThreads, os.cpu_count())
+    cmd = [
+        "python",
+        resolution_script,
+        "--card",
+        card_name,
+        "--nThreads",
+        nthreads,
+        "--seed",
+        args.seed,
+        "--output",
+        output_dir,
+        "--input",
+        *inputs
+    ]
+    if args.slim:
+        cmd.append("--slim")
+    if config.split_species:
+        cmd += ["--pdg", *config.particle_ids]
+    records = [(f"{output_dir}/{sample_name}", upstream_digest(f"{output_dir}/{sample_name}")) for sample_name in stale]
+    return [scheduler.Job(job_name(config, table), "resolution", cmd, inputs, [table], records, cost=config.job_events*len(stale)/nthreads, memory=config.stage_memory["resolution"])]
+
+def run_jobs(config, jobs):
+    """Run the jobs of all requested steps as one dependency graph, returns the failed jobs"""
+    memory_budget = args.memory if args.memory is not None else scheduler.available_memory()
+    log_path = args.job_log or f"{config.output_base_dir}/job_log.jsonl"
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    sched = scheduler.Scheduler(args.nThreads, parse_stage_values(args.stage_jobs, int), memory_budget, args.retries, dry_run=args.display_commands, log_path=log_path)
+    return sched.run(jobs)
+
+def step_jobs(config, samples, units):
+    """Jobs of the requested steps for the given gun/Delphes/analysis units of the samples, for all cards"""
+
+    jobs = []
+    if args.gun and not args.stream:
+        os.makedirs(config.hepmc_path, exist_ok=True)
+        jobs += gun_jobs(config, units, config.gun_path, config.hepmc_path)
+
+    # the gun samples are shared, the Delphes jobs of all cards start as soon as their sample is generated
+    for delphes_card_name, delphes_card in config.delphes_cards.items():
+        delphes_path = f"{config.output_base_dir}/delphes_{delphes_card_name}/"
+        analysis_path = f"{config.output_base_dir}/analysis_{delphes_card_name}/"
+        slim_path = f"{config.output_base_dir}/slim_{delphes_card_name}/"
+        tracks_path = slim_path if args.slim else delphes_path # inputs of the analysis and of the unbinned resolutions
+        plots_path = f"{config.output_base_dir}/plots_{delphes_card_name}/"
+
+        if args.stream:
+            os.makedirs(config.stream_path, exist_ok=True)
+            os.makedirs(delphes_path, exist_ok=True)
+            shard_cards = delphes_shard_cards(units, delphes_card, f"{delphes_path}/cards")
+            jobs += stream_jobs(config, units, config.gun_path, config.stream_path, delphes_path, shard_cards)
+        elif args.delphes:
+            os.makedirs(delphes_path, exist_ok=True)
+            shard_cards = delphes_shard_cards(units, delphes_card, f"{delphes_path}/cards")
+            jobs += delphes_jobs(config, units, config.hepmc_path, delphes_path, shard_cards)
+
+        if args.slim and (args.analysis or (args.plots and args.unbinned)):
+            os.makedirs(slim_path, exist_ok=True)
+            jobs += slim_jobs(config, units, delphes_path, slim_path, f"{current_dir}/analysis/slim.py")
+
+        if args.analysis:
+            os.makedirs(analysis_path, exist_ok=True)
+            analysis_script = f"{current_dir}/analysis/analysis.py"
+            jobs += analysis_jobs(config, units, tracks_path, analysis_path, analysis_script)
+            if any(config.sample_units[sample_name] != [sample_name] for sample_name in samples):
+                jobs += merge_jobs(config, samples, analysis_path)
+
+        if args.plots and args.unbinned:
+            os.makedirs(plots_path, exist_ok=True)
+            resolution_script = f"{current_dir}/analysis/resolution.py"
+            jobs += resolution_jobs(config, samples, tracks_path, plots_path, resolution_script, delphes_card_name)
+        elif args.plots:
+            os.makedirs(plots_path, exist_ok=True)
+            plots_script = f"{current_dir}/analysis/plots.py"
+            jobs += plot_jobs(config, [species for sample_name in samples for species in species_samples(config, sample_name)], analysis_path, plots_path, plots_script, delphes_card_name)
+    return jobs
+
+def relative_uncertainties(config, samples):
+    """Largest relative uncertainty of the quantile width of the target observables over all cards and species, per sample"""
+    worst = {sample_name: 0. for sample_name in samples}
+    for delphes_card_name in config.delphes_cards:
+        table_path = results.results_path(f"{config.output_base_dir}/plots_{delphes_card_name}/")
+        table = results.read_table(table_path) if os.path.exists(table_path) else None
+        for sample_name in samples:
+            for species in species_samples(config, sample_name):
+                particle, theta, p = results.parse_sample(species)
+                for observable in args.target_observables:
+                    try:
+                        res = results.lookup(table, "res_quantile", card=delphes_card_name, particle=particle, theta=theta, p=p, observable=observable)
+                        err = results.lookup(table, "res_quantile_err", card=delphes_card_name, particle=particle, theta=theta, p=p, observable=observable)
+                        relative = err/abs(res) if res else math.inf
+                    except (KeyError, TypeError): # no table or no row yet
+                        relative = math.inf
+                    worst[sample_name] = max(worst[sample_name], relative if math.isfinite(relative) else math.inf)
+    return worst
+
+def adaptive_batches(config, grid):
+    """
+    Run the requested steps in rounds of event batches until the quantile widths of the target observables of
+    each sample are known to --target_precision, or --nevents are generated. Each batch is a shard of its sample,
+    with its own seed and event range, and the analysis histograms of the batches are merged after each round.
+    The next batch of a sample is sized from the 1/sqrt(N) scaling of its current uncertainty
+    """
+    os.makedirs(config.gun_path, exist_ok=True)
+    events = {sample_name: 0 for sample_name in grid}
+    batch = {sample_name: min(args.batch_events, args.nevents) for sample_name in grid}
+    for sample_name in grid:
+        config.sample_units[sample_name] = []
+
+    rounds = 0
+    while batch:
+        units = []
+        for sample_name, n in batch.items():
+            unit = f"{sample_name}_shard{len(config.sample_units[sample_name])}"
+            theta, mom = grid[sample_name]
+            # n events per species
+            write_gun_card(os.path.join(config.gun_path, f"{unit}.input"), unit, theta, mom, config.particle_ids, n*len(config.particle_ids), events[sample_name]*len(config.particle_ids), config.npart, config.R0, config.z0)
+            config.sample_units[sample_name].append(unit)
+            events[sample_name] += n
+            units.append(unit)
+        config.job_events = max(batch.values())*config.npart*len(config.particle_ids)
+        print(f"Round {rounds}: {sum(batch.values())} events for {len(batch)} sample(s)")
+        if run_jobs(config, step_jobs(config, list(batch), units)):
+            sys.exit(1)
+        rounds += 1
+        if args.display_commands: # nothing was run, so there are no uncertainties to go on
+            break
+
+        precision = relative_uncertainties(config, batch)
+        next_batch = {}
+        for sample_name in batch:
+            status = f"{sample_name}: relative uncertainty {precision[sample_name]:.2%} with {events[sample_name]} events"
+            if precision[sample_name] <= args.target_precision:
+                print(f"{status}, target reached")
+            elif events[sample_name] >= args.nevents:
+                print(f"{status}, maximum of {args.nevents} events reached")
             else:
-                subprocess.run(cmd, check=True)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.nThreads) as pool:
-        for sample_name in os.listdir(input_dir):
-            pool.submit(helper_plot, sample_name)
-
-def plot_summary(plots_path, theta_ranges, mom_ranges, hist_type):
+                # with a 10% margin, so that most samples converge in the next round
+                needed = 1.1*events[sample_name]*(precision[sample_name]/args.target_precision)**2 if math.isfinite(precision[sample_name]) else 2*events[sample_name]
+                next_batch[sample_name] = min(max(math.ceil(needed) - events[sample_name], args.batch_events), args.nevents - events[sample_name])
+                print(f"{status}, {next_batch[sample_name]} more")
+        batch = next_batch
+
+    total = sum(events.values())
+    print(f"Generated {total} events in {rounds} round(s), {total/(len(grid)*args.nevents):.0%} of {args.nevents} events per sample")
+
+def run_grid(config, grid):
+    """Run the requested steps on the samples of grid, {sample name: (theta, mom)}"""
+    if args.target_precision:
+        # samples are generated in batches until their resolutions are precise enough
+        adaptive_batches(config, grid)
+        return
+
+    samples = list(grid)
+    for sample in samples:
+        config.sample_units[sample] = shard_names(sample, args.shards)
+    units = [unit for sample in samples for unit in config.sample_units[sample]]
+    if args.gun:
+        os.makedirs(config.gun_path, exist_ok=True)
+        generate_gun_cards(config.gun_path, grid.values(), pids=config.particle_ids, nevents=config.nevents*len(config.particle_ids), npart=config.npart, R0=config.R0, z0=config.z0, nshards=args.shards)
+    jobs = step_jobs(config, samples, units)
+
+    # the jobs can also be handed to worker agents on several nodes, the summary plots are made after they are done
+    if args.job_manifest:
+        scheduler.write_job_manifest(jobs, args.job_manifest)
+        print(f"Wrote {len(jobs)} jobs to {args.job_manifest}, run them with: python analysis/worker.py {args.job_manifest}")
+        sys.exit(0)
+
+    # all requested steps run as one graph: each sample moves on as soon as its upstream job is done
+    if run_jobs(config, jobs):
+        sys.exit(1)
+
+def refine_grid(config, grid):
+    """
+    New points of the summary curves (resolution vs cos(theta) per momentum, log scale as plotted) where linear
+    interpolation is not good enough: an interval is split at its midpoint in cos(theta) if a parabola through it
+    and a neighbouring point deviates there from the straight line by more than --refine_tolerance (relative), for any
+    species. Returns {sample name: (theta, mom)} of the new points, theta rounded to 0.1 degree
+    """
+    points = {}
+    for delphes_card_name in config.delphes_cards:
+        table_path = results.results_path(f"{config.output_base_dir}/plots_{delphes_card_name}/")
+        if not os.path.exists(table_path):
+            continue
+        table = results.read_table(table_path)
+        for mom in dict.fromkeys(mom for _, mom in grid.values()):
+            thetas = sorted(theta for theta, p in grid.values() if p == mom)
+            # the curves of all species, a point is added to the gun samples of all of them
+            for pid in config.particle_ids:
+                for observable in ["d0", "z0", "p", "k"]:
+                    curve = []
+                    for theta in thetas:
+                        try:
+                            res = results.lookup(table, "res_quantile", card=delphes_card_name, particle=pdg_dict[pid], theta=theta, p=mom, observable=observable)
+                        except KeyError:
+                            continue
+                        if res > 0:
+                            curve.append((math.cos(math.radians(theta)), math.log(res), theta))
+                    for j in range(len(curve) - 1):
+                        (x0, y0, theta0), (x1, y1, theta1) = curve[j], curve[j+1]
+                        xm = 0.5*(x0 + x1)
+                        deviation = 0.
+                        for x2, y2, _ in curve[max(j-1, 0):j] + curve[j+2:j+3]:
+                            # parabola through the three points at the midpoint, minus the straight line
+                            quadratic = y0*(xm - x1)*(xm - x2)/((x0 - x1)*(x0 - x2)) + y1*(xm - x0)*(xm - x2)/((x1 - x0)*(x1 - x2)) + y2*(xm - x0)*(xm - x1)/((x2 - x0)*(x2 - x1))
+                            deviation = max(deviation, abs(quadratic - 0.5*(y0 + y1)))
+                        theta = round(math.degrees(math.acos(xm)), 1)
+                        if math.expm1(deviation) > args.refine_tolerance and abs(theta1 - theta0) >= 2*args.refine_min_step:
+                            name = gun_sample_name(config.particle_ids, theta, mom)
+                            if name not in grid:
+                                points[name] = (theta, mom)
+    return points
+
+def plot_summary(config, plots_path, card_name, grid, hist_type, pid):
 
     xmin, xmax = 0, 1
     ymin, ymax = 9e99, -9e99
@@ -218,10 +771,14 @@ def plot_summary(plots_path, theta_ranges, mom_ranges, hist_type):
     legend.SetFillStyle(0)
     legend.SetTextSize(0.03)
     legend.SetMargin(0.2)
-    legend.SetHeader(f"Delphes {delphes_card_name}")
+    legend.SetHeader(f"Delphes {card_name}, {pdg_dict[pid]}" if config.split_species else f"Delphes {card_name}")
+
+    table = results.read_table(results.results_path(plots_path))
+    particle = pdg_dict[pid]
 
     colors = [ROOT.kBlack, ROOT.kRed, ROOT.kBlue, ROOT.kGreen+2, ROOT.kMagenta+1]
     graphs = []
+    mom_ranges = list(dict.fromkeys(mom for _, mom in grid.values()))
     for i,mom in enumerate(mom_ranges):
         g = ROOT.TGraph()
         g.SetName(f"mom{mom}")
@@ -233,16 +790,14 @@ def plot_summary(plots_path, theta_ranges, mom_ranges, hist_type):
         g.SetTitle(f"p = {mom} GeV")
         legend.AddEntry(g, f"p = {mom} GeV", "LP")
 
+        theta_ranges = sorted(theta for theta, p in grid.values() if p == mom) # refined grids differ per momentum
         for j,theta in enumerate(theta_ranges):
             cost = math.cos(theta*math.pi/180.)
-            res = -9e99
-            with open(f"{plots_path}/{hist_type}_{pdg_dict[particle_id]}_theta_{theta}_p_{mom}.json") as json_file:
-                data = json.load(json_file)
-                res = data['res_quantile']
-                if res < ymin and res != 0:
-                    ymin = res
-                if res > ymax and res != 0:
-                    ymax = res
+            res = results.lookup(table, 'res_quantile', card=card_name, particle=particle, theta=theta, p=mom, observable=hist_type)
+            if res < ymin and res != 0:
+                ymin = res
+            if res > ymax and res != 0:
+                ymax = res
             g.SetPoint(j, cost, res)
         graphs.append(g)
         g.Draw("LP SAME")
@@ -256,63 +811,85 @@ def plot_summary(plots_path, theta_ranges, mom_ranges, hist_type):
 
     legend.Draw()
 
+    # one set of plots per species when the samples are split by species
+    name = f"{particle}_{hist_type}_vs_theta" if config.split_species else f"{hist_type}_vs_theta"
     c.Update()
-    c.SaveAs(f"{plots_path}/{hist_type}_vs_theta.png")
-    c.SaveAs(f"{plots_path}/{hist_type}_vs_theta.pdf")
+    c.SaveAs(f"{plots_path}/{name}.png")
+    c.SaveAs(f"{plots_path}/{name}.pdf")
 
-    fOut = ROOT.TFile(f"{plots_path}/{hist_type}_vs_theta.root", "RECREATE")
+    fOut = ROOT.TFile(f"{plots_path}/{name}.root", "RECREATE")
     for g in graphs:
         g.Write()
     fOut.Close()
 
 if __name__ == "__main__":
 
-    # configuration of the gun
-    theta_ranges = [10, 20, 30, 40, 50, 60, 70, 80, 90]
-    mom_ranges = [5, 10, 50, 100]
-    R0, z0 = 20, 0 # displacement of track
-    particle_id = 13
-    nevents = 100000 # number of events
-    npart = 1 # particles per event
-
-    output_base_dir = f"{current_dir}/{args.output_dir}"
-    delphes_card_name = args.delphes_card
-    delphes_card = f"{current_dir}/delphes_cards/{delphes_card_name}.tcl"
-    if not delphes_card:
-        print(f"ERROR: Delphes card {delphes_card_name} does not exist")
-        quit()
-
-    gun_path = f"{output_base_dir}/cards/"
-    hepmc_path = f"{output_base_dir}/hepmc3/"
-    delphes_path = f"{output_base_dir}/delphes_{delphes_card_name}/"
-    analysis_path = f"{output_base_dir}/analysis_{delphes_card_name}/"
-    plots_path = f"{output_base_dir}/plots_{delphes_card_name}/"
-
-    if args.gun:
-        os.makedirs(gun_path, exist_ok=True)
-        os.makedirs(hepmc_path, exist_ok=True)
-        generate_gun_cards(gun_path, theta_range=theta_ranges, mom_range=mom_ranges, pid=particle_id, nevents=nevents, npart=npart, R0=R0, z0=z0)
-        generate_gun_events(gun_path, hepmc_path)
-
-    if args.delphes:
-        os.makedirs(delphes_path, exist_ok=True)
-        detector_response(hepmc_path, delphes_path, delphes_card)
-
-
-    if args.analysis:
-        os.makedirs(analysis_path, exist_ok=True)
-        analysis_script = f"{current_dir}/analysis/analysis.py"
-        analyze(delphes_path, analysis_path, analysis_script)
-
-    if args.plots:
-        os.makedirs(plots_path, exist_ok=True)
-        plots_script = f"{current_dir}/analysis/plots.py"
-        plot(analysis_path, plots_path, plots_script)
+    config = RunConfig(args)
+    output_base_dir = config.output_base_dir
+
+    # Delphes cards: the given cards and the variants of a sweep, all run on the same gun samples
+    if args.sweep:
+        config.delphes_cards.update(cards.write_sweep(args.sweep, f"{current_dir}/delphes_cards", f"{output_base_dir}/cards_sweep"))
+    for delphes_card_name, delphes_card in config.delphes_cards.items():
+        if not os.path.exists(delphes_card):
+            print(f"ERROR: Delphes card {delphes_card_name} does not exist")
+            quit()
+
+    # tracking-only cards: only the modules needed for the tracks, muons and MC particles used by the analysis
+    if args.tracking_only:
+        os.makedirs(f"{output_base_dir}/cards_tracking", exist_ok=True)
+        tracking_cards = {}
+        for delphes_card_name, delphes_card in config.delphes_cards.items():
+            with open(delphes_card) as f:
+                card = cards.tracking_card(cards.parse_card(f.read()))
+            tracking_cards[f"{delphes_card_name}_tracking"] = f"{output_base_dir}/cards_tracking/{delphes_card_name}_tracking.tcl"
+            with open(tracking_cards[f"{delphes_card_name}_tracking"], "w") as f:
+                f.write(card.to_text())
+        config.delphes_cards = tracking_cards
+
+    grid = {gun_sample_name(config.particle_ids, theta, mom): (theta, mom) for theta in args.theta for mom in args.mom}
+
+    run_grid(config, grid)
+
+    # new points where the summary curves are not smooth yet, run the same way as the initial grid
+    for refinement in range(args.refine_rounds if args.refine_tolerance and not args.display_commands else 0):
+        points = refine_grid(config, grid)
+        if not points:
+            break
+        print(f"Refinement {refinement+1}: {len(points)} new point(s): {', '.join(points)}")
+        grid.update(points)
+        run_grid(config, points)
+
+    # analytic resolutions from the tracker geometry, seconds for the whole grid so always recomputed
+    summary_cards = list(config.delphes_cards)
+    if args.fastsim:
+        for delphes_card_name, delphes_card in config.delphes_cards.items():
+            print(f"Fast simulation of {delphes_card_name}")
+            fastsim_path = f"{output_base_dir}/plots_{delphes_card_name}{fastsim.FASTSIM_SUFFIX}/"
+            if not args.display_commands:
+                for pid in config.particle_ids:
+                    fastsim.fastsim_card(delphes_card, delphes_card_name, fastsim_path, pdg_dict[pid], sorted({theta for theta, _ in grid.values()}), sorted({mom for _, mom in grid.values()}), config.R0*1e-3)
+            summary_cards.append(f"{delphes_card_name}{fastsim.FASTSIM_SUFFIX}")
+
+    # per-sample plots are only drawn on request, the plots step only writes the numbers
+    if args.render is not None and not args.display_commands:
+        for delphes_card_name in config.delphes_cards:
+            analysis_path = f"{output_base_dir}/analysis_{delphes_card_name}/"
+            plots_path = f"{output_base_dir}/plots_{delphes_card_name}/"
+            species = [s for sample_name in grid for s in species_samples(config, sample_name)]
+            selected = [s for s in species if not args.render or any(fnmatch.fnmatch(s, pattern) for pattern in args.render)]
+            inputs = [f"{analysis_path}/{s}.root" for s in selected if os.path.exists(f"{analysis_path}/{s}.root")]
+            if len(inputs) < len(selected):
+                print(f"No analysis output for {len(selected) - len(inputs)} sample(s) of {delphes_card_name}, not drawn")
+            os.makedirs(plots_path, exist_ok=True)
+            plots.render(inputs, plots_path, pdf=None if args.render else f"{plots_path}/resolutions.pdf")
 
     if args.summary_plots:
-        os.makedirs(plots_path, exist_ok=True)
-        plot_summary(plots_path, theta_ranges, mom_ranges, 'd0')
-        plot_summary(plots_path, theta_ranges, mom_ranges, 'z0')
-        plot_summary(plots_path, theta_ranges, mom_ranges, 'p')
-        plot_summary(plots_path, theta_ranges, mom_ranges, 'k')
-
+        for delphes_card_name in summary_cards:
+            plots_path = f"{output_base_dir}/plots_{delphes_card_name}/"
+            os.makedirs(plots_path, exist_ok=True)
+            for pid in config.particle_ids:
+                plot_summary(config, plots_path, delphes_card_name, grid, 'd0', pid)
+                plot_summary(config, plots_path, delphes_card_name, grid, 'z0', pid)
+                plot_summary(config, plots_path, delphes_card_name, grid, 'p', pid)
+                plot_summary(config, plots_path, delphes_card_name, grid, 'k', pid)
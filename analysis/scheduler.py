@@ -0,0 +1,294 @@
+import argparse
+import concurrent.futures
+import heapq
+import json
+import os
+import subprocess
+import time
+
+import manifest
+
+
+class Job:
+    """A command of the pipeline, with the files it reads and writes"""
+
+    def __init__(self, name, stage, cmd, inputs=(), outputs=(), records=(), cost=1.0, memory=0):
+        self.name = name
+        self.stage = stage
+        self.cmd = [str(c) for c in cmd]
+        self.inputs = [os.path.normpath(i) for i in inputs]
+        self.outputs = [os.path.normpath(o) for o in outputs]
+        self.records = list(records) # (manifest key, digest) pairs recorded when the job succeeds
+        self.cost = cost # estimated run time (arbitrary units), the longest chains are started first
+        self.memory = memory # estimated memory in MB
+        self.deps = set()
+        self.attempts = 0
+        self.status = "pending"
+
+
+def resolve_dependencies(jobs):
+    """A job depends on the jobs producing its inputs"""
+    producers = {output: job.name for job in jobs for output in job.outputs}
+    for job in jobs:
+        job.deps = {producers[i] for i in job.inputs if i in producers and producers[i] != job.name}
+
+def dependents(jobs):
+    children = {job.name: [] for job in jobs}
+    for job in jobs:
+        for dep in job.deps:
+            children[dep].append(job.name)
+    return children
+
+def upward_ranks(jobs):
+    """Cost of the longest chain from each job to the end of the pipeline"""
+    children = dependents(jobs)
+    ranks = {}
+    for job in topological_order(jobs)[::-1]:
+        ranks[job.name] = job.cost + max((ranks[child] for child in children[job.name]), default=0)
+    return ranks
+
+def topological_order(jobs):
+    by_name = {job.name: job for job in jobs}
+    indegree = {job.name: len(job.deps) for job in jobs}
+    children = dependents(jobs)
+    order = []
+    queue = [job.name for job in jobs if indegree[job.name] == 0]
+    while queue:
+        name = queue.pop(0)
+        order.append(by_name[name])
+        for child in children[name]:
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                queue.append(child)
+    if len(order) != len(jobs):
+        raise ValueError("Dependency cycle between jobs")
+    return order
+
+def available_memory():
+    """MemAvailable in MB, None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def critical_path(records):
+    """
+    Longest chain of dependent jobs by their measured wall time, from the last attempt of each job in the log.
+    Returns the jobs on the path and its total time
+    """
+    last = {}
+    for record in sorted(records, key=lambda r: r["start"]): # a job starts after its dependencies end
+        last[record["name"]] = record
+    finish, previous = {}, {}
+    for name, record in last.items():
+        deps = [dep for dep in record["deps"] if dep in finish]
+        previous[name] = max(deps, key=lambda dep: finish[dep], default=None)
+        finish[name] = record["wall"] + (finish[previous[name]] if previous[name] else 0.)
+    if not finish:
+        return [], 0.
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name:
+        path.append(last[name])
+        name = previous[name]
+    return path[::-1], total
+
+def report(records, top=10):
+    """Print the per-stage totals, the slowest jobs and the critical path of a job log"""
+    elapsed = max(r["end"] for r in records) - min(r["start"] for r in records)
+    print(f"{len(records)} job attempt(s) in {elapsed:.1f} s")
+    print(f"{'stage':12} {'jobs':>5} {'wall (s)':>10} {'CPU (s)':>10} {'max RSS (MB)':>13} {'read (MB)':>10} {'written (MB)':>13}")
+    stages = {}
+    for r in records:
+        stages.setdefault(r["stage"], []).append(r)
+    for stage, rs in stages.items():
+        print(f"{stage:12} {len(rs):5d} {sum(r['wall'] for r in rs):10.1f} {sum(r.get('cpu', 0.) for r in rs):10.1f} "
+              f"{max(r.get('max_rss_mb', 0.) for r in rs):13.0f} {sum(r.get('read_bytes', 0) for r in rs)/1e6:10.1f} {sum(r.get('write_bytes', 0) for r in rs)/1e6:13.1f}")
+    print("Slowest jobs:")
+    for r in sorted(records, key=lambda r: -r["wall"])[:top]:
+        print(f"  {r['wall']:8.1f} s  {r['name']} ({r['stage']}, {r.get('cpu', 0.):.1f} s CPU, {r.get('max_rss_mb', 0.):.0f} MB)")
+    path, total = critical_path(records)
+    print(f"Critical path: {total:.1f} s of {elapsed:.1f} s elapsed")
+    for r in path:
+        print(f"  {r['wall']:8.1f} s  {r['name']}")
+
+
+class Scheduler:
+    """
+    Runs jobs as soon as their dependencies are done, so samples flow through the stages independently.
+    max_jobs: total number of concurrent jobs
+    stage_limits: maximum number of concurrent jobs per stage
+    memory_budget: total estimated memory (MB) of the concurrent jobs
+    retries: number of times a failed job is retried, its dependents are skipped if it keeps failing
+    log_path: JSON lines file the resource usage of every job attempt is appended to
+    """
+
+    def __init__(self, max_jobs, stage_limits=None, memory_budget=None, retries=0, dry_run=False, log_path=None):
+        self.max_jobs = max_jobs
+        self.stage_limits = stage_limits or {}
+        self.memory_budget = memory_budget
+        self.retries = retries
+        self.dry_run = dry_run
+        self.log_path = log_path
+
+    def execute(self, job):
+        """
+        Run the command of a job, returns its exit code and resource usage: wall and CPU time (s), peak RSS (MB)
+        and bytes read from and written to disk, of the job and all its child processes (from wait4)
+        """
+        start = time.time()
+        try:
+            process = subprocess.Popen(job.cmd)
+            _, status, rusage = os.wait4(process.pid, 0)
+            returncode = os.waitstatus_to_exitcode(status)
+            # the child is reaped: Popen must not wait for its pid again, which may by now belong to another job
+            process.returncode = returncode
+        except Exception as e:
+            print(f"Error running {job.name}: {e}")
+            return -1, {"start": start, "end": time.time(), "wall": time.time() - start}
+        end = time.time()
+        return returncode, {"start": start, "end": end, "wall": end - start, "cpu": rusage.ru_utime + rusage.ru_stime,
+                            "max_rss_mb": rusage.ru_maxrss/1024, "read_bytes": rusage.ru_inblock*512, "write_bytes": rusage.ru_oublock*512}
+
+    def log(self, job, returncode, usage):
+        """Append a job attempt to the log"""
+        entry = {"name": job.name, "stage": job.stage, "attempt": job.attempts, "returncode": returncode, "deps": sorted(job.deps), **usage}
+        job.usage = usage
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def fits(self, job, running):
+        stage_running = sum(1 for j in running.values() if j.stage == job.stage)
+        if stage_running >= self.stage_limits.get(job.stage, self.max_jobs):
+            return False
+        if self.memory_budget is not None and running:
+            if sum(j.memory for j in running.values()) + job.memory > self.memory_budget:
+                return False
+        return True
+
+    def run(self, jobs):
+        """Run all jobs, returns the list of failed jobs (their dependents are marked as skipped)"""
+        resolve_dependencies(jobs)
+        if self.dry_run:
+            for job in topological_order(jobs):
+                print(' '.join(job.cmd))
+            return []
+
+        by_name = {job.name: job for job in jobs}
+        ranks = upward_ranks(jobs)
+        children = dependents(jobs)
+        waiting = {job.name: len(job.deps) for job in jobs}
+        ready = [(-ranks[job.name], job.name) for job in jobs if not job.deps]
+        heapq.heapify(ready)
+        running = {}
+        failed = []
+        log = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs) as pool:
+            while ready or running:
+                # start the highest ranked ready jobs that fit within the limits
+                deferred = []
+                while ready and len(running) < self.max_jobs:
+                    item = heapq.heappop(ready)
+                    job = by_name[item[1]]
+                    if self.fits(job, running):
+                        job.attempts += 1
+                        job.status = "running"
+                        print(f"Starting {job.name} (attempt {job.attempts})")
+                        running[pool.submit(self.execute, job)] = job
+                    else:
+                        deferred.append(item)
+                for item in deferred:
+                    heapq.heappush(ready, item)
+                if not running:
+                    # the remaining ready jobs can never fit the limits: they fail rather than pass as done
+                    for _, name in ready:
+                        job = by_name[name]
+                        job.status = "failed"
+                        failed.append(job)
+                        print(f"Failed {job.name} (it does not fit the limits of stage {job.stage})")
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    returncode, usage = future.result()
+                    log.append(self.log(job, returncode, usage))
+                    if returncode == 0:
+                        job.status = "done"
+                        for key, digest in job.records:
+                            manifest.record(key, digest)
+                        print(f"Done {job.name}")
+                        for child in children[job.name]:
+                            waiting[child] -= 1
+                            if waiting[child] == 0:
+                                heapq.heappush(ready, (-ranks[child], child))
+                    elif job.attempts <= self.retries:
+                        print(f"Failed {job.name} (exit code {returncode}), retrying")
+                        heapq.heappush(ready, (-ranks[job.name], job.name))
+                    else:
+                        job.status = "failed"
+                        failed.append(job)
+                        print(f"Failed {job.name} (exit code {returncode})")
+
+        for job in jobs:
+            if job.status == "pending":
+                job.status = "skipped"
+        skipped = [job for job in jobs if job.status == "skipped"]
+        if log:
+            report(log)
+        if failed:
+            print(f"{len(failed)} job(s) failed: {', '.join(job.name for job in failed)}")
+            print(f"{len(skipped)} dependent job(s) skipped")
+        return failed
+
+
+def write_job_manifest(jobs, path):
+    """
+    Write the jobs with their dependencies and ranks as JSON, to be run by worker agents (worker.py) on any
+    node sharing the filesystem. Returns the path
+    """
+    resolve_dependencies(jobs)
+    ranks = upward_ranks(jobs)
+    entries = [{"name": job.name, "stage": job.stage, "cmd": job.cmd, "inputs": job.inputs, "outputs": job.outputs,
+                "records": [list(record) for record in job.records], "cost": job.cost, "memory": job.memory,
+                "deps": sorted(job.deps), "rank": ranks[job.name]} for job in topological_order(jobs)]
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump({"jobs": entries}, f, indent=4)
+    os.replace(tmp, path)
+    return path
+
+def read_job_manifest(path):
+    """Jobs of a job manifest, with their dependencies and ranks"""
+    with open(path) as f:
+        entries = json.load(f)["jobs"]
+    jobs = []
+    for entry in entries:
+        job = Job(entry["name"], entry["stage"], entry["cmd"], entry["inputs"], entry["outputs"], [tuple(r) for r in entry["records"]], entry["cost"], entry["memory"])
+        job.deps = set(entry["deps"])
+        job.rank = entry["rank"]
+        jobs.append(job)
+    return jobs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log", type=str, nargs='+', help="Job log(s) (JSON lines) written by run.py or by worker agents (<manifest>.state/log.*.jsonl)")
+    parser.add_argument("--top", type=int, help="Number of slowest jobs to show", default=10)
+    args = parser.parse_args()
+
+    report([record for path in args.log for record in read_log(path)], args.top)
@@ -0,0 +1,81 @@
+import re
+
+import numpy as np
+
+# quantile sketches written by the analysis (QuantileSketchHelper in functions.h): a histogram with one bin
+# per signed logarithmic bucket of the values, the parameters of the buckets are stored in its title
+SKETCH_SUFFIX = "_sketch"
+TITLE = re.compile(r"sketch alpha=(\S+) min=(\S+) nbuckets=(\d+)")
+
+
+class Sketch:
+    """Decoded quantile sketch: counts per bucket ordered by value, and the exact sum of x and x^2"""
+
+    def __init__(self, counts, alpha, min_value, sumx, sumx2):
+        self.counts = np.asarray(counts, dtype='d')
+        self.alpha = alpha
+        self.min_value = min_value
+        self.nbuckets = (len(self.counts) - 1) // 2
+        self.sumx = sumx
+        self.sumx2 = sumx2
+
+    @classmethod
+    def from_hist(cls, hist):
+        m = TITLE.fullmatch(hist.GetTitle())
+        if not m:
+            raise ValueError(f"{hist.GetName()} is not a quantile sketch")
+        counts = [hist.GetBinContent(i) for i in range(1, hist.GetNbinsX()+1)]
+        stats = np.zeros(4, dtype='d') # sumw, sumw2, sumwx, sumwx2
+        hist.GetStats(stats)
+        return cls(counts, float(m.group(1)), float(m.group(2)), stats[2], stats[3])
+
+    @property
+    def gamma(self):
+        return (1 + self.alpha)/(1 - self.alpha)
+
+    def values(self):
+        """Value representing each bucket, within a relative accuracy alpha of all values in it"""
+        index = np.arange(-self.nbuckets, self.nbuckets+1)
+        magnitude = 2*self.min_value*self.gamma**np.abs(index)/(1 + self.gamma)
+        return np.where(index == 0, 0., np.sign(index)*magnitude)
+
+    @property
+    def n(self):
+        return self.counts.sum()
+
+    @property
+    def empty(self):
+        return self.n == 0
+
+    # the moments and quantiles of an empty sketch (e.g. no matched tracks) are NaN
+
+    @property
+    def mean(self):
+        return self.sumx/self.n if not self.empty else np.nan
+
+    @property
+    def rms(self):
+        return np.sqrt(max(self.sumx2/self.n - self.mean**2, 0.)) if not self.empty else np.nan
+
+    @property
+    def rms_err(self):
+        return self.rms/np.sqrt(2*self.n) if not self.empty else np.nan
+
+    def quantiles(self, probabilities):
+        """Quantiles of the values, to a relative accuracy alpha"""
+        if self.empty:
+            return np.full(len(probabilities), np.nan)
+        cumulative = np.cumsum(self.counts)
+        ranks = np.asarray(probabilities, dtype='d')*(cumulative[-1] - 1)
+        index = np.searchsorted(cumulative, ranks, side='right')
+        return self.values()[np.minimum(index, len(self.counts)-1)]
+
+    def bootstrap_quantiles(self, probabilities, nboot=100, rng=None):
+        """Quantiles of nboot Poisson bootstrap replicas of the bucket counts, shape (nboot, len(probabilities))"""
+        rng = rng or np.random.default_rng()
+        cumulative = np.cumsum(rng.poisson(self.counts, size=(nboot, len(self.counts))), axis=1)
+        ranks = np.asarray(probabilities, dtype='d')*np.maximum(cumulative[:, -1:] - 1, 0)
+        index = np.array([np.searchsorted(c, r, side='right') for c, r in zip(cumulative, ranks)])
+        quantiles = self.values()[np.minimum(index, len(self.counts)-1)]
+        # replicas without any value have no quantiles
+        return np.where(cumulative[:, -1:] > 0, quantiles, np.nan)
@@ -0,0 +1,83 @@
+import argparse
+import logging
+
+import ROOT
+
+import analysis
+
+logger = logging.getLogger("fcclogger")
+
+# Slim track tables: one entry per event with one float per muon (or track, with --all_tracks) in each column,
+# holding the truth species and helix parameters, the reconstructed ones, their covariances and the residuals (read back
+# under the names of analysis.py, see analysis.slim_aliases). All muons are kept, with NaN truth values and d0/z0
+# residuals for the unmatched ones, so the analysis of a table gives the same outputs as that of the Delphes output.
+# Rerunning the histogramming (analysis.py --slim) or the unbinned resolutions (resolution.py --slim) on them
+# reads a few MB per sample instead of the full EDM4hep output of Delphes.
+
+# columns of the table, in terms of the columns of analysis.define_residuals
+slim_columns = {
+    # truth, of the generator particle matched to each muon (NaN if there is none)
+    "gen_theta": "FCCAnalyses::takeGen(FCCAnalyses::MCParticle::get_theta(Particle), muon_mc_index)",
+    "gen_p": "FCCAnalyses::takeGen(FCCAnalyses::MCParticle::get_p(Particle), muon_mc_index)",
+    "gen_d0": "FCCAnalyses::toFloat(D0_gen)", # mm
+    "gen_z0": "FCCAnalyses::toFloat(Z0_gen)", # mm
+    "gen_pdg": "FCCAnalyses::toFloat(muon_mc_pdg)", # species of the particle
+    # reconstructed momentum, helix parameters and their covariances
+    "trk_p": "FCCAnalyses::toFloat(muons_p)",
+    "trk_d0": "FCCAnalyses::toFloat(ReconstructedParticle2Track::getRP2TRK_D0(muons_all, _EFlowTrack_trackStates))", # mm
+    "trk_z0": "FCCAnalyses::toFloat(ReconstructedParticle2Track::getRP2TRK_Z0(muons_all, _EFlowTrack_trackStates))", # mm
+    "trk_omega": "FCCAnalyses::toFloat(RP_TRK_omega)", # mm-1
+    "trk_phi": "FCCAnalyses::toFloat(RP_TRK_phi)",
+    "trk_tanlambda": "FCCAnalyses::toFloat(RP_TRK_tanlambda)",
+    "trk_d0_cov": "FCCAnalyses::toFloat(RP_TRK_D0_cov)",
+    "trk_z0_cov": "FCCAnalyses::toFloat(RP_TRK_Z0_cov)",
+    "trk_omega_cov": "FCCAnalyses::toFloat(RP_TRK_omega_cov)",
+    "trk_phi_cov": "FCCAnalyses::toFloat(RP_TRK_phi_cov)",
+    "trk_tanlambda_cov": "FCCAnalyses::toFloat(RP_TRK_tanlambda_cov)",
+    # residuals
+    "res_d0_um": "FCCAnalyses::toFloat(RP_TRK_D0_um)", # NaN if unmatched
+    "res_z0_um": "FCCAnalyses::toFloat(RP_TRK_Z0_um)",
+    "res_p": "muon_residuals.p", # leptonResiduals only has the matched muons, as in the analysis
+    "res_k": "muon_residuals.k",
+    "res_theta": "muon_residuals.theta",
+    "res_phi": "muon_residuals.phi",
+    "res_pdg": "muon_residuals.pdg", # species of the matched muons of res_p, res_k, ...
+}
+
+
+def book_slim(input_file, output_file, all_tracks=False):
+    """
+    Book the snapshot of the track table of a Delphes output (lazy, triggered by the returned handle),
+    of the muons or with all_tracks of all tracks (see analysis.define_residuals)
+    """
+    df = analysis.define_covariances(analysis.define_residuals(ROOT.RDataFrame("events", input_file), all_tracks))
+    for column, expression in slim_columns.items():
+        df = df.Define(column, expression)
+    options = ROOT.RDF.RSnapshotOptions()
+    options.fLazy = True
+    options.fCompressionAlgorithm = ROOT.RCompressionSetting.EAlgorithm.kZSTD
+    return df.Snapshot(analysis.slim_tree, output_file, list(slim_columns), options)
+
+def slim_batch(input_files, output_files, nThreads=0, all_tracks=False):
+    """Write the track tables of all inputs, the event loops run together on a shared thread pool"""
+    if nThreads != 1:
+        ROOT.EnableImplicitMT(nThreads)
+    snapshots = [book_slim(input_file, output_file, all_tracks) for input_file, output_file in zip(input_files, output_files)]
+    ROOT.RDF.RunGraphs(snapshots)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, nargs='+', help="Delphes output file(s)", required=True)
+    parser.add_argument("-o", "--output", type=str, nargs='+', help="Track table file(s), one per input file", required=True)
+    parser.add_argument("--nThreads", type=int, help="Number of threads (0: all cores, 1: no implicit multi-threading)", default=0)
+    parser.add_argument("--all_tracks", help="Keep all matched tracks instead of the muons, for samples of several species (analysis.py --pdg)", action='store_true')
+    args = parser.parse_args()
+
+    if len(args.input) != len(args.output):
+        parser.error("--input and --output need the same number of files")
+
+    logger.info(f"Slimming {len(args.input)} file(s)")
+    slim_batch(args.input, args.output, args.nThreads, args.all_tracks)
+    logger.info(f"Done! Track tables saved to {', '.join(args.output)}")
@@ -0,0 +1,270 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+import manifest
+import scheduler
+
+# Worker agent draining a job manifest (run.py --job_manifest) together with the agents of other nodes sharing the
+# filesystem. A job is claimed by creating its lock file with O_CREAT|O_EXCL, which succeeds for one agent only;
+# the lock is kept fresh while the job runs, so the locks of a crashed agent go stale and are taken over. A lock
+# holds a token unique to the claim, so an agent only refreshes and removes its own locks. Results are reported in
+# a status file per job, next to the lock, in the <manifest>.state directory.
+
+
+class JobState:
+    """Lock and status files of the jobs of a job manifest"""
+
+    def __init__(self, manifest_path):
+        self.dir = f"{os.path.splitext(manifest_path)[0]}.state"
+        os.makedirs(self.dir, exist_ok=True)
+        self.tokens = {} # tokens of the locks taken by this JobState, per job name
+
+    def base(self, job):
+        # job names are paths: readable, but made unique by a hash
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", job.name)
+        return os.path.join(self.dir, f"{name}.{hashlib.sha1(job.name.encode()).hexdigest()[:8]}")
+
+    def lock_path(self, job):
+        return f"{self.base(job)}.lock"
+
+    def status(self, job):
+        try:
+            with open(f"{self.base(job)}.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_status(self, job, **status):
+        path = f"{self.base(job)}.json"
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(status, f, indent=4)
+        os.replace(tmp, path)
+
+    def read_lock(self, path):
+        """Token and modification time of a lock file, None if there is none"""
+        try:
+            with open(path) as f:
+                token = f.read().strip()
+            return token, os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def holder(self, job):
+        """Agent holding the lock of a job and the age of the lock in seconds, None if it is not locked"""
+        held = self.read_lock(self.lock_path(job))
+        if held is None:
+            return None
+        return held[0].split(" ")[0], time.time() - held[1]
+
+    def owns(self, job):
+        """Whether the lock of a job is the one this JobState took"""
+        held = self.read_lock(self.lock_path(job))
+        return held is not None and held[0] == self.tokens.get(job.name)
+
+    def claim(self, job, agent, stale_after):
+        """Try to take the lock of a job, breaking it if its agent stopped refreshing it"""
+        lock = self.lock_path(job)
+        held = self.read_lock(lock)
+        if held and time.time() - held[1] > stale_after:
+            stale = f"{lock}.stale{os.getpid()}.{os.urandom(4).hex()}"
+            try:
+                os.rename(lock, stale)
+            except OSError:
+                return False
+            # another agent may have broken the stale lock and taken the job between the read and the rename:
+            # then the renamed lock is its fresh one, which is put back (unless yet another lock was created since)
+            if self.read_lock(stale) != held:
+                try:
+                    os.link(stale, lock)
+                except OSError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            print(f"Broke stale lock of {job.name} held by {held[0].split(' ')[0]}")
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        # the token tells this claim apart from later ones of the same job, also by the same agent
+        token = f"{agent} {os.urandom(8).hex()}"
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+        self.tokens[job.name] = token
+        return True
+
+    def release(self, job):
+        if self.owns(job):
+            try:
+                os.remove(self.lock_path(job))
+            except FileNotFoundError:
+                pass
+        self.tokens.pop(job.name, None)
+
+    def touch(self, job):
+        if self.owns(job):
+            try:
+                os.utime(self.lock_path(job))
+            except FileNotFoundError:
+                pass
+
+
+def job_states(jobs, state):
+    """
+    State of each job: done, failed (after all its retries), blocked (an upstream job failed),
+    running (locked by some agent), ready (its dependencies are done) or waiting
+    """
+    states = {}
+    statuses = {}
+    for job in jobs: # manifests are in topological order
+        status = state.status(job)
+        statuses[job.name] = status
+        if status and status["status"] in ("done", "failed"):
+            states[job.name] = status["status"]
+        elif any(states[dep] in ("failed", "blocked") for dep in job.deps):
+            states[job.name] = "blocked"
+        elif state.holder(job):
+            states[job.name] = "running"
+        elif all(states[dep] == "done" for dep in job.deps):
+            states[job.name] = "ready"
+        else:
+            states[job.name] = "waiting"
+    return states, statuses
+
+
+class Worker:
+    """
+    Runs ready jobs of a job manifest until all jobs are finished, at most max_jobs at a time and within the
+    stage limits and memory budget of this agent (see scheduler.Scheduler), highest ranked jobs first
+    """
+
+    def __init__(self, manifest_path, max_jobs=1, stage_limits=None, memory_budget=None, retries=0, stale_after=300, poll=5):
+        self.jobs = scheduler.read_job_manifest(manifest_path)
+        self.state = JobState(manifest_path)
+        self.agent = f"{socket.gethostname()}:{os.getpid()}"
+        # resource usage of the jobs of this agent, see scheduler.report
+        log_path = os.path.join(self.state.dir, f"log.{self.agent.replace(':', '_')}.jsonl")
+        self.limits = scheduler.Scheduler(max_jobs, stage_limits, memory_budget, log_path=log_path)
+        self.max_jobs = max_jobs
+        self.retries = retries
+        self.stale_after = stale_after
+        self.poll = poll
+        self.running = {}
+        self.stopped = threading.Event()
+
+    def heartbeat(self):
+        """Keep the locks of the running jobs fresh"""
+        while not self.stopped.wait(self.stale_after/4):
+            for job in list(self.running.values()):
+                self.state.touch(job)
+
+    def finish(self, job, status, returncode, usage):
+        attempts = (status or {}).get("attempts", 0) + 1
+        job.attempts = attempts
+        self.limits.log(job, returncode, usage)
+        if returncode == 0:
+            for key, digest in job.records:
+                manifest.record(key, digest)
+            result = "done"
+            print(f"Done {job.name}")
+        elif attempts <= self.retries:
+            result = "retry"
+            print(f"Failed {job.name} (exit code {returncode}), to be retried")
+        else:
+            result = "failed"
+            print(f"Failed {job.name} (exit code {returncode})")
+        self.state.write_status(job, status=result, attempts=attempts, returncode=returncode, agent=self.agent, **usage)
+        self.state.release(job)
+
+    def run(self):
+        """Drain the manifest, returns the number of failed jobs"""
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        ranked = sorted(self.jobs, key=lambda job: -job.rank)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs) as pool:
+            while True:
+                states, _ = job_states(self.jobs, self.state)
+                # locks of crashed agents look like running jobs until they go stale
+                stale = [job for job in self.jobs if states[job.name] == "running" and job not in self.running.values()
+                         and self.state.holder(job) and self.state.holder(job)[1] > self.stale_after]
+                for job in ranked:
+                    if len(self.running) >= self.max_jobs:
+                        break
+                    if (states[job.name] == "ready" or job in stale) and self.limits.fits(job, self.running):
+                        if not self.state.claim(job, self.agent, self.stale_after):
+                            continue
+                        status = self.state.status(job) # it may have finished since the states were read
+                        if status and status["status"] in ("done", "failed"):
+                            self.state.release(job)
+                            continue
+                        print(f"Starting {job.name} on {self.agent}")
+                        self.running[pool.submit(self.limits.execute, job)] = job
+
+                if not self.running:
+                    if all(s in ("done", "failed", "blocked") for s in states.values()):
+                        break
+                    time.sleep(self.poll) # the remaining jobs wait for jobs running on other agents
+                    continue
+
+                done, _ = concurrent.futures.wait(self.running, timeout=self.poll, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job = self.running.pop(future)
+                    self.finish(job, self.state.status(job), *future.result())
+        self.stopped.set()
+
+        states, _ = job_states(self.jobs, self.state)
+        failed = [name for name, s in states.items() if s == "failed"]
+        blocked = [name for name, s in states.items() if s == "blocked"]
+        if failed:
+            print(f"{len(failed)} job(s) failed: {', '.join(failed)}")
+            print(f"{len(blocked)} dependent job(s) blocked")
+        return len(failed)
+
+def print_status(manifest_path):
+    """Summary of the states of the jobs of a manifest, and the agents running jobs"""
+    jobs = scheduler.read_job_manifest(manifest_path)
+    state = JobState(manifest_path)
+    states, statuses = job_states(jobs, state)
+    counts = {}
+    for s in states.values():
+        counts[s] = counts.get(s, 0) + 1
+    print(", ".join(f"{s}: {n}" for s, n in sorted(counts.items())))
+    for job in jobs:
+        if states[job.name] == "running":
+            owner, age = state.holder(job) or ("?", 0)
+            print(f"  running {job.name} on {owner} (lock refreshed {age:.0f} s ago)")
+        elif states[job.name] == "failed":
+            print(f"  failed {job.name} (exit code {statuses[job.name]['returncode']} on {statuses[job.name]['agent']})")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", type=str, help="Job manifest written by run.py --job_manifest")
+    parser.add_argument("--max_jobs", type=int, help="Maximum number of concurrent jobs of this agent", default=os.cpu_count())
+    parser.add_argument("--stage_jobs", type=str, nargs='*', help="Maximum number of concurrent jobs per stage of this agent, e.g. delphes=16", default=[])
+    parser.add_argument("--memory", type=int, help="Memory budget in MB of this agent (default: available memory)", default=None)
+    parser.add_argument("--retries", type=int, help="Number of times a failed job is retried (by any agent)", default=1)
+    parser.add_argument("--stale_after", type=float, help="Seconds after which the lock of a job whose agent stopped refreshing it is taken over", default=300)
+    parser.add_argument("--poll", type=float, help="Seconds between checks for jobs that became ready", default=5)
+    parser.add_argument("--status", help="Print the states of the jobs and exit", action='store_true')
+    args = parser.parse_args()
+
+    if args.status:
+        print_status(args.manifest)
+        sys.exit(0)
+
+    stage_limits = {stage: int(value) for stage, value in (item.split("=") for item in args.stage_jobs)}
+    if any(limit < 1 for limit in stage_limits.values()):
+        parser.error("--stage_jobs limits must be at least 1, a stage without job slots would never run")
+    memory_budget = args.memory if args.memory is not None else scheduler.available_memory()
+    worker = Worker(args.manifest, args.max_jobs, stage_limits, memory_budget, args.retries, args.stale_after, args.poll)
+    sys.exit(1 if worker.run() else 0)
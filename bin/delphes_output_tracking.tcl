@@ -0,0 +1,7 @@
+module EDM4HepOutput EDM4HepOutput {   
+    add ReconstructedParticleCollections EFlowTrack
+    add GenParticleCollections           Particle
+    add MuonCollections                  Muon 
+    set RecoParticleCollectionName       ReconstructedParticles
+    set RecoMCParticleLinkCollection     MCRecoAssociations
+} 
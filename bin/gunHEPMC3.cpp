@@ -11,6 +11,10 @@
 #include <string>
 #include <random>
 #include <cmath>
+#include <thread>
+#include <mutex>
+#include <atomic>
+#include <algorithm>
 
 using namespace HepMC3;
 
@@ -41,13 +45,9 @@ double get_mass(int pid) {
     return masses.count(pid) ? masses[pid] : 0;
 }
 
-void generate_event(int iEv, WriterAscii& writer, const std::vector<int>& pid_list, 
+void generate_event(int iEv, WriterAscii& writer, std::mt19937& gen, const std::vector<int>& pid_list, 
                     int npart, const std::vector<double>& theta_range, 
                     const std::vector<double>& mom_range, double R0=0, double z0=0.) {
-    // Create a random number generator
-    std::random_device rd;
-    std::mt19937 gen(rd());
-
     // Create a new event
     GenEvent evt(Units::GEV, Units::MM);
 
@@ -120,22 +120,23 @@ void generate_event(int iEv, WriterAscii& writer, const std::vector<int>& pid_li
 }
 
 
-int main(int argc, char** argv) {
-    // Check that the correct number of parameters were passed
-    if (argc < 2) {
-        std::cerr << "Usage: " << argv[0] << " <config file>\n";
-        return 1;
-    }
+// serializes the printouts of the worker threads
+std::mutex output_mutex;
+
+int generate_sample(const std::string& config_path, std::string output_file) {
+    // printouts are collected and written at once, samples may be generated in parallel
+    std::ostringstream printout;
 
     // Open the configuration file
-    std::ifstream configFile(argv[1]);
+    std::ifstream configFile(config_path);
     if (!configFile) {
-        std::cerr << "Could not open configuration file " << argv[1] << "\n";
+        std::lock_guard<std::mutex> lock(output_mutex);
+        std::cerr << "Could not open configuration file " << config_path << "\n";
         return 1;
     }
 
     // extract filename of input file
-    std::string filename_str = argv[1];
+    std::string filename_str = config_path;
     size_t slash_pos = filename_str.find_last_of("/\\"); // Find position of last '/' or '\\'
     std::string filename = (slash_pos == std::string::npos) ? filename_str : filename_str.substr(slash_pos + 1);
     size_t dot_pos = filename.find_last_of('.'); // Find last dot
@@ -189,39 +190,112 @@ int main(int argc, char** argv) {
         pid_list.push_back(std::stoi(pid));
     }
 
+    // Seed of the random number generator: fixed by the config for reproducible (sharded) samples, random otherwise
+    unsigned int seed = config.count("seed") ? std::stoul(config["seed"]) : std::random_device{}();
+    std::mt19937 gen(seed);
+
+    // Event number of the first event, to generate a sample in shards of consecutive event ranges
+    int first_event = config.count("first_event") ? std::stoi(config["first_event"]) : 0;
+
     // Print the parsed values for debugging
-    std::cout << "nevents: " << nevents << "\n";
+    printout << "config: " << config_path << "\n";
+    printout << "nevents: " << nevents << "\n";
+    printout << "seed: " << seed << "\n";
+    printout << "first_event: " << first_event << "\n";
 
     // Print the parsed values for debugging
-    std::cout << "npart: " << npart << "\n";
+    printout << "npart: " << npart << "\n";
 
 
-    std::cout << "theta_range: ";
+    printout << "theta_range: ";
     for (double theta : theta_range) {
-        std::cout << theta << " ";
+        printout << theta << " ";
     }
-    std::cout << "\n";
+    printout << "\n";
 
-    std::cout << "mom_range: ";
+    printout << "mom_range: ";
     for (double mom : mom_range) {
-        std::cout << mom << " ";
+        printout << mom << " ";
     }
-    std::cout << "\n";
+    printout << "\n";
 
-    std::cout << "pid_list: ";
+    printout << "pid_list: ";
     for (int pid : pid_list) {
-        std::cout << pid << " ";
+        printout << pid << " ";
     }
-    std::cout << "\n";
+    printout << "\n";
 
     // Open the output file
-    WriterAscii writer(filename_name_only + ".hepmc");
+    if (output_file.empty()) output_file = filename_name_only + ".hepmc";
+    WriterAscii writer(output_file);
 
     // Generate and write n events
     for (int i = 0; i < nevents; i++) {
-        generate_event(i, writer, pid_list, npart, theta_range, mom_range, R0, z0);
+        generate_event(first_event + i, writer, gen, pid_list, npart, theta_range, mom_range, R0, z0);
     }
 
     writer.close();  // This will add the "HepMC::Asciiv3-END_EVENT_LISTING" line
+
+    std::lock_guard<std::mutex> lock(output_mutex);
+    std::cout << printout.str() << "Done: " << output_file << "\n";
+    return 0;
+}
+
+int main(int argc, char** argv) {
+    // Parse the arguments: one or several config files (e.g. a whole theta x momentum grid),
+    // generated in this process by a pool of worker threads
+    std::vector<std::string> configs;
+    std::string output_file;
+    int nthreads = 1;
+    for (int i = 1; i < argc; i++) {
+        std::string arg = argv[i];
+        if (arg == "-o" && i + 1 < argc) {
+            output_file = argv[++i];
+        }
+        else if (arg == "-j" && i + 1 < argc) {
+            nthreads = std::stoi(argv[++i]);
+        }
+        else if (arg.size() > 1 && arg[0] == '-') {
+            std::cerr << "Unknown argument " << arg << "\n";
+            return 1;
+        }
+        else {
+            configs.push_back(arg);
+        }
+    }
+
+    // Check that the correct number of parameters were passed
+    if (configs.empty() || (!output_file.empty() && configs.size() > 1)) {
+        std::cerr << "Usage: " << argv[0] << " [-j <threads>] <config file> [<config file> ...]\n";
+        std::cerr << "       " << argv[0] << " <config file> -o <output file>\n";
+        return 1;
+    }
+
+    std::atomic<size_t> next_config(0);
+    std::atomic<int> nfailed(0);
+    auto worker = [&]() {
+        for (size_t i = next_config++; i < configs.size(); i = next_config++) {
+            int status = 1;
+            try {
+                status = generate_sample(configs[i], output_file);
+            }
+            catch (const std::exception& e) {
+                std::lock_guard<std::mutex> lock(output_mutex);
+                std::cerr << "Error generating " << configs[i] << ": " << e.what() << "\n";
+            }
+            if (status != 0) nfailed++;
+        }
+    };
+
+    nthreads = std::max(1, std::min(nthreads, (int)configs.size()));
+    std::vector<std::thread> threads;
+    for (int t = 1; t < nthreads; t++) threads.emplace_back(worker);
+    worker();
+    for (auto& thread : threads) thread.join();
+
+    if (nfailed > 0) {
+        std::cerr << nfailed << " of " << configs.size() << " samples failed\n";
+        return 1;
+    }
     return 0;
-}
\ No newline at end of file
+}
@@ -0,0 +1,42 @@
+#!/bin/bash
+
+# Stream gun events into Delphes through a named pipe, without writing the HepMC3 file to disk
+# $1: directory for the named pipe (must be visible inside the gun container)
+# $2: gun executable
+# $3: gun input card
+# $4: Delphes card
+# $5: Delphes output configuration
+# $6: Delphes output file
+# $7: "native" to run the Python gun given as $2 (analysis/gun.py) directly instead of in the gun container
+
+fifo="$1/$(basename "$3" .input).hepmc"
+rm -f "$fifo"
+mkfifo "$fifo" || exit 1
+trap 'rm -f "$fifo"' EXIT
+
+if [ "$7" = "native" ]; then
+    python "$2" "$3" -o "$fifo" &
+else
+    "$(dirname "${BASH_SOURCE[0]}")/run_gunHEPMC3_singularity.sh" "$1" "$2" "$3" -o "$fifo" &
+fi
+gun_pid=$!
+
+# Delphes reads the pipe as standard input ("-"), regular input files are seeked to get their size
+DelphesHepMC3_EDM4HEP "$4" "$5" "$6" - < "$fifo" &
+delphes_pid=$!
+
+wait $gun_pid
+gun_status=$?
+if [ $gun_status -ne 0 ]; then
+    # the gun may have failed before opening the pipe, leaving Delphes blocked on it
+    echo "Gun failed for $3 (exit code $gun_status)" >&2
+    kill $delphes_pid 2>/dev/null
+fi
+
+wait $delphes_pid
+delphes_status=$?
+
+if [ $gun_status -ne 0 ]; then
+    exit $gun_status
+fi
+exit $delphes_status
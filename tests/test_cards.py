@@ -0,0 +1,67 @@
+import glob
+import json
+import os
+
+import pytest
+
+import cards
+
+CARDS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "delphes_cards")
+BASELINE = os.path.join(CARDS_DIR, "IDEA_baseline.tcl")
+
+
+def read_card(path=BASELINE):
+    with open(path) as f:
+        return cards.parse_card(f.read())
+
+@pytest.mark.parametrize("path", sorted(glob.glob(os.path.join(CARDS_DIR, "*.tcl"))), ids=os.path.basename)
+def test_round_trip(path):
+    with open(path) as f:
+        text = f.read()
+    card = cards.parse_card(text)
+    assert card.to_text() == text
+    assert card.execution_path and set(card.execution_path) <= set(card.modules)
+
+def test_tracking_card():
+    original = set(read_card().modules)
+    card = cards.tracking_card(read_card())
+    modules = card.modules
+    branches = [values[1] for values in modules["TreeWriter"].params("Branch")]
+    assert sorted(branches) == sorted(cards.TRACKING_BRANCHES)
+    assert not any(m.cls in cards.TRACKING_BYPASS + cards.CALORIMETERS for m in modules.values())
+    assert set(card.execution_path) == set(modules)
+    # every module read is kept in the card (references also match words like forward/backward of comments)
+    for module in modules.values():
+        for name, _ in module.references():
+            assert name in modules or name not in original
+    # the derived card is a valid card itself
+    assert cards.parse_card(card.to_text()).to_text() == card.to_text()
+
+def test_set_parameter():
+    card = read_card()
+    cards.set_parameter(card, "B", 3)
+    cards.set_parameter(card, "VTXLOW[0].r", 0.0117)
+    cards.set_parameter(card, "LAYER[1].X0", 0.5)
+    cards.set_parameter(card, "TrackSmearing.NMinHits", 5)
+    bz, layers = cards.detector_geometry(cards.parse_card(card.to_text()))
+    assert bz == 3.
+    assert [layer["r"] for layer in layers if layer["label"] == "VTXLOW"][0] == 0.0117
+    assert layers[1]["X0"] == 0.5
+    assert card.modules["TrackSmearing"].param("NMinHits") == "5"
+    for key in ("NoSuchVariable", "TrackSmearing.NoSuchKey", "VTXLOW[99].r"):
+        with pytest.raises(ValueError):
+            cards.set_parameter(card, key, 1)
+
+def test_sweep(tmp_path):
+    spec = tmp_path / "sweep.json"
+    spec.write_text(json.dumps({"template": "IDEA_baseline", "parameters": {"B": [2, 3], "VTXLOW[0].r": [0.0117, 0.0137]}}))
+    paths = cards.write_sweep(str(spec), CARDS_DIR, str(tmp_path / "cards"))
+    assert len(paths) == 4
+    with open(tmp_path / "cards" / "sweep.json") as f:
+        index = json.load(f)
+    assert set(index) == set(paths)
+    for name, parameters in index.items():
+        bz, layers = cards.detector_geometry(read_card(paths[name]))
+        assert bz == parameters["B"]
+        assert [layer["r"] for layer in layers if layer["label"] == "VTXLOW"][0] == parameters["VTXLOW[0].r"]
+    assert "IDEA_baseline_B3_VTXLOW0.r0.0117" in paths
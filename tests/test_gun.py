@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import gun
+
+
+def write_card(path, **settings):
+    config = {"npart": 2, "theta_range": "20.,20.", "mom_range": "5.,5.", "pid_list": "13,-13", "R0": 0, "z0": 0,
+              "nevents": 5, "seed": 1, "first_event": 10}
+    config.update(settings)
+    path.write_text("".join(f"{key} {value}\n" for key, value in config.items()))
+    return str(path)
+
+def read_events(path):
+    with open(path) as f:
+        text = f.read()
+    assert text.startswith(gun.HEADER) and text.endswith(gun.FOOTER)
+    events = []
+    for line in text[len(gun.HEADER):-len(gun.FOOTER)].splitlines():
+        if line.startswith("E "):
+            events.append([])
+        events[-1].append(line.split())
+    return events
+
+@pytest.mark.parametrize("R0", [0, 20])
+def test_sample_format(tmp_path, R0):
+    output = gun.generate_sample(write_card(tmp_path / "gun.txt", R0=R0), output_dir=str(tmp_path), batch_size=2)
+    assert output == str(tmp_path / "gun.hepmc")
+    events = read_events(output)
+    assert [int(event[0][1]) for event in events] == list(range(10, 15))
+    for event in events:
+        assert event[0][2:] == ["2", "6"] and event[1] == ["U", "GEV", "MM"]
+        assert [line[0] for line in event[2:]] == ["P", "P", "V", "P"]*2
+        vertices = [line for line in event if line[0] == "V"]
+        assert all(("@" in line) == (R0 != 0) for line in vertices)
+        for line in event:
+            if line[0] == "P" and line[3] in ("13", "-13"):
+                px, py, pz, e, m = (float(v) for v in line[4:9])
+                assert line[2] != "0" and line[9] == "1"
+                assert np.isclose(np.hypot(np.hypot(px, py), pz), 5.)
+                assert np.isclose(np.degrees(np.arctan2(np.hypot(px, py), pz)), 20.)
+                assert np.isclose(m, gun.masses[13], rtol=1e-3)
+        if R0:
+            x, y = (float(v) for v in vertices[0][5:7])
+            assert np.isclose(np.hypot(x, y), R0)
+
+def test_seed_reproduces_the_sample(tmp_path):
+    card = write_card(tmp_path / "gun.txt", nevents=50)
+    first = open(gun.generate_sample(card, str(tmp_path / "a.hepmc"))).read()
+    second = open(gun.generate_sample(card, str(tmp_path / "b.hepmc"))).read()
+    assert first == second
@@ -0,0 +1,29 @@
+import manifest
+
+
+SOURCE = '''
+def residuals(df):
+    return df
+
+def binning():
+    return 200
+'''
+
+def test_source_digest_of_some_functions(tmp_path):
+    path = tmp_path / "script.py"
+    path.write_text(SOURCE)
+    digest = manifest.source_digest(str(path), ["residuals"])
+    path.write_text(SOURCE.replace("200", "100"))
+    assert manifest.source_digest(str(path), ["residuals"]) == digest
+    path.write_text(SOURCE.replace("return df", "return df.Filter('true')"))
+    assert manifest.source_digest(str(path), ["residuals"]) != digest
+
+def test_record_and_is_current(tmp_path):
+    output = tmp_path / "sample.root"
+    digest = manifest.compute_digest(extra={"nevents": 1000})
+    assert not manifest.is_current(str(output), digest)
+    output.write_text("events")
+    manifest.record(str(output), digest)
+    assert manifest.is_current(str(output), digest)
+    assert manifest.output_digest(str(output)) == digest
+    assert not manifest.is_current(str(output), manifest.compute_digest(extra={"nevents": 2000}))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ROOT")
+import plots
+
+
+def gaussian_rows(rng, sigmas, nevents=20000, nbins=200):
+    """Histograms of Gaussian samples as rows of bin centers and contents, over +-5 sigma"""
+    centers, contents = [], []
+    for sigma in sigmas:
+        counts, edges = np.histogram(rng.normal(0., sigma, nevents), bins=nbins, range=(-5*sigma, 5*sigma))
+        centers.append(0.5*(edges[1:] + edges[:-1]))
+        contents.append(counts.astype('d'))
+    return np.array(centers), np.array(contents)
+
+def test_core_fit_recovers_sigma():
+    rng = np.random.default_rng(1)
+    sigmas = [0.5, 1., 3., 10.]
+    centers, contents = gaussian_rows(rng, sigmas)
+    fit = plots.core_fit(centers, contents, np.zeros(len(sigmas)), 1.2*np.array(sigmas))
+    errors = np.sqrt(fit["covariance"][:, 2, 2])
+    assert np.all(np.isfinite(errors))
+    assert np.all(np.abs(fit["sigma"] - sigmas) < 5*errors)
+
+def test_core_fit_degenerate_rows_do_not_abort_the_batch():
+    rng = np.random.default_rng(2)
+    centers, contents = gaussian_rows(rng, [1., 2.])
+    nbins = centers.shape[1]
+    # all bins at the same center (singular chi2), an empty histogram and a collapsed starting sigma
+    centers = np.vstack([centers, np.zeros(nbins), centers[0], centers[0]])
+    contents = np.vstack([contents, np.full(nbins, 10.), np.zeros(nbins), contents[0]])
+    fit = plots.core_fit(centers, contents, np.zeros(5), [1., 2., 1., 1., 0.])
+    assert np.all(np.isfinite(fit["sigma"][:2]))
+    assert np.all(np.abs(fit["sigma"][:2] - [1., 2.]) < 5*np.sqrt(fit["covariance"][:2, 2, 2]))
+    assert np.all(np.isnan(fit["sigma"][2:]))
+    assert np.all(np.isnan(fit["covariance"][2:]))
+    values = plots.fit_values(fit, 2)
+    assert np.isnan(values["sigma"]) and np.isnan(values["sigma_err"])
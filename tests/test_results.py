@@ -0,0 +1,43 @@
+import concurrent.futures
+
+import numpy as np
+
+import results
+
+
+def make_row(card, theta, p, observable, sigma):
+    row = {"card": card, "particle": "mu_minus", "theta": theta, "p": p, "observable": observable}
+    row.update({key: sigma for key in results.VALUES})
+    return row
+
+def test_parse_sample():
+    assert results.parse_sample("mu_minus_theta_10_p_5") == ("mu_minus", 10., 5.)
+    assert results.parse_sample("pi_plus_theta_15.5_p_0.5") == ("pi_plus", 15.5, 0.5)
+
+def test_round_trip(tmp_path):
+    path = results.results_path(str(tmp_path))
+    rows = [make_row("idea", 10., 1., "d0", 0.5), make_row("idea", 10., 1., "z0", np.nan)]
+    results.write_table(path, results.from_rows(rows))
+    table = results.read_table(path)
+    assert results.to_rows(table)[0] == rows[0]
+    assert np.isnan(results.lookup(table, "sigma", observable="z0"))
+
+def test_update_table_replaces_rows_with_the_same_keys(tmp_path):
+    path = results.results_path(str(tmp_path))
+    results.update_table(path, [make_row("idea", 10., 1., "d0", 1.), make_row("idea", 10., 2., "d0", 2.)])
+    results.update_table(path, [make_row("idea", 10., 2., "d0", 3.), make_row("idea", 20., 2., "d0", 4.)])
+    table = results.read_table(path)
+    assert len(table["card"]) == 3
+    assert results.lookup(table, "sigma", theta=10., p=1.) == 1.
+    assert results.lookup(table, "sigma", theta=10., p=2.) == 3.
+    assert results.lookup(table, "sigma", theta=20., p=2.) == 4.
+    assert results.select(table, p=2.).sum() == 2
+
+def update_theta(path, theta):
+    results.update_table(path, [make_row("idea", float(theta), float(p), "d0", 1.) for p in range(20)])
+
+def test_concurrent_updates_keep_all_rows(tmp_path):
+    path = results.results_path(str(tmp_path))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=8) as pool:
+        list(pool.map(update_theta, [path]*16, range(16)))
+    assert len(results.read_table(path)["card"]) == 16*20
@@ -0,0 +1,44 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "analysis")
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """run.py imported with the given command line, in a temporary working directory"""
+    pytest.importorskip("ROOT")
+    monkeypatch.chdir(tmp_path)
+    def load(*argv):
+        monkeypatch.setattr(sys, "argv", ["run.py", *argv])
+        sys.modules.pop("run", None)
+        return importlib.import_module("run")
+    yield load
+    sys.modules.pop("run", None)
+
+def test_builders_take_the_config(run):
+    module = run("--analysis", "--pdg", "13", "11", "--shards", "2")
+    config = module.RunConfig(module.args)
+    assert config.split_species and config.job_events == module.args.nevents
+    samples = [module.gun_sample_name(config.particle_ids, 10, 5)]
+    for sample in samples:
+        config.sample_units[sample] = module.shard_names(sample, 2)
+    units = [unit for sample in samples for unit in config.sample_units[sample]]
+
+    analysis = module.analysis_jobs(config, units, "delphes", "analysis", f"{ANALYSIS_DIR}/analysis.py")
+    assert [job.outputs for job in analysis] == [[os.path.normpath(f"analysis/{pdg}_theta_10_p_5_shard{i}.root") for pdg in ("mu_minus", "e_minus")] for i in range(2)]
+    assert all(job.cmd[-3:] == ["--pdg", "13", "11"] and job.memory == config.stage_memory["analysis"] for job in analysis)
+
+    merge = module.merge_jobs(config, samples, "analysis")
+    assert [job.outputs for job in merge] == [[os.path.normpath(f"analysis/{pdg}_theta_10_p_5.root")] for pdg in ("mu_minus", "e_minus")]
+    assert merge[1].inputs == [os.path.normpath(f"analysis/e_minus_theta_10_p_5_shard{i}.root") for i in range(2)]
+
+def test_sample_names_do_not_depend_on_the_number_type(run):
+    module = run("--plots", "--theta", "10", "22.3")
+    assert module.args.theta == [10., 22.3]
+    assert module.gun_sample_name([13], module.args.theta[0], 5) == module.gun_sample_name([13], 10, 5.) == "mu_minus_theta_10_p_5"
+    assert module.gun_sample_name([13, 11], module.args.theta[1], 5) == "mu_minus+e_minus_theta_22.3_p_5"
+    assert module.sample_name(-13, 22.3, 0.5) == "mu_plus_theta_22.3_p_0.5"
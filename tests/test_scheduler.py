@@ -0,0 +1,58 @@
+import scheduler
+
+
+def test_dag_runs_in_dependency_order(tmp_path):
+    a, b, c = (str(tmp_path / name) for name in "abc")
+    jobs = [scheduler.Job("c", "analysis", ["sh", "-c", f"test -f {b} && touch {c}"], inputs=[b], outputs=[c]),
+            scheduler.Job("b", "delphes", ["sh", "-c", f"test -f {a} && touch {b}"], inputs=[a], outputs=[b]),
+            scheduler.Job("a", "gun", ["touch", a], outputs=[a])]
+    failed = scheduler.Scheduler(max_jobs=3).run(jobs)
+    assert failed == []
+    assert [job.status for job in jobs] == ["done", "done", "done"]
+
+def test_failure_skips_dependents_only(tmp_path):
+    log = tmp_path / "log.jsonl"
+    jobs = [scheduler.Job("bad", "gun", ["false"], outputs=["bad.out"]),
+            scheduler.Job("child", "delphes", ["true"], inputs=["bad.out"], outputs=["child.out"]),
+            scheduler.Job("good", "gun", ["true"], outputs=["good.out"])]
+    failed = scheduler.Scheduler(max_jobs=2, retries=1, log_path=str(log)).run(jobs)
+    assert [job.name for job in failed] == ["bad"]
+    assert jobs[0].attempts == 2
+    assert {job.name: job.status for job in jobs} == {"bad": "failed", "child": "skipped", "good": "done"}
+    records = scheduler.read_log(str(log))
+    assert sorted(r["name"] for r in records) == ["bad", "bad", "good"]
+
+def test_job_that_never_fits_fails():
+    jobs = [scheduler.Job("a", "delphes", ["true"])]
+    failed = scheduler.Scheduler(max_jobs=2, stage_limits={"delphes": 0}).run(jobs)
+    assert failed == jobs and jobs[0].status == "failed"
+
+def test_fits():
+    limits = scheduler.Scheduler(max_jobs=4, stage_limits={"delphes": 1}, memory_budget=1000)
+    running = {1: scheduler.Job("d1", "delphes", ["true"], memory=600)}
+    assert not limits.fits(scheduler.Job("d2", "delphes", ["true"]), running)
+    assert not limits.fits(scheduler.Job("a1", "analysis", ["true"], memory=500), running)
+    assert limits.fits(scheduler.Job("a2", "analysis", ["true"], memory=400), running)
+    # a job above the budget still runs alone
+    assert limits.fits(scheduler.Job("a3", "analysis", ["true"], memory=2000), {})
+
+def test_ranks_follow_the_longest_chain():
+    jobs = [scheduler.Job("gun", "gun", ["true"], outputs=["g"], cost=1),
+            scheduler.Job("slow", "delphes", ["true"], inputs=["g"], outputs=["s"], cost=10),
+            scheduler.Job("fast", "delphes", ["true"], inputs=["g"], outputs=["f"], cost=2),
+            scheduler.Job("plots", "plots", ["true"], inputs=["s", "f"], cost=1)]
+    scheduler.resolve_dependencies(jobs)
+    assert jobs[3].deps == {"slow", "fast"}
+    assert scheduler.upward_ranks(jobs) == {"gun": 12, "slow": 11, "fast": 3, "plots": 1}
+    order = [job.name for job in scheduler.topological_order(jobs)]
+    assert order.index("gun") < order.index("slow") < order.index("plots")
+
+def test_job_manifest_round_trip(tmp_path):
+    jobs = [scheduler.Job("a", "gun", ["true"], outputs=["a.out"], records=[("a.out", "digest")], cost=2, memory=100),
+            scheduler.Job("b", "delphes", ["true"], inputs=["a.out"], cost=3)]
+    path = scheduler.write_job_manifest(jobs, str(tmp_path / "jobs.json"))
+    read = scheduler.read_job_manifest(path)
+    assert [job.name for job in read] == ["a", "b"]
+    assert read[0].records == [("a.out", "digest")] and read[0].memory == 100
+    assert read[1].deps == {"a"}
+    assert [job.rank for job in read] == [5, 3]
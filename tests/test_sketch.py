@@ -0,0 +1,31 @@
+import math
+
+import numpy as np
+
+import sketch
+
+
+def make_sketch(x, alpha=0.002, min_value=1e-8, max_value=1.):
+    """Sketch of the values x, bucketed as QuantileSketchHelper in functions.h"""
+    log_gamma = math.log((1 + alpha)/(1 - alpha))
+    nbuckets = math.ceil(math.log(max_value/min_value)/log_gamma)
+    ax = np.abs(x)
+    index = np.where(ax >= min_value, np.clip(np.ceil(np.log(np.maximum(ax, min_value)/min_value)/log_gamma), 1, nbuckets), 0).astype(int)
+    counts = np.bincount(nbuckets + np.where(x < 0, -index, index), minlength=2*nbuckets + 1)
+    return sketch.Sketch(counts, alpha, min_value, x.sum(), (x*x).sum())
+
+def test_quantiles_within_relative_accuracy():
+    x = np.random.default_rng(1).normal(0., 0.01, 100000)
+    sk = make_sketch(x)
+    probabilities = [0.16, 0.5, 0.84]
+    exact = np.quantile(x, probabilities)
+    assert np.allclose(sk.quantiles(probabilities), exact, rtol=2*sk.alpha, atol=1e-6)
+    assert math.isclose(sk.mean, x.mean())
+    assert math.isclose(sk.rms, x.std(), rel_tol=1e-9)
+
+def test_empty_sketch_is_nan():
+    sk = make_sketch(np.zeros(0))
+    assert sk.empty
+    assert math.isnan(sk.mean) and math.isnan(sk.rms) and math.isnan(sk.rms_err)
+    assert np.all(np.isnan(sk.quantiles([0.16, 0.84])))
+    assert np.all(np.isnan(sk.bootstrap_quantiles([0.16, 0.84], nboot=10, rng=np.random.default_rng(1))))
@@ -0,0 +1,73 @@
+import os
+import time
+
+import scheduler
+import worker
+
+
+def make_jobs():
+    """Chain a -> b -> c and an independent job d"""
+    jobs = [scheduler.Job("a", "gun", ["true"], outputs=["a.out"]),
+            scheduler.Job("b", "delphes", ["true"], inputs=["a.out"], outputs=["b.out"]),
+            scheduler.Job("c", "analysis", ["true"], inputs=["b.out"], outputs=["c.out"]),
+            scheduler.Job("d", "gun", ["true"], outputs=["d.out"])]
+    scheduler.resolve_dependencies(jobs)
+    return jobs
+
+def test_claim_is_exclusive(tmp_path):
+    job = make_jobs()[0]
+    first = worker.JobState(str(tmp_path / "jobs.json"))
+    second = worker.JobState(str(tmp_path / "jobs.json"))
+    assert first.claim(job, "node1:1", stale_after=60)
+    assert not second.claim(job, "node2:1", stale_after=60)
+    assert first.owns(job) and not second.owns(job)
+    assert first.holder(job)[0] == "node1:1"
+    second.release(job) # not its lock: it stays
+    assert first.owns(job)
+    first.release(job)
+    assert first.holder(job) is None
+    assert second.claim(job, "node2:1", stale_after=60)
+
+def test_stale_lock_is_taken_over(tmp_path):
+    job = make_jobs()[0]
+    crashed = worker.JobState(str(tmp_path / "jobs.json"))
+    other = worker.JobState(str(tmp_path / "jobs.json"))
+    assert crashed.claim(job, "node1:1", stale_after=60)
+    old = time.time() - 120
+    os.utime(crashed.lock_path(job), (old, old))
+    assert other.claim(job, "node2:1", stale_after=60)
+    assert other.owns(job) and not crashed.owns(job)
+    # the former holder neither refreshes nor removes the new lock
+    os.utime(other.lock_path(job), (old, old))
+    crashed.touch(job)
+    assert other.holder(job)[1] > 100
+    crashed.release(job)
+    assert other.owns(job)
+    other.touch(job)
+    assert other.holder(job)[1] < 60
+
+def test_fresh_lock_is_not_taken_over(tmp_path):
+    job = make_jobs()[0]
+    first = worker.JobState(str(tmp_path / "jobs.json"))
+    second = worker.JobState(str(tmp_path / "jobs.json"))
+    assert first.claim(job, "node1:1", stale_after=60)
+    assert not second.claim(job, "node2:1", stale_after=60)
+    assert first.owns(job)
+
+def test_job_states(tmp_path):
+    jobs = make_jobs()
+    state = worker.JobState(str(tmp_path / "jobs.json"))
+    states, _ = worker.job_states(jobs, state)
+    assert states == {"a": "ready", "b": "waiting", "c": "waiting", "d": "ready"}
+
+    state.write_status(jobs[0], status="done", attempts=1, returncode=0)
+    state.write_status(jobs[1], status="retry", attempts=1, returncode=1)
+    assert state.claim(jobs[3], "node1:1", stale_after=60)
+    states, statuses = worker.job_states(jobs, state)
+    # a job to be retried is ready again
+    assert states == {"a": "done", "b": "ready", "c": "waiting", "d": "running"}
+    assert statuses["b"]["attempts"] == 1
+
+    state.write_status(jobs[1], status="failed", attempts=2, returncode=1)
+    states, _ = worker.job_states(jobs, state)
+    assert states["b"] == "failed" and states["c"] == "blocked"